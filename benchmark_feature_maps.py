@@ -0,0 +1,76 @@
+"""CPU time and memory of DPFP feature map: concatenation-based (cat, previous DPFP class, dpfp function in
+modeling_amt/language_modeling.py) vs gather of rolled copies (gather, modeling_amt.feature_maps.DPFP).
+
+Inputs are keys of one segment, (batch_size, seq_len, d_mem). For every d_mem and nu reports time of forward and
+backward, bytes allocated during forward (torch.profiler) and bytes saved for backward:
+
+python benchmark_feature_maps.py --d_mem 16 32 64 128 --nu 1 3 5 --batch_size 1 --seq_len 1024
+"""
+import argparse
+import json
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from modeling_amt.feature_maps import get_feature_map
+from modeling_amt.language_modeling import dpfp
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--d_mem', type=int, nargs='+', default=[16, 32, 64, 128])
+parser.add_argument('--nu', type=int, nargs='+', default=[1, 3, 5])
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--seq_len', type=int, default=1024)
+parser.add_argument('--n_iters', type=int, default=50)
+parser.add_argument('--n_threads', type=int, default=None, help='torch.set_num_threads')
+
+
+def step(phi, x):
+    out = phi(x)
+    out.backward(torch.ones_like(out))
+    x.grad = None
+
+
+def time_ms(phi, x, n_iters):
+    step(phi, x)
+    start = time.time()
+    for _ in range(n_iters):
+        step(phi, x)
+    return (time.time() - start) * 1000 / n_iters
+
+
+def allocated_mb(phi, x):
+    # total size of allocations during forward, frees are not subtracted
+    with torch.no_grad(), profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        phi(x)
+    return sum(max(e.self_cpu_memory_usage, 0) for e in prof.key_averages()) / 2 ** 20
+
+
+def saved_mb(phi, x):
+    saved = []
+
+    def pack(tensor):
+        saved.append(tensor.numel() * tensor.element_size())
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        phi(x)
+    return sum(saved) / 2 ** 20
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    for d_mem in args.d_mem:
+        for nu in args.nu:
+            x = torch.randn(args.batch_size, args.seq_len, d_mem, requires_grad=True)
+            feature_maps = {'cat': lambda x, nu=nu: dpfp(x, nu=nu), 'gather': get_feature_map('dpfp', d_mem, nu=nu)}
+            result = {'d_mem': d_mem, 'nu': nu}
+            for name, phi in feature_maps.items():
+                result[f'{name}_ms'] = time_ms(phi, x, args.n_iters)
+                result[f'{name}_allocated_mb'] = allocated_mb(phi, x)
+                result[f'{name}_saved_mb'] = saved_mb(phi, x)
+            result['speedup'] = result['cat_ms'] / result['gather_ms']
+            print(json.dumps(result))
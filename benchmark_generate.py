@@ -0,0 +1,112 @@
+"""Prefill and per-token decoding latency of AssociativeMemoryCell.generate.
+
+Compares the previous generate path, which builds embeddings and attention mask of the prompt with memory tokens
+and slices memory tokens off (previous), with the current one, which embeds the prompt directly (current). Both
+decode incrementally with KV cache (use_cache=True, the HF default), decoding without KV cache (no_cache) is added
+for reference. Memory is filled with a context segment once and restored before every generate call, generated
+tokens of all paths are checked to match (greedy decoding).
+
+python benchmark_generate.py --model_cfg gpt2 --model_cls transformers:GPT2LMHeadModel \
+    --d_mem 64 --num_mem_tokens 16 --segment_size 512 --prompt_len 128 --max_new_tokens 64 --device cpu
+"""
+import argparse
+import json
+import time
+
+import torch
+from transformers import AutoConfig
+
+from lm_experiments_tools.utils import get_cls_by_name
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_cfg', type=str, help='backbone model config name or path')
+parser.add_argument('--model_cls', type=str, default='transformers:GPT2LMHeadModel', help='backbone model class')
+parser.add_argument('--memory_cell_cls', type=str, default='modeling_amt.language_modeling:AssociativeMemoryCell')
+parser.add_argument('--layers_attr', type=str, default=None, help='attribute of model, which contains layers')
+parser.add_argument('--num_mem_tokens', type=int, default=16)
+parser.add_argument('--d_mem', type=int, default=64)
+parser.add_argument('--segment_size', type=int, default=512, help='length of context segment written to memory')
+parser.add_argument('--prompt_len', type=int, default=128)
+parser.add_argument('--max_new_tokens', type=int, default=64)
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--n_iters', type=int, default=5)
+parser.add_argument('--dtype', type=str, default='float32')
+parser.add_argument('--device', type=str, default=None, help='cuda if available, cpu otherwise')
+
+
+def previous_generate(cell, input_ids, attention_mask, **generate_kwargs):
+    # AssociativeMemoryCell.generate before prompt was embedded directly
+    cell.generate_mode(True)
+    seg_kwargs = cell.process_input(input_ids, attention_mask=attention_mask)
+    out = cell.model.generate(
+        inputs_embeds=seg_kwargs['inputs_embeds'][:, :-cell.num_mem_tokens],
+        attention_mask=seg_kwargs['attention_mask'][:, :-cell.num_mem_tokens],
+        **generate_kwargs
+    )
+    cell.generate_mode(False)
+    return out
+
+
+def current_generate(cell, input_ids, attention_mask, **generate_kwargs):
+    return cell.generate(input_ids, attention_mask, **generate_kwargs)
+
+
+def no_cache_generate(cell, input_ids, attention_mask, **generate_kwargs):
+    return cell.generate(input_ids, attention_mask, use_cache=False, **generate_kwargs)
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def timed_generate(fn, cell, memory_state, input_ids, attention_mask, max_new_tokens, n_iters, device):
+    generate_kwargs = dict(max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, do_sample=False,
+                           pad_token_id=cell.model.config.eos_token_id)
+    cell.set_memory_state(memory_state)
+    out = fn(cell, input_ids, attention_mask, **generate_kwargs)
+    sync(device)
+    start = time.time()
+    for _ in range(n_iters):
+        cell.set_memory_state(memory_state)
+        fn(cell, input_ids, attention_mask, **generate_kwargs)
+    sync(device)
+    return (time.time() - start) / n_iters, out
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    torch.manual_seed(42)
+
+    model = get_cls_by_name(args.model_cls)(config=AutoConfig.from_pretrained(args.model_cfg))
+    mem_cell_args = dict(base_model=model, num_mem_tokens=args.num_mem_tokens, d_mem=args.d_mem)
+    if args.layers_attr is not None:
+        mem_cell_args['layers_attr'] = args.layers_attr
+    cell = get_cls_by_name(args.memory_cell_cls)(**mem_cell_args)
+    cell.to(device=device, dtype=getattr(torch, args.dtype)).eval()
+
+    vocab_size = model.config.vocab_size
+    context_ids = torch.randint(0, vocab_size, (args.batch_size, args.segment_size), device=device)
+    input_ids = torch.randint(0, vocab_size, (args.batch_size, args.prompt_len), device=device)
+    attention_mask = torch.ones_like(input_ids)
+
+    with torch.no_grad():
+        cell(context_ids, attention_mask=torch.ones_like(context_ids), zero_mem=True)
+        memory_state = cell.get_memory_state()
+
+        outputs = {}
+        for name, fn in [('previous', previous_generate), ('current', current_generate),
+                         ('no_cache', no_cache_generate)]:
+            # prefill: time to the first token, decoding: time of every next token
+            prefill_time, _ = timed_generate(fn, cell, memory_state, input_ids, attention_mask, 1, args.n_iters,
+                                             device)
+            total_time, outputs[name] = timed_generate(fn, cell, memory_state, input_ids, attention_mask,
+                                                       args.max_new_tokens, args.n_iters, device)
+            result = {'path': name, 'prefill_ms': prefill_time * 1000,
+                      'per_token_ms': (total_time - prefill_time) * 1000 / max(args.max_new_tokens - 1, 1)}
+            print(json.dumps(result))
+
+    for name in ['current', 'no_cache']:
+        if not torch.equal(outputs[name], outputs['previous']):
+            print(f'generated tokens of {name} and previous paths differ')
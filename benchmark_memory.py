@@ -0,0 +1,162 @@
+"""Peak memory and throughput of a training step (forward + backward) of recurrent memory models.
+
+python benchmark_memory.py --model_cfg gpt2 --model_cls transformers:GPT2LMHeadModel \
+    --memory_cell_cls modeling_amt.language_modeling:AssociativeMemoryCell \
+    --recurrent_wrapper_cls modeling_amt.language_modeling:AssociativeRecurrentWrapper \
+    --d_mem 64 --segment_size 512 --n_segments 32 --k2 -1 1 4 16 --segment_checkpointing --offload_activations
+
+LM head applied only to masked positions vs full logits, on CPU with GPT-NeoX backbone and loss on 16 last tokens:
+python benchmark_memory.py --model_cfg EleutherAI/pythia-160m \
+    --model_cls base_models.modeling_gpt_neox:GPTNeoXForCausalLM --layers_attr gpt_neox.layers \
+    --memory_cell_cls modeling_amt.language_modeling:AssociativeMemoryCell \
+    --recurrent_wrapper_cls modeling_amt.language_modeling:AssociativeRecurrentWrapper \
+    --d_mem 64 --segment_size 256 --n_segments 8 --masked_lm_head --labels_mask_last 16 --device cpu
+
+Eager vs compiled (torch.compile, inductor) segment step, forward only, on CPU with a tiny GPT-NeoX config
+of associative retrieval runs (RMT: modeling_rmt.language_modeling:MemoryCell / RecurrentWrapper, no --d_mem):
+python benchmark_memory.py --model_cfg base_models/gptconfigs/neox_tiny_4l4hd128.json \
+    --model_cls base_models.modeling_gpt_neox:GPTNeoXForCausalLM \
+    --d_mem 32 --num_mem_tokens 8 --segment_size 64 --n_segments 16 --batch_size 8 \
+    --compile_segment_step --forward_only --device cpu
+
+Every configuration runs in a separate process, so peak RSS (peak_rss_mb) is measured per configuration.
+Model construction time and RSS after construction are reported too, with --construction_only the training step
+is skipped (e.g., to measure startup of evaluation workers with --wrap_pos).
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import time
+
+import torch
+from transformers import AutoConfig
+
+from lm_experiments_tools.utils import get_cls_by_name
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_cfg', type=str, help='backbone model config name or path')
+parser.add_argument('--model_cls', type=str, default='transformers:GPT2LMHeadModel', help='backbone model class')
+parser.add_argument('--memory_cell_cls', type=str, default='modeling_amt.language_modeling:AssociativeMemoryCell')
+parser.add_argument('--recurrent_wrapper_cls', type=str,
+                    default='modeling_amt.language_modeling:AssociativeRecurrentWrapper')
+parser.add_argument('--layers_attr', type=str, default=None, help='attribute of model, which contains layers')
+parser.add_argument('--num_mem_tokens', type=int, default=16)
+parser.add_argument('--wrap_pos', action='store_true', default=False, help='wrap positional embeddings (GPT-2 only)')
+parser.add_argument('--d_mem', type=int, default=None, help='number of rows in associative matrix (ARMT)')
+parser.add_argument('--segment_size', type=int, default=512)
+parser.add_argument('--n_segments', type=int, default=16)
+parser.add_argument('--batch_size', type=int, default=1)
+parser.add_argument('--k2', type=int, nargs='+', default=[-1], help='values of k2 to benchmark')
+parser.add_argument('--segment_checkpointing', action='store_true', default=False,
+                    help='also benchmark every k2 with segment checkpointing')
+parser.add_argument('--offload_activations', action='store_true', default=False,
+                    help='also benchmark every k2 with activations offload')
+parser.add_argument('--masked_lm_head', action='store_true', default=False,
+                    help='also benchmark every k2 with LM head applied only to positions used in loss')
+parser.add_argument('--labels_mask_last', type=int, default=None,
+                    help='compute loss only on N last tokens of input (as in BABILong and associative retrieval)')
+parser.add_argument('--compile_segment_step', action='store_true', default=False,
+                    help='also benchmark every k2 with compiled segment step')
+parser.add_argument('--forward_only', action='store_true', default=False, help='benchmark inference (no_grad) only')
+parser.add_argument('--construction_only', action='store_true', default=False,
+                    help='measure only model construction time and memory')
+parser.add_argument('--n_iters', type=int, default=5)
+parser.add_argument('--n_warmup_iters', type=int, default=1)
+parser.add_argument('--dtype', type=str, default='float32')
+parser.add_argument('--device', type=str, default=None, help='cuda if available, cpu otherwise')
+parser.add_argument('--output', type=str, default=None, help='save results to json file')
+
+
+def build_model(args, **rmt_kwargs):
+    model_cfg = AutoConfig.from_pretrained(args.model_cfg)
+    model = get_cls_by_name(args.model_cls)(config=model_cfg)
+
+    mem_cell_args = dict(base_model=model, num_mem_tokens=args.num_mem_tokens, wrap_pos=args.wrap_pos)
+    if args.d_mem is not None:
+        mem_cell_args['d_mem'] = args.d_mem
+    if args.layers_attr is not None:
+        mem_cell_args['layers_attr'] = args.layers_attr
+    cell = get_cls_by_name(args.memory_cell_cls)(**mem_cell_args)
+    return get_cls_by_name(args.recurrent_wrapper_cls)(cell, segment_size=args.segment_size,
+                                                       max_n_segments=args.n_segments, **rmt_kwargs)
+
+
+def benchmark(model, args, device):
+    vocab_size = model.memory_cell.model.config.vocab_size
+    input_ids = torch.randint(0, vocab_size, (args.batch_size, args.segment_size * args.n_segments), device=device)
+    attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
+    labels_mask = None
+    if args.labels_mask_last is not None:
+        labels_mask = torch.zeros_like(input_ids, dtype=torch.bool)
+        labels_mask[:, -args.labels_mask_last - 1:-1] = True
+
+    def step():
+        if args.forward_only:
+            with torch.no_grad():
+                model(input_ids=input_ids, labels=input_ids, labels_mask=labels_mask, attention_mask=attention_mask)
+            return
+        out = model(input_ids=input_ids, labels=input_ids, labels_mask=labels_mask, attention_mask=attention_mask)
+        out['loss'].backward()
+        model.zero_grad(set_to_none=True)
+
+    for _ in range(args.n_warmup_iters):
+        step()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start_time = time.time()
+    for _ in range(args.n_iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.time() - start_time
+
+    return {
+        'tokens_per_sec': input_ids.numel() * args.n_iters / elapsed,
+        'peak_memory_mb': torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else None,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+    }
+
+
+def run_config(args, rmt_kwargs):
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    torch.manual_seed(42)
+    start_time = time.time()
+    model = build_model(args, **rmt_kwargs).to(device=device, dtype=getattr(torch, args.dtype))
+    result = dict(**rmt_kwargs,
+                  construction_sec=time.time() - start_time,
+                  construction_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10)
+    if args.construction_only:
+        return result
+    result.update(benchmark(model, args, device))
+    if getattr(model, 'offloader', None) is not None:
+        result.update(model.offloader.report())
+    return result
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    configs = [dict(k2=k2) for k2 in args.k2]
+    if args.segment_checkpointing:
+        configs += [dict(k2=k2, segment_checkpointing=True) for k2 in args.k2]
+    if args.offload_activations:
+        configs += [dict(k2=k2, offload_activations=True) for k2 in args.k2]
+    if args.masked_lm_head:
+        configs += [dict(k2=k2, masked_lm_head=True) for k2 in args.k2]
+    if args.compile_segment_step:
+        configs += [dict(k2=k2, compile_segment_step=True) for k2 in args.k2]
+
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for rmt_kwargs in configs:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_config, (args, rmt_kwargs))
+        print(json.dumps(result))
+        results.append(result)
+
+    if args.output is not None:
+        json.dump(results, open(args.output, 'w'), indent=4)
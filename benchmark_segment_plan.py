@@ -0,0 +1,104 @@
+"""Per-segment overhead of legacy RMT encoders: everything in a forward pass except backbone calls.
+
+Compares per-sample segmentation with boolean-mask gathers/scatters of memory (loop) with batched segmentation and
+execution plan, where samples are sorted by number of segments once per batch (plan). Batches are random documents
+of contract-nli length (SCROLLS, ~1-8k tokens) split into segments as in scripts/contract-nli:
+
+python benchmark_segment_plan.py --model_cfg bert-base-cased --tokenizer bert-base-cased \
+    --input_size 512 --num_mem_tokens 10 --max_n_segments 16 --batch_size 1 4 16 --min_len 1000 --max_len 8000
+"""
+import argparse
+import json
+import time
+
+import torch
+from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+
+from modeling_rmt.sequence_classification import RMTEncoderForSequenceClassification
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model_cfg', type=str, help='backbone model config name or path')
+parser.add_argument('--tokenizer', type=str, help='tokenizer name or path')
+parser.add_argument('--input_size', type=int, default=512)
+parser.add_argument('--num_mem_tokens', type=int, default=10)
+parser.add_argument('--max_n_segments', type=int, default=16)
+parser.add_argument('--segment_alignment', type=str, default=None, help='left, right, center (default: right)')
+parser.add_argument('--batch_size', type=int, nargs='+', default=[1, 4, 16], help='batch sizes to benchmark')
+parser.add_argument('--min_len', type=int, default=1000, help='min document length in tokens')
+parser.add_argument('--max_len', type=int, default=8000, help='max document length in tokens')
+parser.add_argument('--n_steps', type=int, default=20)
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def make_batch(tokenizer, batch_size, args, device):
+    lengths = torch.randint(args.min_len, args.max_len + 1, (batch_size,))
+    samples = [tokenizer.build_inputs_with_special_tokens(torch.randint(1000, tokenizer.vocab_size, (l,)).tolist())
+               for l in lengths.tolist()]
+    input_ids = torch.full((batch_size, max(len(s) for s in samples)), tokenizer.pad_token_id)
+    for i, sample in enumerate(samples):
+        input_ids[i, :len(sample)] = torch.tensor(sample)
+    return input_ids.to(device)
+
+
+def loop_overhead(model, input_ids):
+    # per-sample segmentation, memory is gathered and scattered with non_empty_mask every segment
+    memory = model.set_memory(input_ids.shape)
+    for segment_input_ids in model.pad_and_segment_loop(input_ids):
+        seg_kwargs, non_empty_mask = model.prepare_kwargs(segment_input_ids, {})
+        if sum(non_empty_mask) == 0:
+            continue
+        seg_kwargs['inputs_embeds'][:, model.memory_position] = memory[non_empty_mask]
+        memory[non_empty_mask] = seg_kwargs['inputs_embeds'][:, model.memory_position]
+    return memory
+
+
+def plan_overhead(model, input_ids):
+    # batched segmentation, segment steps run on contiguous prefixes of sorted batch
+    memory = model.set_memory(input_ids.shape)
+    order, segmented, segmented_attention_mask, n_non_empty = model.segment_plan(model.pad_and_segment(input_ids))
+    for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
+        if n == 0:
+            continue
+        seg_kwargs = model.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n], {})
+        seg_kwargs['inputs_embeds'][:, model.memory_position] = memory[:n]
+        memory[:n] = seg_kwargs['inputs_embeds'][:, model.memory_position]
+    return model.restore_order(memory, order)
+
+
+def benchmark(fn, model, batches, device):
+    with torch.no_grad():
+        fn(model, batches[0])
+        sync(device)
+        start = time.time()
+        for input_ids in batches:
+            fn(model, input_ids)
+        sync(device)
+    return (time.time() - start) / len(batches)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    backbone = AutoModelForSequenceClassification.from_config(AutoConfig.from_pretrained(args.model_cfg))
+    rmt_config = {'input_size': args.input_size, 'max_n_segments': args.max_n_segments,
+                  'segment_alignment': args.segment_alignment, 'bptt_depth': -1, 'sum_loss': False}
+    model = RMTEncoderForSequenceClassification(backbone, num_mem_tokens=args.num_mem_tokens, tokenizer=tokenizer,
+                                                **rmt_config)
+    model.to(device).eval()
+
+    for batch_size in args.batch_size:
+        batches = [make_batch(tokenizer, batch_size, args, device) for _ in range(args.n_steps)]
+        result = {'batch_size': batch_size}
+        for name, fn in [('loop', loop_overhead), ('plan', plan_overhead)]:
+            step_time = benchmark(fn, model, batches, device)
+            result[f'{name}_step_ms'] = step_time * 1000
+            result[f'{name}_segment_ms'] = step_time * 1000 / args.max_n_segments
+        result['speedup'] = result['loop_step_ms'] / result['plan_step_ms']
+        print(json.dumps(result))
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import struct
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import torch
+
+# snapshot file layout:
+#   MAGIC | header length (uint64, little-endian) | json header | padding | tensor bytes
+# every tensor starts at an offset aligned to ALIGNMENT bytes, so it can be viewed directly from a memory map
+MAGIC = b'MEMSNAP1'
+ALIGNMENT = 64
+
+DTYPES = {str(dtype): dtype for dtype in [torch.float64, torch.float32, torch.float16, torch.bfloat16,
+                                          torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8,
+                                          torch.bool]}
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def flatten_state(state, tensors):
+    """Replaces tensors in nested dicts/lists/tuples with references to `tensors` list."""
+    if isinstance(state, torch.Tensor):
+        tensors.append(state)
+        return {'__tensor__': len(tensors) - 1}
+    if isinstance(state, dict):
+        return {'__dict__': {k: flatten_state(v, tensors) for k, v in state.items()}}
+    if isinstance(state, (list, tuple)):
+        return {'__list__': [flatten_state(v, tensors) for v in state]}
+    return state
+
+
+def unflatten_state(spec, tensors):
+    if isinstance(spec, dict):
+        if '__tensor__' in spec:
+            return tensors[spec['__tensor__']]
+        if '__dict__' in spec:
+            return {k: unflatten_state(v, tensors) for k, v in spec['__dict__'].items()}
+        if '__list__' in spec:
+            return [unflatten_state(v, tensors) for v in spec['__list__']]
+    return spec
+
+
+def save_memory_snapshot(path, memory_state, meta=None):
+    """Saves memory state of a memory cell to a single file.
+
+    Args:
+        path: snapshot file path
+        memory_state: RMT memory_state tensor or AssociativeMemoryCell.get_memory_state() output
+        meta (dict): optional json-serializable info stored in the header
+    """
+    tensors = []
+    spec = flatten_state(memory_state, tensors)
+    tensors = [t.detach().cpu().contiguous() for t in tensors]
+
+    tensors_info = []
+    offset = 0
+    for t in tensors:
+        nbytes = t.numel() * t.element_size()
+        tensors_info.append({'dtype': str(t.dtype), 'shape': list(t.shape), 'offset': offset, 'nbytes': nbytes})
+        offset = align(offset + nbytes)
+
+    header = json.dumps({'state': spec, 'tensors': tensors_info, 'meta': meta or {}}).encode('utf8')
+    data_start = align(len(MAGIC) + 8 + len(header))
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as fout:
+        fout.write(MAGIC)
+        fout.write(struct.pack('<Q', len(header)))
+        fout.write(header)
+        for t, info in zip(tensors, tensors_info):
+            fout.seek(data_start + info['offset'])
+            # bytes are written through uint8 view, numpy has no bfloat16
+            fout.write(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+        fout.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_header(path):
+    with open(path, 'rb') as fin:
+        if fin.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a memory snapshot')
+        header_len = struct.unpack('<Q', fin.read(8))[0]
+        header = json.loads(fin.read(header_len).decode('utf8'))
+    header['data_start'] = align(len(MAGIC) + 8 + header_len)
+    return header
+
+
+def load_memory_snapshot(path, return_meta=False):
+    """Loads memory state saved with save_memory_snapshot.
+
+    Tensors are CPU views of a copy-on-write memory map of the file: no data is read until it is used,
+    and in-place modifications do not change the file. Move the state to the model device with .to().
+    """
+    header = read_header(path)
+    mmap = np.memmap(path, dtype=np.uint8, mode='c')
+    tensors = []
+    for info in header['tensors']:
+        start = header['data_start'] + info['offset']
+        buffer = torch.from_numpy(mmap[start:start + info['nbytes']])
+        tensors.append(buffer.view(DTYPES[info['dtype']]).view(info['shape']))
+
+    state = unflatten_state(header['state'], tensors)
+    if return_meta:
+        return state, header['meta']
+    return state
+
+
+class MemorySnapshotStore:
+    """Directory of memory snapshots, one file per key, with an LRU cache of loaded states in RAM.
+
+    store = MemorySnapshotStore('snapshots/', cache_size=32)
+    store.put(doc_id, session.memory_state)
+    ...
+    memory_state = store.get(doc_id)
+    """
+    def __init__(self, root, cache_size=16):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def path(self, key):
+        return self.root / f'{hashlib.sha1(str(key).encode("utf8")).hexdigest()}.mem'
+
+    def put(self, key, memory_state, meta=None):
+        meta = dict(meta or {}, key=str(key))
+        save_memory_snapshot(self.path(key), memory_state, meta=meta)
+        self.cache.pop(key, None)
+
+    def get(self, key, default=None):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        path = self.path(key)
+        if not path.exists():
+            return default
+
+        state = load_memory_snapshot(path)
+        if self.cache_size > 0:
+            self.cache[key] = state
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return state
+
+    def delete(self, key):
+        self.cache.pop(key, None)
+        path = self.path(key)
+        if path.exists():
+            path.unlink()
+
+    def __contains__(self, key):
+        return key in self.cache or self.path(key).exists()
@@ -0,0 +1,94 @@
+import math
+import torch
+from torch.nn.functional import relu as r
+
+# feature maps phi applied to associative memory keys and queries, selected by name with get_feature_map
+FEATURE_MAPS = {}
+
+
+def register_feature_map(name):
+    def register(cls):
+        FEATURE_MAPS[name] = cls
+        return cls
+    return register
+
+
+def get_feature_map(name, d_mem, **kwargs):
+    if name not in FEATURE_MAPS:
+        raise ValueError(f'Unknown feature map {name}, available: {list(FEATURE_MAPS)}')
+    return FEATURE_MAPS[name](d_mem, **kwargs)
+
+
+@register_feature_map('dpfp')
+class DPFP:
+    """Deterministic parameter-free projection, 2 * nu * d_mem features.
+
+    Computes cat([x2 * x2.roll(j) for j in 1..nu]) with x2 = cat([relu(x), relu(-x)]) as a single broadcasted
+    product of x2 and a gather of its rolled copies, without concatenations.
+    """
+    def __init__(self, d_mem, nu=3):
+        self.nu = nu
+        self.d_key = 2 * nu * d_mem
+        self.signs = {}
+        self.roll_inds = {}
+
+    def get_signs(self, device, dtype):
+        key = (device, dtype)
+        if key not in self.signs:
+            self.signs[key] = torch.tensor([[1], [-1]], device=device, dtype=dtype)
+        return self.signs[key]
+
+    def get_roll_inds(self, dim, device):
+        # roll_inds[j - 1, i] = (i - j) % dim, i.e. x[..., roll_inds[j - 1]] == x.roll(shifts=j, dims=-1)
+        key = (dim, device)
+        if key not in self.roll_inds:
+            shifts = torch.arange(1, self.nu + 1, device=device)[:, None]
+            self.roll_inds[key] = (torch.arange(dim, device=device)[None, :] - shifts) % dim
+        return self.roll_inds[key]
+
+    def __call__(self, x):
+        x = r(x[..., None, :] * self.get_signs(x.device, x.dtype)).flatten(-2)  # (..., 2d): relu(x), relu(-x)
+        x_rolled = x[..., self.get_roll_inds(x.shape[-1], x.device)]                # (..., nu, 2d)
+        return (x[..., None, :] * x_rolled).flatten(-2)
+
+
+@register_feature_map('identity')
+class IdentityFeatureMap:
+    def __init__(self, d_mem):
+        self.d_key = d_mem
+
+    def __call__(self, x):
+        return x
+
+
+@register_feature_map('elu')
+class ELUFeatureMap:
+    # elu(x) + 1 from "Transformers are RNNs", Katharopoulos et al., 2020
+    def __init__(self, d_mem):
+        self.d_key = d_mem
+
+    def __call__(self, x):
+        return torch.nn.functional.elu(x) + 1
+
+
+@register_feature_map('favor')
+class FAVORFeatureMap(torch.nn.Module):
+    # positive orthogonal random features from "Rethinking Attention with Performers", Choromanski et al., 2020
+    def __init__(self, d_mem, n_features=None):
+        super().__init__()
+        self.d_mem = d_mem
+        self.d_key = n_features if n_features is not None else 2 * d_mem
+        self.register_buffer('projection', self.sample_projection(self.d_key, d_mem))
+
+    @staticmethod
+    def sample_projection(n_features, d_mem):
+        blocks = []
+        for _ in range(math.ceil(n_features / d_mem)):
+            q, _ = torch.linalg.qr(torch.randn(d_mem, d_mem))
+            blocks.append(q.T)
+        norms = torch.randn(n_features, d_mem).norm(dim=-1, keepdim=True)
+        return torch.cat(blocks)[:n_features] * norms
+
+    def forward(self, x):
+        projected = x @ self.projection.to(x.dtype).T
+        return torch.exp(projected - (x ** 2).sum(dim=-1, keepdim=True) / 2) / math.sqrt(self.d_key)
@@ -1,10 +1,20 @@
 import math
 import torch
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
+from contextlib import nullcontext
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 from torch.nn.functional import relu as r
 import wandb
 
+from .feature_maps import DPFP, get_feature_map  # noqa: F401
+from .memory_storage import get_memory_storage
+from modeling_rmt.offload import ActivationOffloader
+from modeling_rmt.losses import chunked_cross_entropy
+from modeling_rmt.segmentation import segment, split_tensor
+from modeling_rmt.kv_cache import SlidingWindowCache
+from modeling_rmt.backbones import get_backbone_adapter
+
 def dpfp(x, nu=1):
   x = torch.cat([r(x), r(-x)], dim=-1)
   x_rolled = torch.cat([x.roll(shifts=j, dims=-1)
@@ -12,32 +22,40 @@ def dpfp(x, nu=1):
   x_repeat = torch.cat([x] * nu, dim=-1)
   return x_repeat * x_rolled
 
-class DPFP:
-    def __init__(self, nu):
-        self.nu = nu
-    
-    def __call__(self, x):
-        nu = self.nu
-        x = torch.cat([r(x), r(-x)], dim=-1)
-        x_rolled = torch.cat([x.roll(shifts=j, dims=-1) for j in range(1,nu+1)], dim=-1)
-        x_repeat = torch.cat([x] * nu, dim=-1)
-        return x_repeat * x_rolled
+def get_assoc_layers(schedule, n_layers):
+    """Indices of layers with associative memory.
+
+    schedule: None or 'all', list of indices, 'every:k' (every k-th layer counting down from the last one),
+    'top:n' (last n layers) or comma-separated indices, e.g. '0,3,5'. Negative indices count from the end.
+    """
+    if schedule is None or schedule == 'all':
+        return list(range(n_layers))
+    if isinstance(schedule, str):
+        if schedule.startswith('every:'):
+            k = int(schedule[len('every:'):])
+            return list(range((n_layers - 1) % k, n_layers, k))
+        if schedule.startswith('top:'):
+            n = int(schedule[len('top:'):])
+            return list(range(max(n_layers - n, 0), n_layers))
+        schedule = [int(i) for i in schedule.split(',') if i.strip()]
+    layers = sorted({i % n_layers for i in schedule})
+    if len(layers) == 0:
+        raise ValueError(f'Empty associative layers schedule: {schedule}')
+    return layers
 
 class AssociativeLayerWrapper(torch.nn.Module):
 
-    def __init__(self, layer, d_model, num_mem_tokens, d_mem, correction=True, info=None) -> None:
+    def __init__(self, layer, d_model, num_mem_tokens, d_mem, correction=True, info=None,
+                 feature_map='dpfp', feature_map_kwargs=None,
+                 memory_storage='dense', memory_storage_kwargs=None) -> None:
         super().__init__()
         self.info = info
-        self.seg_num = 0
         self.d_model = d_model
         self.num_mem_tokens = num_mem_tokens
         self.d_mem = d_mem
 
-        nu = 3
-        self.d_key = 2 * nu * d_mem
-        self.phi = DPFP(nu)
-        # self.d_key = d_mem
-        # self.phi = torch.nn.Identity()
+        self.phi = get_feature_map(feature_map, d_mem, **(feature_map_kwargs or {}))
+        self.d_key = self.phi.d_key
 
         self.W_mq = torch.nn.Linear(d_model, d_mem, bias=False)
         # torch.nn.init.zeros_(self.W_mq.weight)
@@ -46,10 +64,9 @@ class AssociativeLayerWrapper(torch.nn.Module):
         torch.nn.init.zeros_(self.W_mv.weight)
         self.W_mb = torch.nn.Linear(d_model, 1)
 
-        self.W_mem = torch.zeros(1, self.d_key, d_model)
-        self.z = torch.zeros(1, self.d_key)
-        self.W_mem.requires_grad_(False)
-        self.z.requires_grad_(False)
+        self.W_mem = get_memory_storage(memory_storage, (1, self.d_key, d_model), **(memory_storage_kwargs or {}))
+        # memory state is reset to these buffers, they follow device and dtype of the model
+        self.register_buffer('z_zero', torch.zeros(1, self.d_key), persistent=False)
         
         # self.ln = torch.nn.LayerNorm(d_model)
 
@@ -63,15 +80,12 @@ class AssociativeLayerWrapper(torch.nn.Module):
 
     def associate(self, hidden_states):
 
-        self.W_mem = self.W_mem.to(hidden_states.device)
-        self.z = self.z.to(hidden_states.device)
-        
         mq = self.phi(self.W_mq(hidden_states)) # (bsz, seq_len, 2d_mem * nu)
 
         # crutch for dataparallel
         # mq += 0 * self.W_mb(hidden_states).sum() * self.W_mk(hidden_states).sum() * self.W_mv(hidden_states).sum() 
 
-        num = torch.einsum('ijk,ikt->ijt', mq, self.W_mem)
+        num = self.W_mem.read(mq)
         denom = torch.einsum("ik,ijk->ij", self.z, mq)[..., None] + 1e-5
         hidden_states = num / denom
 
@@ -93,13 +107,10 @@ class AssociativeLayerWrapper(torch.nn.Module):
 
     def update_mem(self, mem_tokens):
 
-        self.W_mem = self.W_mem.to(mem_tokens.device)
-        self.z = self.z.to(mem_tokens.device)
-
         mk = self.phi(self.W_mk(mem_tokens))
         new_mv = self.W_mv(mem_tokens) # (bsz, num_mem_tokens, d_model)
         if not self.first_seg:
-            num = torch.einsum('ijk,ikt->ijt', mk, self.W_mem)
+            num = self.W_mem.read(mk)
             denom = torch.einsum("ij,ikj->ik", self.z, mk)[..., None] + 1e-5
             prev_mv = num / denom
             if self.correction:
@@ -121,24 +132,134 @@ class AssociativeLayerWrapper(torch.nn.Module):
 
         mb = torch.sigmoid(self.W_mb(mem_tokens))[..., 0]
 
-        associations =  torch.einsum('ijk,ijt,ij->ikt', mk, mv, mb) # (bsz, d_mem, d_model)
-        self.W_mem = self.W_mem + associations
+        self.W_mem.add(mk * mb[..., None], mv)  # W_mem += sum_j mb_j * mk_j^T mv_j
 
         self.z = self.z + (new_info_coef*mk).sum(dim=1)
         # self.z = self.z + (new_info_coef*mb[..., None]*mk).sum(dim=1)
-        self.seg_num += 1
 
 
     def zero_mem(self):
         self.first_seg = True
-        self.W_mem = torch.zeros(1, self.d_key, self.d_model)
-        self.z = torch.zeros(1, self.d_key)
-        self.seg_num = 0
+        self.W_mem.zero()
+        self.z = self.z_zero
+
+    def get_memory_state(self):
+        return dict(**self.W_mem.get_state(), z=self.z, first_seg=self.first_seg)
+
+    def set_memory_state(self, state):
+        self.W_mem.set_state(state)
+        self.z = state['z'].to(self.z_zero.device)
+        self.first_seg = state['first_seg']
+
+
+class StackedAssociativeMemory(torch.nn.Module):
+    """Associative memory of all wrapped layers kept in a single (n_layers, bsz, d_key, d_model) tensor.
+
+    Reads are done per layer (inputs of layer i depend on outputs of layer i-1), writes are collected
+    during the segment and applied to all layers at once in update_mem.
+    """
+    def __init__(self, n_layers, d_model, d_mem, correction=True, feature_map='dpfp', feature_map_kwargs=None,
+                 memory_storage='dense', memory_storage_kwargs=None) -> None:
+        super().__init__()
+        self.n_layers = n_layers
+        self.d_model = d_model
+        self.d_mem = d_mem
+
+        self.phi = get_feature_map(feature_map, d_mem, **(feature_map_kwargs or {}))
+        self.d_key = self.phi.d_key
+
+        # same init as in torch.nn.Linear, weights are stored as (n_layers, in_features, out_features)
+        bound = 1 / math.sqrt(d_model)
+        self.W_mq = torch.nn.Parameter(torch.empty(n_layers, d_model, d_mem).uniform_(-bound, bound))
+        self.W_mk = torch.nn.Parameter(torch.empty(n_layers, d_model, d_mem).uniform_(-bound, bound))
+        self.W_mv = torch.nn.Parameter(torch.zeros(n_layers, d_model, d_model))
+        self.W_mb = torch.nn.Parameter(torch.empty(n_layers, d_model, 1).uniform_(-bound, bound))
+        self.b_mb = torch.nn.Parameter(torch.empty(n_layers, 1).uniform_(-bound, bound))
+
+        self.correction = correction
+        self.W_mem = get_memory_storage(memory_storage, (n_layers, 1, self.d_key, d_model),
+                                        **(memory_storage_kwargs or {}))
+        self.pending_mem_tokens = [None] * n_layers
+        self.register_buffer('z_zero', torch.zeros(n_layers, 1, self.d_key), persistent=False)
+        self.zero_mem()
+
+    def associate(self, layer_idx, hidden_states):
+        mq = self.phi(hidden_states @ self.W_mq[layer_idx])  # (bsz, seq_len, 2d_mem * nu)
+        num = self.W_mem.read(mq, layer_idx)
+        denom = mq @ self.z[layer_idx][..., None] + 1e-5
+        return num / denom
+
+    def write(self, layer_idx, mem_tokens):
+        # indexed by layer, so recomputation of a layer (e.g. gradient checkpointing) does not duplicate writes
+        self.pending_mem_tokens[layer_idx] = mem_tokens
+
+    def update_mem(self):
+        if any(m is None for m in self.pending_mem_tokens):
+            return
+        mem_tokens = torch.stack(self.pending_mem_tokens)  # (n_layers, bsz, num_mem_tokens, d_model)
+        self.pending_mem_tokens = [None] * self.n_layers
+
+        mk = self.phi(mem_tokens @ self.W_mk[:, None])
+        new_mv = mem_tokens @ self.W_mv[:, None]
+        if not self.first_seg:
+            num = self.W_mem.read(mk)
+            denom = mk @ self.z[..., None] + 1e-5
+            prev_mv = num / denom
+            if self.correction:
+                new_info_coef = 1 - denom / (torch.linalg.norm(mk, dim=-1) ** 2 + 1e-5)[..., None]
+                new_info_coef = torch.clip(new_info_coef, 0, 1).detach()
+            else:
+                new_info_coef = 1
+        else:
+            prev_mv = torch.zeros_like(new_mv, device=new_mv.device)
+            new_info_coef = 1
+
+        mv = new_mv - prev_mv
+        mb = torch.sigmoid(mem_tokens @ self.W_mb[:, None] + self.b_mb[:, None, None])
+
+        self.W_mem.add(mk * mb, mv)  # (n_layers, bsz, d_key, d_model)
+        self.z = self.z + (new_info_coef * mk).sum(dim=-2)
+
+        self.first_seg = False
+
+    def zero_mem(self):
+        self.first_seg = True
+        self.W_mem.zero()
+        self.z = self.z_zero
+        self.pending_mem_tokens = [None] * self.n_layers
+
+    def get_memory_state(self):
+        return dict(**self.W_mem.get_state(), z=self.z, first_seg=self.first_seg)
 
+    def set_memory_state(self, state):
+        self.W_mem.set_state(state)
+        self.z = state['z'].to(self.z_zero.device)
+        self.first_seg = state['first_seg']
+
+
+class StackedLayerWrapper(torch.nn.Module):
+    def __init__(self, layer, memory, layer_idx, num_mem_tokens) -> None:
+        super().__init__()
+        self.layer = layer
+        # plain reference: shared memory is registered once in AssociativeMemoryCell, not in every layer
+        object.__setattr__(self, 'memory', memory)
+        self.layer_idx = layer_idx
+        self.num_mem_tokens = num_mem_tokens
+        self.generate_mode = False
+
+    def forward(self, hidden_states, **kwargs):
+        if not self.memory.first_seg:
+            hidden_states = self.memory.associate(self.layer_idx, hidden_states) + hidden_states
+        out = self.layer(hidden_states=hidden_states, **kwargs)
+        if not self.generate_mode:
+            self.memory.write(self.layer_idx, out[0][:, -self.num_mem_tokens:])
+        return out
 
 
 class AssociativeMemoryCell(torch.nn.Module):
-    def __init__(self, base_model, num_mem_tokens, d_mem, layers_attr: str = 'transformer.h', wrap_pos=True, correction=True):
+    def __init__(self, base_model, num_mem_tokens, d_mem, layers_attr: str = None, wrap_pos=True, correction=True,
+                 stacked_memory=False, feature_map='dpfp', feature_map_kwargs=None,
+                 memory_storage='dense', memory_storage_kwargs=None, assoc_layers=None):
         super().__init__()
         self.model = base_model
         self.num_mem_tokens = num_mem_tokens
@@ -146,28 +267,82 @@ class AssociativeMemoryCell(torch.nn.Module):
         self.d_model = base_model.get_input_embeddings().embedding_dim
         self.W_mq = torch.nn.ModuleList()
         self.W_mem = []
-        self.layers = self.model
 
-        self.layers_attrs = layers_attr.split('.')
-        for i, attr in enumerate(self.layers_attrs):
-            self.layers = getattr(self.layers, attr)
-        
-        for i in range(len(self.layers)):
-            self.layers[i] = AssociativeLayerWrapper(
-                self.layers[i], 
-                self.d_model, 
-                self.num_mem_tokens, 
-                self.d_mem, 
-                correction,
-                info={'layer': i}
-            )
+        # layers_attr defaults to the layers of backbone architecture
+        self.backbone = get_backbone_adapter(base_model)
+        self.layers = self.backbone.get_layers(layers_attr)
+        self.layers_attr = layers_attr or self.backbone.layers_attr
+        self.layers_attrs = self.layers_attr.split('.')
+
+        # layers not in assoc_layers are left as is and run without associative memory
+        self.assoc_layers = get_assoc_layers(assoc_layers, len(self.layers))
+        self.stacked_memory = None
+        if stacked_memory:
+            self.stacked_memory = StackedAssociativeMemory(len(self.assoc_layers), self.d_model, self.d_mem, correction,
+                                                           feature_map, feature_map_kwargs,
+                                                           memory_storage, memory_storage_kwargs)
+            for j, i in enumerate(self.assoc_layers):
+                self.layers[i] = StackedLayerWrapper(self.layers[i], self.stacked_memory, j, self.num_mem_tokens)
+        else:
+            for i in self.assoc_layers:
+                self.layers[i] = AssociativeLayerWrapper(
+                    self.layers[i],
+                    self.d_model,
+                    self.num_mem_tokens,
+                    self.d_mem,
+                    correction,
+                    info={'layer': i},
+                    feature_map=feature_map,
+                    feature_map_kwargs=feature_map_kwargs,
+                    memory_storage=memory_storage,
+                    memory_storage_kwargs=memory_storage_kwargs
+                )
+        self._register_load_state_dict_pre_hook(self.remap_assoc_layers_state_dict)
         self.create_memory(num_mem_tokens)
         self.wrap_pos = wrap_pos
         if wrap_pos:
             self.wrap_positional_embeddings(num_mem_tokens)
-    
+
+    def associative_layers(self):
+        return [self.layers[i] for i in self.assoc_layers]
+
+    def remap_assoc_layers_state_dict(self, state_dict, prefix, *args):
+        # makes checkpoints loadable with another layers schedule:
+        # weights of unwrapped layers are moved from layer.* to the layer itself, associative weights of
+        # unwrapped layers are dropped, and associative weights missing in checkpoint are kept from init
+        own_state = self.state_dict()
+        # layers are registered both in model and in the cell itself
+        for layers_prefix in [f'{prefix}model.{self.layers_attr}.', f'{prefix}layers.']:
+            for i in range(len(self.layers)):
+                layer_prefix = f'{layers_prefix}{i}.'
+                keys = [k for k in state_dict if k.startswith(layer_prefix)]
+                if len(keys) == 0:
+                    continue
+                ckpt_wrapped = any(k.startswith(f'{layer_prefix}layer.') for k in keys)
+                wrapped = i in self.assoc_layers
+                if ckpt_wrapped and not wrapped:
+                    for k in keys:
+                        value = state_dict.pop(k)
+                        if k.startswith(f'{layer_prefix}layer.'):
+                            state_dict[layer_prefix + k[len(f'{layer_prefix}layer.'):]] = value
+                elif wrapped and not ckpt_wrapped:
+                    for k in keys:
+                        state_dict[f'{layer_prefix}layer.{k[len(layer_prefix):]}'] = state_dict.pop(k)
+                    for k, value in own_state.items():
+                        if f'{prefix}{k}'.startswith(layer_prefix) and f'{prefix}{k}' not in state_dict:
+                            state_dict[f'{prefix}{k}'] = value
+
+        if self.stacked_memory is not None:
+            for k, value in self.stacked_memory.state_dict().items():
+                key = f'{prefix}stacked_memory.{k}'
+                if key not in state_dict:
+                    state_dict[key] = value
+                elif state_dict[key].shape[0] == len(self.layers) != value.shape[0]:
+                    # checkpoint with memory in all layers
+                    state_dict[key] = state_dict[key][self.assoc_layers]
+
     def generate_mode(self, is_on):
-        for layer in self.layers:
+        for layer in self.associative_layers():
             layer.generate_mode = is_on
     
     def create_memory(self, num_mem_tokens):
@@ -178,39 +353,146 @@ class AssociativeMemoryCell(torch.nn.Module):
         self.register_parameter('memory', torch.nn.Parameter(memory_weights, requires_grad=True))
 
     def wrap_positional_embeddings(self, num_mem_tokens):
-        num_pos_embs, emb_dim = self.model.transformer.wpe.weight.shape
-        prev_embs = self.model.transformer.wpe.weight.detach()
-        self.model.transformer.wpe = torch.nn.Embedding(num_mem_tokens + num_pos_embs, emb_dim)
-
-        new_num_pos = num_pos_embs + num_mem_tokens
-        with torch.no_grad():
-            self.model.transformer.wpe.weight[:len(self.model.transformer.wpe.weight)-num_mem_tokens] = prev_embs
-        for layer in self.model.transformer.h:
-            layer.layer.attn.bias = torch.tril(torch.ones((new_num_pos, new_num_pos), dtype=torch.uint8)).view(
-                1, 1, new_num_pos, new_num_pos
-            )
+        # positions of memory tokens and causal masks depend on the backbone, see modeling_rmt/backbones.py
+        mask_size = self.backbone.wrap_positional_embeddings(0, num_mem_tokens)
+        if mask_size is None:
+            return
+        self.register_buffer('causal_mask', torch.ones((mask_size, mask_size), dtype=torch.bool).tril_().view(
+            1, 1, mask_size, mask_size), persistent=False)
+        self.tie_causal_mask()
+        self._register_load_state_dict_pre_hook(self.drop_causal_mask_state_dict)
+
+    def tie_causal_mask(self):
+        # all attention layers reference the single causal mask of the cell instead of keeping a copy each,
+        # it is not a buffer of layers, so it is moved by model.to() once and tied again in _apply
+        for attn in self.backbone.attention_modules():
+            attn._buffers.pop('bias', None)
+            attn.bias = self.causal_mask
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        if getattr(self, 'causal_mask', None) is not None:
+            self.tie_causal_mask()
+        return self
+
+    def drop_causal_mask_state_dict(self, state_dict, prefix, *args):
+        # checkpoints saved with per-layer masks
+        for k in [k for k in state_dict if k.startswith(prefix) and k.endswith('.attn.bias')]:
+            state_dict.pop(k)
 
     def set_memory(self, input_shape):
         memory = self.memory.repeat(input_shape[0], 1, 1)
         return memory
 
     def zero_mem(self):
-        for layer in self.layers:
+        if self.stacked_memory is not None:
+            self.stacked_memory.zero_mem()
+            return
+        for layer in self.associative_layers():
             layer.zero_mem()
 
-    def forward(self, input_ids, labels=None, labels_mask=None, zero_mem=False, **kwargs):
+    def get_memory_state(self):
+        if self.stacked_memory is not None:
+            return self.stacked_memory.get_memory_state()
+        return [layer.get_memory_state() for layer in self.associative_layers()]
+
+    def set_memory_state(self, state):
+        if self.stacked_memory is not None:
+            self.stacked_memory.set_memory_state(state)
+            return
+        for layer, layer_state in zip(self.associative_layers(), state):
+            layer.set_memory_state(layer_state)
+
+    def detach_mem(self):
+        def detach(layer_state):
+            return {k: v.detach() if isinstance(v, torch.Tensor) else v for k, v in layer_state.items()}
+
+        state = self.get_memory_state()
+        if self.stacked_memory is not None:
+            self.set_memory_state(detach(state))
+        else:
+            self.set_memory_state([detach(layer_state) for layer_state in state])
+
+    def fork_memory_state(self, state, n_forks):
+        # repeats memory of every sample n_forks times along the batch dim
+        if n_forks == 1:
+            return state
+        batch_dim = 1 if self.stacked_memory is not None else 0
+
+        def fork(layer_state):
+            forked = dict(layer_state)
+            for key, value in layer_state.items():
+                if isinstance(value, torch.Tensor) and value.size(batch_dim) > 1:
+                    forked[key] = value.repeat_interleave(n_forks, dim=batch_dim)
+            return forked
+
+        if self.stacked_memory is not None:
+            return fork(state)
+        return [fork(layer_state) for layer_state in state]
+
+    def select_memory_state(self, state, index):
+        # memory of samples in index, memory shared by the whole batch (batch size 1) is kept as is
+        batch_dim = 1 if self.stacked_memory is not None else 0
+
+        def select(layer_state):
+            selected = dict(layer_state)
+            for key, value in layer_state.items():
+                if isinstance(value, torch.Tensor) and value.size(batch_dim) > 1:
+                    selected[key] = value.index_select(batch_dim, index)
+            return selected
+
+        if self.stacked_memory is not None:
+            return select(state)
+        return [select(layer_state) for layer_state in state]
+
+    def scatter_memory_state(self, state, new_state, index, batch_size):
+        # memory of the whole batch: samples in index are taken from new_state, others from state.
+        # first_seg is taken from new_state
+        batch_dim = 1 if self.stacked_memory is not None else 0
+
+        def expand(tensor, size):
+            shape = list(tensor.shape)
+            shape[batch_dim] = size
+            return tensor.expand(*shape)
+
+        def scatter(layer_state, new_layer_state):
+            scattered = dict(new_layer_state)
+            for key, value in layer_state.items():
+                if isinstance(value, torch.Tensor):
+                    new_value = expand(new_layer_state[key], len(index))
+                    scattered[key] = expand(value.to(new_value.dtype), batch_size).index_copy(batch_dim, index,
+                                                                                              new_value)
+            return scattered
+
+        if self.stacked_memory is not None:
+            return scatter(state, new_state)
+        return [scatter(layer_state, new_layer_state) for layer_state, new_layer_state in zip(state, new_state)]
+
+    def forward(self, input_ids, labels=None, labels_mask=None, zero_mem=False, lm_head=True, **kwargs):
         if zero_mem:
             self.zero_mem()
 
 
         seg_kwargs = self.process_input(input_ids, **kwargs)
 
-        out = self.model(**seg_kwargs)
+        # without lm_head logits are not computed, last_hidden_state is returned instead
+        out = self.model(**seg_kwargs) if lm_head else self.model.base_model(**seg_kwargs)
+        if self.stacked_memory is not None:
+            self.stacked_memory.update_mem()
 
         out = self.process_output(out, labels, labels_mask, **kwargs)
 
         return out
 
+    def segment_step(self, memory_state, input_ids, attention_mask=None, lm_head=True, output_hidden_states=False,
+                     output_attentions=False):
+        # memory state as explicit input and output for torch.compile (AssociativeRecurrentWrapper with
+        # compile_segment_step), flags are constants of the graph
+        self.set_memory_state(memory_state)
+        out = self(input_ids, attention_mask=attention_mask, lm_head=lm_head, zero_mem=False,
+                   output_hidden_states=output_hidden_states, output_attentions=output_attentions)
+        return out, self.get_memory_state()
+
     def process_input(self, input_ids, **kwargs):
         memory_state = self.set_memory(input_ids.shape)
         seg_kwargs = dict(**kwargs)
@@ -222,35 +504,39 @@ class AssociativeMemoryCell(torch.nn.Module):
         seg_kwargs['input_ids'] = None
         seg_kwargs['inputs_embeds'] = inputs_embeds
         if kwargs.get('attention_mask') is not None:
-            seg_kwargs['attention_mask'] = self.pad_attention_mask(kwargs['attention_mask'], inputs_embeds.shape)
-            if kwargs.get('prev_attn_mask') is not None:
-                seg_kwargs['attention_mask'] = torch.cat([kwargs['prev_attn_mask'], seg_kwargs['attention_mask']], dim=-1)
-            if 'prev_attn_mask' in seg_kwargs:
-                seg_kwargs.pop('prev_attn_mask')
-        seg_kwargs['output_hidden_states'] = True
+            seg_kwargs['attention_mask'] = self.pad_attention_mask(kwargs['attention_mask'], inputs_embeds.shape,
+                                                                   kwargs.get('prev_attn_mask'))
+            seg_kwargs.pop('prev_attn_mask', None)
 
         if self.wrap_pos:
-            num_pos_embs = self.model.transformer.wpe.weight.shape[0]
-            ordinary_pos = torch.arange(0, input_ids.size(1), dtype=torch.long, device=input_ids.device)
-            write_pos = torch.arange(num_pos_embs - self.num_mem_tokens, num_pos_embs, dtype=torch.long, device=input_ids.device)
-            seg_kwargs['position_ids'] = torch.cat([
-                ordinary_pos, 
-                write_pos
-            ]).long().unsqueeze(0)
+            seg_len = inputs_embeds.size(1) - self.num_mem_tokens
+            past_key_values = kwargs.get('past_key_values')
+            past_length = past_key_values[0][0].size(-2) if past_key_values is not None else 0
+            position_ids = self.backbone.position_ids(seg_len, 0, self.num_mem_tokens, inputs_embeds.device,
+                                                      past_length)
+            if position_ids is not None:
+                seg_kwargs['position_ids'] = position_ids
         return seg_kwargs
     
-    def pad_attention_mask(self, attention_mask, shape):
-        if self.num_mem_tokens in {0, None}:
+    def pad_attention_mask(self, attention_mask, shape, prev_attn_mask=None):
+        # mask of previous segment tokens (sliding window), memory and segment tokens in a single allocation
+        if self.num_mem_tokens in {0, None} and prev_attn_mask is None:
             return attention_mask
-        else:
-            mask = torch.ones(*shape[:2], dtype=torch.int64).to(attention_mask.device)
-            mask[:, :-self.num_mem_tokens] = attention_mask
-            return mask
+        prev_len = prev_attn_mask.size(1) if prev_attn_mask is not None else 0
+        num_mem_tokens = self.num_mem_tokens or 0
+        mask = torch.ones(shape[0], prev_len + shape[1], dtype=torch.int64, device=attention_mask.device)
+        if prev_attn_mask is not None:
+            mask[:, :prev_len] = prev_attn_mask
+        mask[:, prev_len:prev_len + shape[1] - num_mem_tokens] = attention_mask
+        return mask
     
     def process_output(self, model_outputs, labels, labels_mask, **kwargs):
         if self.num_mem_tokens not in {0, None}:
             out = CausalLMOutputWithCrossAttentions()
-            out['logits'] = model_outputs.logits[:, :-self.num_mem_tokens]
+            if model_outputs.get('logits') is not None:
+                out['logits'] = model_outputs.logits[:, :-self.num_mem_tokens]
+            else:
+                out['last_hidden_state'] = model_outputs.last_hidden_state[:, :-self.num_mem_tokens]
             if kwargs.get('output_hidden_states'):
                 out['hidden_states'] = [lh[:, :-self.num_mem_tokens] for lh in model_outputs.hidden_states]
             if kwargs.get('output_attentions'):
@@ -258,7 +544,7 @@ class AssociativeMemoryCell(torch.nn.Module):
         else:
             out = model_outputs
 
-        if labels is not None:
+        if labels is not None and out.get('logits') is not None:
             ce_loss_fn = CrossEntropyLoss()
             logits = out['logits'][..., :-1, :].contiguous()
             flat_logits = logits.view(-1, logits.size(-1))
@@ -282,14 +568,22 @@ class AssociativeMemoryCell(torch.nn.Module):
             self.zero_mem()
         
         
+        # memory tokens are not used for generation: prompt is embedded directly and memory is not written.
+        # With KV cache the prompt is processed once and every decoding step passes only the new token
+        # through the layers, so each wrapped layer associates only the new token's hidden state.
+        generate_kwargs.setdefault('use_cache', True)
+        inputs_embeds = self.model.get_input_embeddings()(input_ids)
+        attention_mask = attention_mask.to(torch.int64)
+
         self.generate_mode(True)
-        seg_kwargs = self.process_input(input_ids, attention_mask=attention_mask)
-        out = self.model.generate(
-            inputs_embeds=seg_kwargs['inputs_embeds'][:, :-self.num_mem_tokens], 
-            attention_mask=seg_kwargs['attention_mask'][:, :-self.num_mem_tokens], 
-            **generate_kwargs
-        )
-        self.generate_mode(False)
+        try:
+            out = self.model.generate(
+                inputs_embeds=inputs_embeds,
+                attention_mask=attention_mask,
+                **generate_kwargs
+            )
+        finally:
+            self.generate_mode(False)
         return out
     
 
@@ -299,6 +593,9 @@ class AssociativeRecurrentWrapper(torch.nn.Module):
         
         self.memory_cell = memory_cell
         self.rmt_config = rmt_kwargs
+        self.offloader = ActivationOffloader() if rmt_kwargs.get('offload_activations') else None
+        self.kv_cache = None
+        self.compiled_step = None
 
     def forward(self, 
                 input_ids, 
@@ -320,35 +617,53 @@ class AssociativeRecurrentWrapper(torch.nn.Module):
                 labels=labels[:, i] if not (labels is None) else None, 
                 labels_mask=labels_mask[:, i] if not (labels_mask is None) else None, 
             ) for i in range(n_segs)]
-            labels = torch.cat([labels[:, i] for i in range(n_segs)], dim=1)
+            # (batch, n_segs, seg_len) -> (batch, n_segs * seg_len), a view for contiguous inputs
+            labels = labels.flatten(1, 2)
             if labels_mask is not None:
-                labels_mask = torch.cat([labels_mask[:, i] for i in range(n_segs)], dim=1)
+                labels_mask = labels_mask.flatten(1, 2)
         else:
             segmented = self.segment(input_ids=input_ids, inputs_embeds=inputs_embeds, attention_mask=attention_mask, labels=labels, labels_mask=labels_mask)
+        if self.offloader is not None:
+            self.offloader.reset(self.parameters())
+        ragged = self.rmt_config.get('ragged', False) and attention_mask is not None
+        cell_hidden_states = bool(output_hidden_states) and self.rmt_config.get('output_policy', 'full') != 'loss'
+        # masked_lm_head: cells skip LM head, it is applied in compute_loss only where loss needs logits
+        lm_head = not self.rmt_config.get('masked_lm_head', False)
+        if ragged and sliding_window:
+            raise ValueError('ragged segments are not supported with sliding window')
+        compiled = self.rmt_config.get('compile_segment_step', False)
+        if compiled and (ragged or sliding_window or input_segmented):
+            raise ValueError('compile_segment_step is not supported with ragged segments, sliding window '
+                             'and pre-segmented inputs')
         cell_outputs = []
-        past_key_values = None
+        kv_cache = self.get_kv_cache() if sliding_window else None
         num_mem_tokens = self.memory_cell.num_mem_tokens
-        prev_attn_mask = None
         self.memory_cell.zero_mem()
         for seg_num, segment in enumerate(segmented):
             seg_len = segment['input_ids'].size(-1)
-            cell_out = self.memory_cell(**segment,  
-                                        output_hidden_states=True, 
-                                        use_cache=sliding_window, 
-                                        past_key_values=past_key_values,
-                                        prev_attn_mask=prev_attn_mask,
-                                        zero_mem=False
-            )
+            if ragged:
+                cell_out = self.run_segment(self.ragged_step, segment, cell_hidden_states, lm_head)
+            elif compiled:
+                cell_out = self.run_segment(self.static_step, segment, seg_num, lm_head, cell_hidden_states,
+                                            bool(output_attentions))
+            else:
+                cell_out = self.run_segment(self.memory_cell,
+                                            **segment,  
+                                            output_hidden_states=cell_hidden_states, 
+                                            lm_head=lm_head,
+                                            use_cache=sliding_window, 
+                                            past_key_values=kv_cache.past_key_values if sliding_window else None,
+                                            prev_attn_mask=kv_cache.prev_attn_mask if sliding_window else None,
+                                            zero_mem=False
+                )
             if sliding_window:
-                prev_attn_mask = segment['attention_mask']
-                past_key_values = [
-                    [
-                        k_or_v[..., -(num_mem_tokens+seg_len):k_or_v.size(-2)-num_mem_tokens, :].detach() 
-                        for k_or_v in seg_kv
-                    ] 
-                    for seg_kv in cell_out['past_key_values']
-                ]
+                kv_len = cell_out['past_key_values'][0][0].size(-2)
+                kv_cache.update(cell_out['past_key_values'], segment.get('attention_mask'),
+                                kv_len - num_mem_tokens - seg_len, kv_len - num_mem_tokens)
+                # full K/V of the segment are not kept in outputs
+                cell_out['past_key_values'] = None
             cell_outputs.append(cell_out)
+            self.manage_gradients(seg_num, len(segmented))
         self.memory_cell.zero_mem()
 
 
@@ -358,85 +673,168 @@ class AssociativeRecurrentWrapper(torch.nn.Module):
                                    output_hidden_states=output_hidden_states)
         return out
 
+    def get_kv_cache(self):
+        # buffers of sliding window are kept between calls, segment checkpointing needs a copy for every segment
+        inplace = not self.rmt_config.get('segment_checkpointing', False)
+        if self.kv_cache is None or self.kv_cache.inplace != inplace:
+            self.kv_cache = SlidingWindowCache(self.rmt_config.get('segment_size'), inplace=inplace)
+        self.kv_cache.reset()
+        return self.kv_cache
+
+    def run_segment(self, fn, *args, **kwargs):
+        # with offload_activations tensors saved for backward by older segments are moved to host memory
+        with self.offloader.segment() if self.offloader is not None else nullcontext():
+            return self.checkpoint_segment(fn, *args, **kwargs)
+
+    def checkpoint_segment(self, fn, *args, **kwargs):
+        # with segment_checkpointing only inputs of each segment (incl. memory state) are kept for backward,
+        # segment activations are recomputed during backward
+        if not (self.rmt_config.get('segment_checkpointing') and torch.is_grad_enabled()):
+            return fn(*args, **kwargs)
+
+        def step(memory_state, *args, **kwargs):
+            # W_mem/z live in the cell and change with every segment, so they are passed explicitly:
+            # recomputation in backward starts from memory of this segment, not from the current one
+            self.memory_cell.set_memory_state(memory_state)
+            out = fn(*args, **kwargs)
+            return out, self.memory_cell.get_memory_state()
+
+        out, memory_state = checkpoint(step, self.memory_cell.get_memory_state(), *args, use_reentrant=False, **kwargs)
+        self.memory_cell.set_memory_state(memory_state)
+        return out
+
+    def static_step(self, segment, seg_num, lm_head=True, output_hidden_states=False, output_attentions=False):
+        # compiled cell step with memory state as explicit input and output. The first segment (empty memory,
+        # first_seg branches of layers) runs eagerly, all others share one graph per (batch size, segment length)
+        # and output flags
+        if self.compiled_step is None:
+            self.compiled_step = torch.compile(self.memory_cell.segment_step, dynamic=False)
+        step = self.memory_cell.segment_step if seg_num == 0 else self.compiled_step
+        out, memory_state = step(self.memory_cell.get_memory_state(), segment['input_ids'],
+                                 segment.get('attention_mask'), lm_head, output_hidden_states, output_attentions)
+        self.memory_cell.set_memory_state(memory_state)
+        return out
+
+    def ragged_step(self, segment, output_hidden_states=True, lm_head=True):
+        # runs memory cell only on samples with real tokens in the segment, other samples keep their memory
+        # and get zero outputs, so padding segments of short samples are not computed
+        batch_size = segment['attention_mask'].shape[0]
+        active = segment['attention_mask'].any(dim=1)
+        if active.all() or not active.any():
+            return self.memory_cell(**segment, output_hidden_states=output_hidden_states, lm_head=lm_head,
+                                    zero_mem=False)
+
+        active_idx = active.nonzero(as_tuple=True)[0]
+        active_segment = {k: v[active_idx] for k, v in segment.items() if v is not None}
+        memory_state = self.memory_cell.get_memory_state()
+        self.memory_cell.set_memory_state(self.memory_cell.select_memory_state(memory_state, active_idx))
+        cell_out = self.memory_cell(**active_segment, output_hidden_states=output_hidden_states, lm_head=lm_head,
+                                    zero_mem=False)
+        self.memory_cell.set_memory_state(self.memory_cell.scatter_memory_state(
+            memory_state, self.memory_cell.get_memory_state(), active_idx, batch_size))
+        return self.scatter_output(cell_out, active_idx, batch_size)
+
+    def scatter_output(self, cell_out, active_idx, batch_size):
+        # puts outputs of active samples back to their places in the batch
+        def scatter(tensor):
+            return tensor.new_zeros(batch_size, *tensor.shape[1:]).index_copy(0, active_idx, tensor)
+
+        out = CausalLMOutputWithCrossAttentions()
+        for key, value in cell_out.items():
+            if key in {'logits', 'last_hidden_state'}:
+                out[key] = scatter(value)
+            elif key == 'hidden_states':
+                out[key] = [scatter(lh) for lh in value]
+            else:
+                out[key] = value
+        return out
+
     def segment(self, **kwargs):
-        segments = []
-        for k, tensor in kwargs.items():
-            if tensor is not None:
-                k_segments = self.split_tensor(tensor)
-                for s, k_seg in enumerate(k_segments):
-                    if s < len(segments):
-                        segments[s][k] = k_seg
-                    else:
-                        segments.append({k: k_seg})
-
-        return segments
-    
+        return segment(self.rmt_config.get('segment_size'), self.rmt_config.get('segment_alignment'), **kwargs)
+
     def split_tensor(self, tensor):
-        align = self.rmt_config.get('segment_alignment')
-        segment_size = self.rmt_config.get('segment_size')
-        if align in {'left', None}:
-            split_inds = list(range(0, tensor.shape[1], segment_size)) + [tensor.shape[1]]
-            segments = [tensor[:, start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-        elif align in {'right', None}:
-            split_inds = (list(range(tensor.shape[1], 0, -segment_size)) + [0])[::-1]
-            segments = [tensor[:, start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-        elif align == 'center':
-            n_seg = math.ceil(tensor.shape[1] / segment_size)
-            segments = torch.chunk(tensor, n_seg, dim=1)
-        else:
-            raise NotImplementedError
-        return segments
+        return split_tensor(tensor, self.rmt_config.get('segment_size'), self.rmt_config.get('segment_alignment'))
 
     def process_outputs(self, cell_outputs, **kwargs):
+        # output_policy: 'full' - logits (and hidden states) of the whole input and of every segment,
+        # 'last_segment' - of the last segment only, 'loss' - only loss
+        output_policy = self.rmt_config.get('output_policy', 'full')
+        if output_policy not in {'full', 'last_segment', 'loss'}:
+            raise ValueError(f'Unknown output_policy {output_policy}')
         out = CausalLMOutputWithCrossAttentions()
-        full_logits = torch.cat([o.logits for o in cell_outputs], dim=1)
-        full_hidden_states = tuple([torch.cat(layer_hs, dim=1) for layer_hs in zip(*[o.hidden_states for o in cell_outputs])])
 
         labels = kwargs.get('labels')
         if labels is not None:
-            shift_labels = labels[..., 1:].contiguous()
-            shift_logits = full_logits[..., :-1, :].contiguous()
-            flat_labels = shift_labels.view(-1)
-            flat_logits = shift_logits.view(-1, shift_logits.size(-1))
-            
-            loss_fct = CrossEntropyLoss()
-            labels_mask = kwargs.get('labels_mask')
-            if labels_mask is not None:
-                shift_mask = labels_mask[..., :-1].contiguous()
-
-                flat_labels = flat_labels[shift_mask.view(-1)]
-                flat_logits = flat_logits[shift_mask.view(-1)]
-                
-            out['loss'] = loss_fct(flat_logits, flat_labels)
+            out['loss'] = self.compute_loss(cell_outputs, labels, kwargs.get('labels_mask'))
         else:
-            out['loss'] = 0 
+            out['loss'] = 0
 
         out['ce_loss'] = out['loss']
-        
-        out['logits'] = full_logits
+        # with masked_lm_head full logits are never computed
+        if output_policy == 'loss' or self.rmt_config.get('masked_lm_head', False):
+            return out
+        if output_policy == 'last_segment':
+            out['logits'] = cell_outputs[-1].logits
+            if kwargs.get('output_hidden_states'):
+                out['hidden_states'] = cell_outputs[-1].hidden_states
+            return out
+
+        out['logits'] = torch.cat([o.logits for o in cell_outputs], dim=1)
         segment_keys = ['loss', 'logits']
         if kwargs.get('output_attentions'):
             segment_keys.append('attentions')
         if kwargs.get('output_hidden_states'):
             segment_keys.append('hidden_states')
-            out['hidden_states'] = full_hidden_states
+            out['hidden_states'] = tuple([torch.cat(layer_hs, dim=1)
+                                          for layer_hs in zip(*[o.hidden_states for o in cell_outputs])])
 
         for seg_num, o in enumerate(cell_outputs):
             for key, value in o.items():
                 if any([sk in key for sk in segment_keys]):
                     out[f'{key}_{seg_num}'] = value
 
-        return out 
-        
-    def manage_gradients(self, memory_state, seg_num):
-        k2, max_n_segments = self.rmt_config.get('k2'), self.rmt_config.get('max_n_segments')
-        if seg_num == 0 \
-            or k2 in {-1, None} \
-            or seg_num + k2 > max_n_segments:
-                return True
+        return out
+
+    def compute_loss(self, cell_outputs, labels, labels_mask=None):
+        # mean CE over the whole input computed segment by segment, without concatenation of logits:
+        # logits at position t predict labels[t + 1], labels_mask[t] selects this pair
+        # with masked_lm_head cells return last_hidden_state: LM head is applied only to positions selected
+        # by labels_mask, or, if all positions are labeled, by vocabulary chunks
+        loss_fct = CrossEntropyLoss(reduction='sum')
+        lm_head = self.memory_cell.model.get_output_embeddings()
+        loss, n_tokens = 0, 0
+        start = 0
+        for o in cell_outputs:
+            has_logits = o.get('logits') is not None
+            outputs = o.logits if has_logits else o.last_hidden_state
+            end = min(start + outputs.size(1), labels.size(1) - 1)
+            if end <= start:
+                break
+            outputs = outputs[:, :end - start]
+            flat_outputs = outputs.reshape(-1, outputs.size(-1))
+            flat_labels = labels[:, start + 1:end + 1].reshape(-1)
+            if labels_mask is not None:
+                flat_mask = labels_mask[:, start:end].reshape(-1)
+                flat_outputs = flat_outputs[flat_mask]
+                flat_labels = flat_labels[flat_mask]
+            if has_logits:
+                loss = loss + loss_fct(flat_outputs, flat_labels)
+            elif labels_mask is not None:
+                loss = loss + loss_fct(lm_head(flat_outputs), flat_labels)
+            else:
+                seg_loss, _ = chunked_cross_entropy(flat_outputs, lm_head.weight, flat_labels, lm_head.bias,
+                                                    ignore_index=loss_fct.ignore_index)
+                loss = loss + seg_loss
+            n_tokens += (flat_labels != loss_fct.ignore_index).sum()
+            start = end
+        return loss / n_tokens 
         
-        memory_state = memory_state.detach()
-        return False
+    def manage_gradients(self, seg_num, n_segments):
+        # truncated BPTT: backward goes through associative memory of the last k2 segments only
+        k2 = self.rmt_config.get('k2')
+        if k2 in {-1, None} or seg_num + k2 >= n_segments:
+            return
+        self.memory_cell.detach_mem()
     
     def generate(self, input_ids, attention_mask, **generate_kwargs):
         self.memory_cell.zero_mem()
@@ -448,4 +846,116 @@ class AssociativeRecurrentWrapper(torch.nn.Module):
         final_segment = segmented[-1]
         out = self.memory_cell.generate(**final_segment, zero_mem=False, **generate_kwargs)
         self.memory_cell.zero_mem()
+        return out
+
+    def session(self, sliding_window=False):
+        return MemorySession(self, sliding_window=sliding_window)
+
+    def generate_forked(self, input_ids, attention_mask, questions_input_ids, questions_attention_mask=None,
+                        **generate_kwargs):
+        # context is processed once, its memory is copied to len(questions_input_ids) // len(input_ids)
+        # questions per context, questions of the same context go one after another
+        session = self.session()
+        session.feed(input_ids, attention_mask)
+        return session.generate(questions_input_ids, questions_attention_mask, **generate_kwargs)
+
+
+class MemorySession:
+    """Inference over a stream of tokens that keeps associative memory between calls.
+
+    feed() runs only new complete segments through the memory cell and buffers an incomplete tail,
+    generate() answers from the current memory, the tail is prepended to the generation prompt.
+    Memory of the session is stored in the session and loaded into the cell on every call, so a cell
+    can be shared by several sessions. Segments of feed() and generate() are always left-aligned,
+    segment_alignment of the wrapper is not used.
+    With sliding_window feed() also keeps K/V of the previous segment. generate() does not attend to them
+    (as generate of the wrapper), so it is not supported for such sessions.
+    """
+    def __init__(self, recurrent_wrapper, sliding_window=False):
+        self.wrapper = recurrent_wrapper
+        self.memory_cell = recurrent_wrapper.memory_cell
+        self.segment_size = recurrent_wrapper.rmt_config['segment_size']
+        self.sliding_window = sliding_window
+        self.reset()
+
+    def reset(self):
+        self.memory_cell.zero_mem()
+        self.memory_state = self.memory_cell.get_memory_state()
+        self.kv_cache = SlidingWindowCache(self.segment_size)
+        self.tail_input_ids = None
+        self.tail_attention_mask = None
+        self.batch_size = None
+        self.n_segments = 0
+
+    def get_n_forks(self, batch_size):
+        if self.batch_size is None or self.batch_size == batch_size:
+            return 1
+        if batch_size % self.batch_size != 0:
+            raise ValueError(f'Batch size {batch_size} is not a multiple of session batch size {self.batch_size}')
+        return batch_size // self.batch_size
+
+    def with_tail(self, input_ids, attention_mask=None, n_forks=1):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if self.tail_input_ids is not None:
+            tail_input_ids = self.tail_input_ids.repeat_interleave(n_forks, dim=0)
+            tail_attention_mask = self.tail_attention_mask.repeat_interleave(n_forks, dim=0)
+            input_ids = torch.cat([tail_input_ids, input_ids], dim=1)
+            attention_mask = torch.cat([tail_attention_mask.to(attention_mask.dtype), attention_mask], dim=1)
+        return input_ids, attention_mask
+
+    def split(self, input_ids, attention_mask):
+        # left-aligned segments of segment_size for both feed() and generate(), the last one can be shorter
+        return [dict(input_ids=input_ids[:, i:i + self.segment_size],
+                     attention_mask=attention_mask[:, i:i + self.segment_size])
+                for i in range(0, input_ids.size(1), self.segment_size)]
+
+    @torch.no_grad()
+    def feed(self, input_ids, attention_mask=None):
+        if self.batch_size is not None and self.batch_size != input_ids.size(0):
+            raise ValueError(f'Session batch size is {self.batch_size}, got input of size {input_ids.size(0)}')
+        self.batch_size = input_ids.size(0)
+        input_ids, attention_mask = self.with_tail(input_ids, attention_mask)
+        num_mem_tokens = self.memory_cell.num_mem_tokens
+
+        self.memory_cell.set_memory_state(self.memory_state)
+        n_full_segments = input_ids.size(1) // self.segment_size
+        tail_start = n_full_segments * self.segment_size
+        for segment in self.split(input_ids[:, :tail_start], attention_mask[:, :tail_start]):
+            cell_out = self.memory_cell(**segment,
+                                        output_hidden_states=True,
+                                        use_cache=self.sliding_window,
+                                        past_key_values=self.kv_cache.past_key_values,
+                                        prev_attn_mask=self.kv_cache.prev_attn_mask,
+                                        zero_mem=False)
+            if self.sliding_window:
+                kv_len = cell_out['past_key_values'][0][0].size(-2)
+                self.kv_cache.update(cell_out['past_key_values'], segment['attention_mask'],
+                                     kv_len - num_mem_tokens - self.segment_size, kv_len - num_mem_tokens)
+            self.n_segments += 1
+        self.memory_state = self.memory_cell.get_memory_state()
+
+        if tail_start < input_ids.size(1):
+            self.tail_input_ids = input_ids[:, tail_start:]
+            self.tail_attention_mask = attention_mask[:, tail_start:]
+        else:
+            self.tail_input_ids = self.tail_attention_mask = None
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask=None, **generate_kwargs):
+        if self.sliding_window:
+            raise ValueError('generate is not supported for sessions with sliding_window: queries would be answered '
+                             'without K/V of the previous segment')
+        # session memory is not updated by the prompt, so several queries can be asked over the same stream
+        # batch of queries larger than the session batch gets a copy of memory for each query
+        n_forks = self.get_n_forks(input_ids.size(0))
+        input_ids, attention_mask = self.with_tail(input_ids, attention_mask, n_forks)
+        segmented = self.split(input_ids, attention_mask)
+
+        self.memory_cell.set_memory_state(self.memory_cell.fork_memory_state(self.memory_state, n_forks))
+        for segment in segmented[:-1]:
+            self.memory_cell(**segment, output_hidden_states=True, zero_mem=False)
+
+        out = self.memory_cell.generate(**segmented[-1], zero_mem=False, **generate_kwargs)
+        self.memory_cell.set_memory_state(self.memory_state)
         return out
\ No newline at end of file
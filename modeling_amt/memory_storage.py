@@ -0,0 +1,176 @@
+import torch
+import torch.nn.functional as F
+
+# storage modes of associative memory matrix W_mem of shape (*batch_dims, d_key, d_model)
+# all storages implement:
+#   read(x, index=None) -> x @ W_mem (or x @ W_mem[index] for stacked memory)
+#   add(keys, values)   -> W_mem += keys^T @ values
+#   zero(), get_state(), set_state(state)
+# empty memory is kept in non-persistent buffers: they follow model.to(device/dtype), are allocated once and
+# never modified, so zero() does not allocate or copy anything. Updates are out-of-place, tensors of previous
+# states may be saved for backward or held by sessions and snapshot caches.
+MEMORY_STORAGES = {}
+
+
+def register_memory_storage(name):
+    def register(cls):
+        MEMORY_STORAGES[name] = cls
+        return cls
+    return register
+
+
+def get_memory_storage(name, shape, **kwargs):
+    if name not in MEMORY_STORAGES:
+        raise ValueError(f'Unknown memory storage {name}, available: {list(MEMORY_STORAGES)}')
+    return MEMORY_STORAGES[name](shape, **kwargs)
+
+
+@register_memory_storage('dense')
+class DenseMemory(torch.nn.Module):
+    def __init__(self, shape):
+        super().__init__()
+        self.shape = tuple(shape)
+        self.register_buffer('W_mem_zero', torch.zeros(self.shape), persistent=False)
+        self.zero()
+
+    def zero(self):
+        self.W_mem = self.W_mem_zero
+
+    def read(self, x, index=None):
+        W_mem = self.W_mem if index is None else self.W_mem[index]
+        return x @ W_mem
+
+    def add(self, keys, values):
+        self.W_mem = self.W_mem + keys.transpose(-1, -2) @ values
+
+    def get_state(self):
+        return dict(W_mem=self.W_mem)
+
+    def set_state(self, state):
+        self.W_mem = state['W_mem'].to(self.W_mem_zero.device)
+
+
+@register_memory_storage('mixed')
+class MixedPrecisionMemory(DenseMemory):
+    """fp32 accumulator, reads use a bf16/fp16 copy of it."""
+    def __init__(self, shape, read_dtype='bfloat16'):
+        torch.nn.Module.__init__(self)
+        self.shape = tuple(shape)
+        self.read_dtype = getattr(torch, read_dtype) if isinstance(read_dtype, str) else read_dtype
+        self.register_buffer('W_mem_zero', torch.zeros(self.shape), persistent=False)
+        self.register_buffer('W_read_zero', torch.zeros(self.shape, dtype=self.read_dtype), persistent=False)
+        self.zero()
+
+    def _apply(self, fn, *args, **kwargs):
+        # model.to(dtype) changes only the device of empty memory: accumulator stays fp32, read copy in read_dtype
+        super()._apply(fn, *args, **kwargs)
+        self.W_mem_zero = self.W_mem_zero.float()
+        self.W_read_zero = self.W_read_zero.to(self.read_dtype)
+        return self
+
+    def zero(self):
+        self.W_mem = self.W_mem_zero
+        self.W_read = self.W_read_zero
+
+    def read(self, x, index=None):
+        W_read = self.W_read if index is None else self.W_read[index]
+        return (x.to(self.read_dtype) @ W_read).to(x.dtype)
+
+    def add(self, keys, values):
+        self.W_mem = self.W_mem + (keys.transpose(-1, -2) @ values).float()
+        self.W_read = self.W_mem.to(self.read_dtype)
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.W_read = self.W_mem.to(self.read_dtype)
+
+
+@register_memory_storage('low_rank')
+class LowRankMemory(torch.nn.Module):
+    """W_mem = U @ V with U: (..., d_key, rank), V: (..., rank, d_model).
+
+    Every update appends new associations to the factors and truncates them back to `rank` with QR + SVD of
+    a small (rank + n_new, rank + n_new) matrix. Gradients through truncated SVD are not stable when singular
+    values coincide (e.g., with empty memory), so this mode is meant for evaluation.
+    """
+    def __init__(self, shape, rank=16):
+        super().__init__()
+        self.shape = tuple(shape)
+        self.rank = rank
+        *batch_dims, d_key, d_model = self.shape
+        self.register_buffer('W_mem_u_zero', torch.zeros(*batch_dims, d_key, rank), persistent=False)
+        self.register_buffer('W_mem_v_zero', torch.zeros(*batch_dims, rank, d_model), persistent=False)
+        self.zero()
+
+    def zero(self):
+        self.W_mem_u = self.W_mem_u_zero
+        self.W_mem_v = self.W_mem_v_zero
+
+    def read(self, x, index=None):
+        u, v = self.W_mem_u, self.W_mem_v
+        if index is not None:
+            u, v = u[index], v[index]
+        return (x @ u.to(x.dtype)) @ v.to(x.dtype)
+
+    def add(self, keys, values):
+        batch_shape = torch.broadcast_shapes(self.W_mem_u.shape[:-2], keys.shape[:-2])
+        u = torch.cat([self.W_mem_u.expand(*batch_shape, *self.W_mem_u.shape[-2:]).float(),
+                       keys.transpose(-1, -2).float()], dim=-1)
+        v = torch.cat([self.W_mem_v.expand(*batch_shape, *self.W_mem_v.shape[-2:]).float(),
+                       values.float()], dim=-2)
+
+        q_u, r_u = torch.linalg.qr(u)
+        q_v, r_v = torch.linalg.qr(v.transpose(-1, -2))
+        u_s, s, vh_s = torch.linalg.svd(r_u @ r_v.transpose(-1, -2), full_matrices=False)
+
+        rank = min(self.rank, s.shape[-1])
+        W_mem_u = (q_u @ u_s[..., :rank]) * s[..., None, :rank]
+        W_mem_v = vh_s[..., :rank, :] @ q_v.transpose(-1, -2)
+        if rank < self.rank:
+            W_mem_u = F.pad(W_mem_u, (0, self.rank - rank))
+            W_mem_v = F.pad(W_mem_v, (0, 0, 0, self.rank - rank))
+        self.W_mem_u = W_mem_u.to(self.W_mem_u_zero.dtype)
+        self.W_mem_v = W_mem_v.to(self.W_mem_v_zero.dtype)
+
+    def get_state(self):
+        return dict(W_mem_u=self.W_mem_u, W_mem_v=self.W_mem_v)
+
+    def set_state(self, state):
+        self.W_mem_u = state['W_mem_u'].to(self.W_mem_u_zero.device)
+        self.W_mem_v = state['W_mem_v'].to(self.W_mem_v_zero.device)
+
+
+@register_memory_storage('int8')
+class Int8Memory(torch.nn.Module):
+    """int8 W_mem with per-row (d_key) scales. Updates are not differentiable, inference only."""
+    def __init__(self, shape):
+        super().__init__()
+        self.shape = tuple(shape)
+        self.register_buffer('W_mem_q_zero', torch.zeros(self.shape, dtype=torch.int8), persistent=False)
+        self.register_buffer('W_mem_scale_init', torch.ones(*self.shape[:-1], 1), persistent=False)
+        self.zero()
+
+    def zero(self):
+        self.W_mem_q = self.W_mem_q_zero
+        self.W_mem_scale = self.W_mem_scale_init
+
+    def read(self, x, index=None):
+        q, scale = self.W_mem_q, self.W_mem_scale
+        if index is not None:
+            q, scale = q[index], scale[index]
+        # x @ (scale * q) == (x * scale^T) @ q, full precision matrix is not materialized
+        return (x * scale[..., 0].unsqueeze(-2).to(x.dtype)) @ q.to(x.dtype)
+
+    @torch.no_grad()
+    def add(self, keys, values):
+        W_mem = self.W_mem_q.to(self.W_mem_scale.dtype) * self.W_mem_scale
+        W_mem = W_mem + (keys.transpose(-1, -2) @ values).to(W_mem.dtype)
+        self.W_mem_scale = W_mem.abs().amax(dim=-1, keepdim=True).clamp_min(1e-8) / 127
+        self.W_mem_q = torch.round(W_mem / self.W_mem_scale).clamp(-127, 127).to(torch.int8)
+
+    def get_state(self):
+        return dict(W_mem_q=self.W_mem_q, W_mem_scale=self.W_mem_scale)
+
+    def set_state(self, state):
+        self.W_mem_q = state['W_mem_q'].to(self.W_mem_q_zero.device)
+        self.W_mem_scale = state['W_mem_scale'].to(self.W_mem_scale_init.device)
@@ -0,0 +1,104 @@
+import torch
+
+# backbone adapters describe, per architecture (config.model_type), where layers and their causal masks live
+# and which positions memory tokens get. Memory cells lay out segment inputs as
+# [read memory (n_read tokens), segment tokens, write memory (n_write tokens)], all adapters implement:
+#   layers_attr                                 - attribute of model, which contains layers
+#   wrap_positional_embeddings(n_read, n_write) - makes room for memory positions, returns size of the causal
+#                                                 mask shared by layers or None if masks are left as is
+#   attention_modules()                         - modules which keep causal mask in their `bias` attribute
+#   position_ids(seg_len, n_read, n_write, device, past_length=0) - position_ids for model or None
+BACKBONE_ADAPTERS = {}
+
+
+def register_backbone_adapter(*model_types):
+    def register(cls):
+        for model_type in model_types:
+            BACKBONE_ADAPTERS[model_type] = cls
+        return cls
+    return register
+
+
+def get_backbone_adapter(model):
+    model_type = getattr(model.config, 'model_type', None)
+    return BACKBONE_ADAPTERS.get(model_type, BackboneAdapter)(model)
+
+
+class BackboneAdapter:
+    """Backbones with unknown layout: layers_attr has to be set explicitly, positions can not be wrapped."""
+    layers_attr = None
+
+    def __init__(self, model):
+        self.model = model
+
+    def get_layers(self, layers_attr=None):
+        layers_attr = layers_attr or self.layers_attr
+        if layers_attr is None:
+            raise ValueError(f'layers_attr is not known for {type(self.model).__name__}, set it explicitly')
+        layers = self.model
+        for attr in layers_attr.split('.'):
+            layers = getattr(layers, attr)
+        return layers
+
+    def wrap_positional_embeddings(self, n_read, n_write):
+        raise NotImplementedError(f'Positions of memory tokens are not defined for {type(self.model).__name__}, '
+                                  'use wrap_pos=False or register a backbone adapter')
+
+    def attention_modules(self):
+        return []
+
+    def position_ids(self, seg_len, n_read, n_write, device, past_length=0):
+        return None
+
+
+@register_backbone_adapter('gpt2')
+class GPT2Adapter(BackboneAdapter):
+    """Learned absolute positions: read memory and segment use positions 0..n_read + seg_len - 1 (pretrained
+    positions are shifted by n_read), write memory gets n_write new positions after the pretrained ones, so
+    they do not depend on segment length.
+    """
+    layers_attr = 'transformer.h'
+
+    def wrap_positional_embeddings(self, n_read, n_write):
+        num_pos_embs, emb_dim = self.model.transformer.wpe.weight.shape
+        self.num_pos_embs = num_pos_embs
+        prev_embs = self.model.transformer.wpe.weight.detach()
+        self.model.transformer.wpe = torch.nn.Embedding(num_pos_embs + n_read + n_write, emb_dim)
+        with torch.no_grad():
+            self.model.transformer.wpe.weight[n_read:n_read + num_pos_embs] = prev_embs
+        # keys of sliding window attention also include the previous segment
+        return 2 * num_pos_embs + n_read + n_write
+
+    def attention_modules(self):
+        return [getattr(layer, 'layer', layer).attn for layer in self.model.transformer.h]
+
+    def position_ids(self, seg_len, n_read, n_write, device, past_length=0):
+        read_ordinary_pos = torch.arange(0, n_read + seg_len, dtype=torch.long, device=device)
+        write_pos = torch.arange(n_read + self.num_pos_embs, n_read + self.num_pos_embs + n_write,
+                                 dtype=torch.long, device=device)
+        return torch.cat([read_ordinary_pos, write_pos]).unsqueeze(0)
+
+
+@register_backbone_adapter('gpt_neox')
+class GPTNeoXAdapter(BackboneAdapter):
+    """Rotary positions: attention depends only on distances, so memory tokens keep their places in the input
+    and no new positions are added. Positions continue after keys of the previous segment (sliding window).
+    Causal masks are left to layers, GPTNeoXAttention grows them itself with _init_bias.
+    """
+    layers_attr = 'gpt_neox.layers'
+
+    def wrap_positional_embeddings(self, n_read, n_write):
+        return None
+
+    def position_ids(self, seg_len, n_read, n_write, device, past_length=0):
+        return torch.arange(past_length, past_length + n_read + seg_len + n_write,
+                            dtype=torch.long, device=device).unsqueeze(0)
+
+
+@register_backbone_adapter('mamba')
+class MambaAdapter(BackboneAdapter):
+    """No positions and no attention masks."""
+    layers_attr = 'backbone.layers'
+
+    def wrap_positional_embeddings(self, n_read, n_write):
+        return None
@@ -50,6 +50,99 @@ class RMTBaseModel(torch.nn.Module):
        raise NotImplementedError
 
     def pad_and_segment(self, input_ids):
+        if not self.has_segment_layout():
+            return self.pad_and_segment_loop(input_ids)
+        return self.segment_batch(input_ids)[0]['inputs']
+
+    def has_segment_layout(self):
+        # batched segmentation is used only if segment_layout describes the same layout as pad_add_special_tokens
+        owner = lambda attr: next(c for c in type(self).__mro__ if attr in c.__dict__)
+        return issubclass(owner('segment_layout'), owner('pad_add_special_tokens'))
+
+    def segment_layout(self, add_to='inputs'):
+        # (prefix, suffix, pad_value) around segment content, the same as in pad_add_special_tokens
+        raise NotImplementedError
+
+    def segment_batch(self, input_ids, drop_token_ids=None, **aligned):
+        """Segments the whole batch at once.
+
+        Tokens from drop_token_ids (special tokens by default) are dropped, content is truncated to max_n_segments
+        segments, split according to segment_alignment and laid out as prefix + content + suffix + padding
+        (segment_layout). Samples with fewer segments get empty segments (all padding) first.
+        Returns dict of (n_segments, batch, input_size, ...) tensors for 'inputs' and every tensor in aligned
+        (labels, labels_mask, ... with the same token positions as input_ids) and (n_segments, batch) mask of
+        non-empty segments.
+        """
+        max_n_segments, input_size = self.rmt_config['max_n_segments'], self.rmt_config['input_size']
+        batch_size, seq_len = input_ids.shape
+        device = input_ids.device
+
+        if drop_token_ids is None:
+            drop_token_ids = self.special_token_ids
+        drop_token_ids = torch.tensor([t for t in drop_token_ids if t is not None], device=device)
+        content_mask = ~torch.isin(input_ids, drop_token_ids)
+        # indices of content tokens first, stable sort keeps their order
+        order = torch.sort((~content_mask).to(torch.uint8), dim=1, stable=True).indices
+        lengths = content_mask.sum(dim=1).clamp(max=self.segment_size * max_n_segments)
+
+        align = self.rmt_config.get('segment_alignment')
+        if align == 'center':
+            n_seg = torch.div(lengths + self.segment_size - 1, self.segment_size, rounding_mode='floor')
+            chunk_size = torch.div(lengths + n_seg - 1, n_seg.clamp(min=1), rounding_mode='floor').clamp(min=1)
+        elif align in {'right', 'left', None}:
+            chunk_size = torch.full_like(lengths, self.segment_size)
+        else:
+            raise NotImplementedError
+        n_seg = torch.div(lengths + chunk_size - 1, chunk_size, rounding_mode='floor')
+
+        # number of segment in its sample for every (sample, segment) pair, negative for empty segments
+        seg_ind = torch.arange(max_n_segments, device=device)[None] - (max_n_segments - n_seg)[:, None]
+        lengths, chunk_size = lengths[:, None], chunk_size[:, None]
+        if align in {'right', None}:
+            ends = lengths - (n_seg[:, None] - 1 - seg_ind) * chunk_size
+            starts = (ends - chunk_size).clamp(min=0)
+        else:
+            starts = seg_ind * chunk_size
+            ends = torch.minimum(starts + chunk_size, lengths)
+        non_empty_mask = seg_ind >= 0
+        seg_lens = torch.where(non_empty_mask, ends - starts, 0)
+
+        segmented = {}
+        aligned['inputs'] = input_ids
+        for add_to, tensor in aligned.items():
+            if tensor is None:
+                segmented[add_to] = None
+                continue
+            prefix, suffix, pad_value = self.segment_layout(add_to)
+            n_prefix, n_suffix = len(prefix), len(suffix)
+            dtype = torch.promote_types(tensor.dtype, prefix.dtype)
+            trailing = tensor.shape[2:]
+            expand = lambda t: t.view(*t.shape, *[1] * len(trailing))
+
+            # token positions inside of segment: prefix, content, suffix, padding
+            pos = torch.arange(input_size, device=device).expand(batch_size, max_n_segments, input_size)
+            content_pos = pos - n_prefix
+            suffix_pos = content_pos - seg_lens[..., None]
+            in_prefix = pos < n_prefix
+            in_content = (content_pos >= 0) & (suffix_pos < 0)
+            in_suffix = (suffix_pos >= 0) & (suffix_pos < n_suffix)
+
+            src = order.gather(1, (starts[..., None] + content_pos).clamp(0, seq_len - 1).view(batch_size, -1))
+            src = expand(src).expand(*src.shape, *trailing)
+            content = tensor.gather(1, src).view(batch_size, max_n_segments, input_size, *trailing).to(dtype)
+
+            # the last value of prefix and suffix is padding
+            prefix = F.pad(prefix.to(device=device, dtype=dtype), (0, 1), value=pad_value)
+            suffix = F.pad(suffix.to(device=device, dtype=dtype), (0, 1), value=pad_value)
+            special = torch.where(in_prefix, prefix[pos.clamp(max=n_prefix)],
+                                  suffix[torch.where(in_suffix, suffix_pos, n_suffix)])
+            special = torch.where(non_empty_mask[..., None], special, pad_value)
+            out = torch.where(expand(in_content & non_empty_mask[..., None]), content, expand(special))
+            segmented[add_to] = out.transpose(0, 1)
+
+        return segmented, non_empty_mask.transpose(0, 1)
+
+    def pad_and_segment_loop(self, input_ids):
         segmented_batch = []
         for seq in input_ids:
             drop_mask = torch.any(torch.stack([seq == t for t in self.special_token_ids if t is not None]), dim=0)
@@ -85,11 +178,11 @@ class RMTBaseModel(torch.nn.Module):
 
     def prepare_kwargs(self, segment_input_ids, kwargs):
         seg_kwargs = dict(**kwargs)
-        non_empty_mask = [s is not None for s in segment_input_ids]
+        non_empty_mask = self.get_non_empty_mask(segment_input_ids)
         if sum(non_empty_mask) == 0:
             return None, non_empty_mask
             
-        input_ids = torch.stack([s for s in segment_input_ids if s is not None])
+        input_ids = self.select_non_empty(segment_input_ids, non_empty_mask)
         inputs_embeds = self.model.embeddings(input_ids)
 
         seg_kwargs['input_ids'] = None
@@ -103,6 +196,63 @@ class RMTBaseModel(torch.nn.Module):
 
         return seg_kwargs, non_empty_mask
 
+    def get_non_empty_mask(self, segment):
+        if isinstance(segment, torch.Tensor):
+            # segments from segment_batch, empty ones are all padding
+            return (segment != self.pad_token_id).any(dim=-1)
+        return [s is not None for s in segment]
+
+    def select_non_empty(self, segment, non_empty_mask):
+        if isinstance(segment, torch.Tensor):
+            return segment[non_empty_mask]
+        return torch.stack([s for s, m in zip(segment, non_empty_mask) if m])
+
+    def segment_plan(self, segmented):
+        """Execution plan of segments from segment_batch.
+
+        Empty segments always come first, so after sorting samples by number of non-empty segments once per batch,
+        non-empty samples of every segment are a prefix of the batch and segment steps run on batch[:n] without
+        gathers and scatters of memory. Returns order of samples, segments and their attention masks in this order
+        and number of non-empty samples for every segment.
+        """
+        non_empty_mask = self.get_non_empty_mask(segmented)
+        order = torch.argsort(non_empty_mask.sum(dim=0), descending=True, stable=True)
+        segmented = segmented[:, order]
+        return order, segmented, self.get_attention_mask(segmented), non_empty_mask.sum(dim=1).tolist()
+
+    def prepare_active_kwargs(self, input_ids, attention_mask, kwargs):
+        # prepare_kwargs for the first n = len(input_ids) samples of batch sorted by segment_plan
+        seg_kwargs = dict(**kwargs)
+        inputs_embeds = self.model.embeddings(input_ids)
+
+        seg_kwargs['input_ids'] = None
+        seg_kwargs['inputs_embeds'] = inputs_embeds
+        if seg_kwargs.get('labels') is not None:
+            seg_kwargs['labels'] = seg_kwargs['labels'][:input_ids.shape[0]]
+        seg_kwargs['attention_mask'] = attention_mask
+        if seg_kwargs.get('token_type_ids') is not None:
+            seg_kwargs['token_type_ids'] = self.get_token_type_ids(input_ids)
+        seg_kwargs['output_hidden_states'] = True
+
+        return seg_kwargs
+
+    @staticmethod
+    def restore_order(tensor, order):
+        # rows of the first len(tensor) samples in segment_plan order -> the same samples in input order
+        return tensor[order[:tensor.shape[0]].argsort()]
+
+    def restore_outputs_order(self, rmt_out, order):
+        # logits and per-segment hidden states and attentions from process_outputs -> input order
+        for key in list(rmt_out.keys()):
+            if key != 'logits' and 'hidden_state' not in key and 'attentions' not in key:
+                continue
+            value = rmt_out[key]
+            if isinstance(value, torch.Tensor):
+                rmt_out[key] = self.restore_order(value, order)
+            elif isinstance(value, tuple):
+                rmt_out[key] = tuple(self.restore_order(v, order) for v in value)
+        return rmt_out
+
     def process_outputs(self, model_outputs, output_attentions, output_hidden_states):
         rmt_out = model_outputs[-1]
 
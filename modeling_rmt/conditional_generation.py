@@ -14,24 +14,29 @@ class RMTEncoderDecoderForConditionalGeneration(RMTBaseModel):
 
         memory = self.set_memory(input_ids.shape)
         segmented = self.pad_and_segment(input_ids)
+        # all memory rows are the same at start, only segments and labels are reordered
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
+        if labels is not None:
+            kwargs['labels'] = labels[order]
 
         base_model_outputs = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
             
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
             out = self.model(**seg_kwargs)
             base_model_outputs.append(out)
             
-            memory[non_empty_mask] = out.encoder_hidden_states[-1][:, self.memory_position]
+            memory[:n] = out.encoder_hidden_states[-1][:, self.memory_position]
 
         out = self.process_outputs(base_model_outputs, output_attentions, output_hidden_states)
-        return out
+        return self.restore_outputs_order(out, order)
 
     def generate(self, input_ids, attention_mask=None, position_ids=None, head_mask=None,
                 inputs_embeds=None, output_attentions=None, output_hidden_states=None, return_dict=None,
@@ -45,16 +50,18 @@ class RMTEncoderDecoderForConditionalGeneration(RMTBaseModel):
 
         memory = self.set_memory(input_ids.shape)
         segmented = self.pad_and_segment(input_ids)
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
 
         base_model_outputs = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
             if seg_num == len(segmented) - 1:
                 out = self.model.generate(**seg_kwargs)
             else:
@@ -63,10 +70,10 @@ class RMTEncoderDecoderForConditionalGeneration(RMTBaseModel):
                         seg_kwargs.pop(param)
                         
                 out = self.model.encoder(**seg_kwargs)
-                memory[non_empty_mask] = out.last_hidden_state[:, self.memory_position]
+                memory[:n] = out.last_hidden_state[:, self.memory_position]
                 # base_model_outputs.append(out)
 
-        return out
+        return self.restore_order(out, order)
 
     def pad_add_special_tokens(self, tensor, segment_size):
         input_elements = []
@@ -80,6 +87,10 @@ class RMTEncoderDecoderForConditionalGeneration(RMTBaseModel):
             tensor = F.pad(tensor, (0, pad_size), value=self.pad_token_id)
         return tensor
 
+    def segment_layout(self, add_to='inputs'):
+        prefix = [self.mem_token_ids] if self.bos_token is None else [self.bos_token, self.mem_token_ids]
+        return torch.cat(prefix), self.eos_token, self.pad_token_id
+
 
 import types
 class RMTEncoderDecoderMemoryLayers(RMTEncoderDecoderForConditionalGeneration):
@@ -135,7 +146,7 @@ class RMTEncoderDecoderHorizontalMemory(RMTEncoderDecoderMemoryLayers):
         self.override_encoder_forward(memory_forward_func)
 
     def set_memory(self, input_shape):
-        self.memory_storage = {}
+        self.memory_storage = {'batch_size': input_shape[0], 'non_empty_mask': slice(None)}
         memory = self.model.embeddings(self.mem_token_ids)
         memory = memory.repeat(input_shape[0], 1, 1)
         
@@ -156,25 +167,30 @@ class RMTEncoderDecoderHorizontalMemory(RMTEncoderDecoderMemoryLayers):
 
         memory = self.set_memory(input_ids.shape)
         segmented = self.pad_and_segment(input_ids)
+        # all memory rows are the same at start, only segments and labels are reordered
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
+        if labels is not None:
+            kwargs['labels'] = labels[order]
 
         base_model_outputs = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
-            self.memory_storage['non_empty_mask'] = non_empty_mask
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
+            self.memory_storage['non_empty_mask'] = slice(0, n)
             
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
             out = self.model(**seg_kwargs)
             base_model_outputs.append(out)
             
-            memory[non_empty_mask] = out.encoder_hidden_states[-1][:, self.memory_position]
+            memory[:n] = out.encoder_hidden_states[-1][:, self.memory_position]
 
         out = self.process_outputs(base_model_outputs, output_attentions, output_hidden_states)
-        return out
+        return self.restore_outputs_order(out, order)
 
     def generate(self, input_ids, attention_mask=None, position_ids=None, head_mask=None,
                 inputs_embeds=None, output_attentions=None, output_hidden_states=None, return_dict=None,
@@ -188,16 +204,18 @@ class RMTEncoderDecoderHorizontalMemory(RMTEncoderDecoderMemoryLayers):
 
         memory = self.set_memory(input_ids.shape)
         segmented = self.pad_and_segment(input_ids)
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
 
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
-            self.memory_storage['non_empty_mask'] = non_empty_mask
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
+            self.memory_storage['non_empty_mask'] = slice(0, n)
 
             if seg_num == len(segmented) - 1:
                 out = self.model.generate(**seg_kwargs)
@@ -207,9 +225,9 @@ class RMTEncoderDecoderHorizontalMemory(RMTEncoderDecoderMemoryLayers):
                         seg_kwargs.pop(param)
                         
                 out = self.model.encoder(**seg_kwargs)
-                memory[non_empty_mask] = out.last_hidden_state[:, self.memory_position]
+                memory[:n] = out.last_hidden_state[:, self.memory_position]
 
-        return out
+        return self.restore_order(out, order)
     
 from torch.nn import CrossEntropyLoss
 class RMTEncoderDecoderMemoryOutput(RMTEncoderDecoderMemoryLayers):
@@ -224,27 +242,32 @@ class RMTEncoderDecoderMemoryOutput(RMTEncoderDecoderMemoryLayers):
 
         memory = self.set_memory(input_ids.shape)
         segmented = self.pad_and_segment(input_ids)
+        # all memory rows are the same at start, only segments and labels are reordered
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
+        if labels is not None:
+            kwargs['labels'] = labels[order]
 
         memories = []
         base_model_outputs = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
             
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
             out = self.model(**seg_kwargs)
             base_model_outputs.append(out)
             
-            memory[non_empty_mask] = out.encoder_hidden_states[-1][:, self.memory_position]
+            memory[:n] = out.encoder_hidden_states[-1][:, self.memory_position]
             memories.append(torch.clone(memory))
 
             if seg_num == len(segmented) - 1:
                 memories = torch.cat(memories, dim=1)
-                decoder_input_ids = self.model._shift_right(labels)
+                decoder_input_ids = self.model._shift_right(kwargs['labels'])
 
                 decoder_outputs = self.model.decoder(input_ids=decoder_input_ids, encoder_hidden_states=memories)
                 # base_model_outputs.append(out)
@@ -268,11 +291,11 @@ class RMTEncoderDecoderMemoryOutput(RMTEncoderDecoderMemoryLayers):
         loss = None
         if labels is not None:
             loss_fct = CrossEntropyLoss(ignore_index=-100)
-            loss = loss_fct(lm_logits.view(-1, lm_logits.size(-1)), labels.view(-1))
+            loss = loss_fct(lm_logits.view(-1, lm_logits.size(-1)), kwargs['labels'].view(-1))
         
         out['loss'] = loss
 
-        return out
+        return self.restore_outputs_order(out, order)
 
     def generate(self, input_ids, attention_mask=None, position_ids=None, head_mask=None,
                 inputs_embeds=None, output_attentions=None, output_hidden_states=None, return_dict=None,
@@ -286,23 +309,25 @@ class RMTEncoderDecoderMemoryOutput(RMTEncoderDecoderMemoryLayers):
 
         memory = self.set_memory(input_ids.shape)
         segmented = self.pad_and_segment(input_ids)
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
 
         memories = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
 
             for param in ['min_length', 'max_length']:
                 if param in seg_kwargs:
                     seg_kwargs.pop(param)
                     
             encoder_out = self.model.encoder(**seg_kwargs)
-            memory[non_empty_mask] = out.last_hidden_state[:, self.memory_position]
+            memory[:n] = out.last_hidden_state[:, self.memory_position]
             memories.append(torch.clone(memory))
 
             if seg_num == len(segmented) - 1:                
@@ -313,4 +338,4 @@ class RMTEncoderDecoderMemoryOutput(RMTEncoderDecoderMemoryLayers):
         encoder_out.hidden_states = None
         encoder_out.last_hidden_state = hidden_states
         out = self.model.generate(encoder_outputs=encoder_out)
-        return out 
\ No newline at end of file
+        return self.restore_order(out, order) 
\ No newline at end of file
@@ -0,0 +1,69 @@
+import torch
+
+
+class SlidingWindowCache:
+    """K/V and attention mask of the previous segment tokens for sliding_window mode.
+
+    Buffers of `window` tokens are allocated for every layer on the first update (and again only if batch size,
+    dtype or device change). Every update copies the tokens of the new segment into them in place, cells get
+    views of the buffers. With inplace=False (segment checkpointing: recomputation in backward reads K/V of the
+    previous segment after they were overwritten) new detached tensors are kept for every segment instead.
+    """
+    def __init__(self, window, inplace=True):
+        self.window = window
+        self.inplace = inplace
+        self.key_values = None
+        self.mask = None
+        self.length = 0
+
+    def reset(self):
+        self.length = 0
+
+    @torch.no_grad()
+    def update(self, past_key_values, attention_mask, start, end):
+        # keeps tokens start:end of K/V of every layer and attention mask of these tokens
+        length = end - start
+        if length > self.window:
+            raise ValueError(f'Segment of {length} tokens does not fit sliding window of {self.window} tokens')
+        if not self.inplace:
+            self.key_values = [[k_or_v[..., start:end, :].detach() for k_or_v in seg_kv] for seg_kv in past_key_values]
+            self.mask = attention_mask
+            self.length = length
+            return
+
+        if not self.fits(past_key_values):
+            self.key_values = [[k_or_v.new_empty(*k_or_v.shape[:-2], self.window, k_or_v.shape[-1])
+                                for k_or_v in seg_kv] for seg_kv in past_key_values]
+        for buf_kv, seg_kv in zip(self.key_values, past_key_values):
+            for buf, k_or_v in zip(buf_kv, seg_kv):
+                buf[..., :length, :].copy_(k_or_v[..., start:end, :])
+        if attention_mask is None:
+            self.mask = None
+        else:
+            if self.mask is None or self.mask.shape[0] != attention_mask.shape[0] \
+                    or self.mask.dtype != attention_mask.dtype or self.mask.device != attention_mask.device:
+                self.mask = attention_mask.new_empty(attention_mask.size(0), self.window)
+            self.mask[:, :length].copy_(attention_mask)
+        self.length = length
+
+    def fits(self, past_key_values):
+        if self.key_values is None:
+            return False
+        buf, k_or_v = self.key_values[0][0], past_key_values[0][0]
+        return buf.shape[:-2] == k_or_v.shape[:-2] and buf.dtype == k_or_v.dtype and buf.device == k_or_v.device
+
+    @property
+    def past_key_values(self):
+        if self.length == 0:
+            return None
+        if not self.inplace:
+            return self.key_values
+        return [[buf[..., :self.length, :] for buf in buf_kv] for buf_kv in self.key_values]
+
+    @property
+    def prev_attn_mask(self):
+        if self.length == 0 or self.mask is None:
+            return None
+        if not self.inplace:
+            return self.mask
+        return self.mask[:, :self.length]
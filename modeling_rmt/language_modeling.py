@@ -1,12 +1,22 @@
 import math
 import torch
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
+from contextlib import nullcontext
+from functools import partial
+
+from .offload import ActivationOffloader
+from .losses import chunked_cross_entropy, chunked_distillation_loss, distillation_chunk_size, topk_kl_div
+from .segmentation import segment, split_tensor
+from .kv_cache import SlidingWindowCache
+from .backbones import get_backbone_adapter
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 
 class MemoryCell(torch.nn.Module):
     def __init__(self, base_model, num_mem_tokens, wrap_pos=True):
         super().__init__()
         self.model = base_model
+        self.backbone = get_backbone_adapter(base_model)
         self.create_memory(num_mem_tokens)
         self.wrap_pos = wrap_pos
         if wrap_pos:
@@ -23,32 +33,54 @@ class MemoryCell(torch.nn.Module):
         self.write_memory_position = range(-num_mem_tokens, 0)
 
     def wrap_positional_embeddings(self, num_mem_tokens):
-
-        num_pos_embs, emb_dim = self.model.transformer.wpe.weight.shape
-        self.old_num_pos = num_pos_embs
-        new_num_pos = num_pos_embs + 2 * num_mem_tokens
-        prev_embs = self.model.transformer.wpe.weight.detach()
-        self.model.transformer.wpe = torch.nn.Embedding(new_num_pos, emb_dim)
-        with torch.no_grad():
-            self.model.transformer.wpe.weight[num_mem_tokens:num_pos_embs+num_mem_tokens] = prev_embs
-        for layer in self.model.transformer.h:
-            layer.attn.bias = torch.tril(torch.ones((new_num_pos + num_pos_embs, new_num_pos + num_pos_embs), dtype=torch.uint8)).view(
-                1, 1, new_num_pos + num_pos_embs, new_num_pos + num_pos_embs
-            )
+        # positions of memory tokens and causal masks depend on the backbone, see backbones.py
+        mask_size = self.backbone.wrap_positional_embeddings(num_mem_tokens, num_mem_tokens)
+        if mask_size is None:
+            return
+        self.register_buffer('causal_mask', torch.ones((mask_size, mask_size), dtype=torch.bool).tril_().view(
+            1, 1, mask_size, mask_size), persistent=False)
+        self.tie_causal_mask()
+        self._register_load_state_dict_pre_hook(self.drop_causal_mask_state_dict)
+
+    def tie_causal_mask(self):
+        # all attention layers reference the single causal mask of the cell instead of keeping a copy each,
+        # it is not a buffer of layers, so it is moved by model.to() once and tied again in _apply
+        for attn in self.backbone.attention_modules():
+            attn._buffers.pop('bias', None)
+            attn.bias = self.causal_mask
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        if getattr(self, 'causal_mask', None) is not None:
+            self.tie_causal_mask()
+        return self
+
+    def drop_causal_mask_state_dict(self, state_dict, prefix, *args):
+        # checkpoints saved with per-layer masks
+        for k in [k for k in state_dict if k.startswith(prefix) and k.endswith('.attn.bias')]:
+            state_dict.pop(k)
 
     def set_memory(self, input_shape):
         memory = self.memory.repeat(input_shape[0], 1, 1)
         return memory
 
-    def forward(self, input_ids, memory_state=None, labels=None, labels_mask=None, **kwargs):
+    def forward(self, input_ids, memory_state=None, labels=None, labels_mask=None, lm_head=True, **kwargs):
         if memory_state is None:
             memory_state = self.set_memory(input_ids.shape)
 
         seg_kwargs = self.process_input(input_ids, memory_state, **kwargs)
-        out = self.model(**seg_kwargs)
+        # without lm_head logits are not computed, last_hidden_state is returned instead
+        out = self.model(**seg_kwargs) if lm_head else self.model.base_model(**seg_kwargs)
         out, new_memory_state = self.process_output(out, labels, labels_mask, **kwargs)
 
         return out, new_memory_state
+
+    def segment_step(self, memory_state, input_ids, attention_mask=None, lm_head=True, output_hidden_states=False,
+                     output_attentions=False):
+        # fixed inputs and outputs for torch.compile (RecurrentWrapper with compile_segment_step),
+        # flags are constants of the graph
+        return self(input_ids, memory_state=memory_state, attention_mask=attention_mask, lm_head=lm_head,
+                    output_hidden_states=output_hidden_states, output_attentions=output_attentions)
     
     def generate(self, input_ids, memory_state, attention_mask, **generate_kwargs):
         if memory_state is None:
@@ -73,43 +105,44 @@ class MemoryCell(torch.nn.Module):
         seg_kwargs['input_ids'] = None
         seg_kwargs['inputs_embeds'] = inputs_embeds
         if kwargs.get('attention_mask') is not None:
-            seg_kwargs['attention_mask'] = self.pad_attention_mask(kwargs['attention_mask'], inputs_embeds.shape)
-            if kwargs.get('prev_attn_mask') is not None:
-                seg_kwargs['attention_mask'] = torch.cat([kwargs['prev_attn_mask'], seg_kwargs['attention_mask']], dim=-1)
-            if 'prev_attn_mask' in seg_kwargs:
-                seg_kwargs.pop('prev_attn_mask')
+            seg_kwargs['attention_mask'] = self.pad_attention_mask(kwargs['attention_mask'], inputs_embeds.shape,
+                                                                   kwargs.get('prev_attn_mask'))
+            seg_kwargs.pop('prev_attn_mask', None)
             
+        # last hidden state is needed for memory, it is returned only if output_hidden_states is set
         seg_kwargs['output_hidden_states'] = True
 
         if self.wrap_pos:
-            num_pos_embs = self.model.transformer.wpe.weight.shape[0]
-            read_ordinary_pos = torch.arange(0, input_ids.size(1) + self.num_mem_tokens, dtype=torch.long, device=input_ids.device)
-            write_pos = torch.arange(
-                self.old_num_pos + self.num_mem_tokens, 
-                self.old_num_pos + 2 * self.num_mem_tokens, 
-                dtype=torch.long, 
-                device=input_ids.device
-            )
-            seg_kwargs['position_ids'] = torch.cat([
-                read_ordinary_pos, 
-                write_pos
-            ]).long().unsqueeze(0)
+            seg_len = inputs_embeds.size(1) - 2 * self.num_mem_tokens
+            past_key_values = kwargs.get('past_key_values')
+            past_length = past_key_values[0][0].size(-2) if past_key_values is not None else 0
+            position_ids = self.backbone.position_ids(seg_len, self.num_mem_tokens, self.num_mem_tokens,
+                                                      inputs_embeds.device, past_length)
+            if position_ids is not None:
+                seg_kwargs['position_ids'] = position_ids
 
         return seg_kwargs
     
-    def pad_attention_mask(self, attention_mask, shape):
-        if self.num_mem_tokens in {0, None}:
+    def pad_attention_mask(self, attention_mask, shape, prev_attn_mask=None):
+        # mask of previous segment tokens (sliding window), memory and segment tokens in a single allocation
+        if self.num_mem_tokens in {0, None} and prev_attn_mask is None:
             return attention_mask
-        else:
-            mask = torch.ones(*shape[:2], dtype=torch.int64).to(attention_mask.device)
-            mask[:, self.num_mem_tokens:-self.num_mem_tokens] = attention_mask
-            return mask
+        prev_len = prev_attn_mask.size(1) if prev_attn_mask is not None else 0
+        num_mem_tokens = self.num_mem_tokens or 0
+        mask = torch.ones(shape[0], prev_len + shape[1], dtype=torch.int64, device=attention_mask.device)
+        if prev_attn_mask is not None:
+            mask[:, :prev_len] = prev_attn_mask
+        mask[:, prev_len + num_mem_tokens:prev_len + shape[1] - num_mem_tokens] = attention_mask
+        return mask
     
     def process_output(self, model_outputs, labels, labels_mask, **kwargs):
         if self.num_mem_tokens not in {0, None}:
             out = CausalLMOutputWithCrossAttentions()
             memory_state = model_outputs.hidden_states[-1][:, -self.num_mem_tokens:]
-            out['logits'] = model_outputs.logits[:, self.num_mem_tokens:-self.num_mem_tokens]
+            if model_outputs.get('logits') is not None:
+                out['logits'] = model_outputs.logits[:, self.num_mem_tokens:-self.num_mem_tokens]
+            else:
+                out['last_hidden_state'] = model_outputs.last_hidden_state[:, self.num_mem_tokens:-self.num_mem_tokens]
             
             if kwargs.get('output_hidden_states'):
                 out['hidden_states'] = [lh[:, self.num_mem_tokens:-self.num_mem_tokens] for lh in model_outputs.hidden_states]
@@ -119,7 +152,7 @@ class MemoryCell(torch.nn.Module):
             memory_state = None
             out = model_outputs
 
-        if labels is not None:
+        if labels is not None and out.get('logits') is not None:
             ce_loss_fn = CrossEntropyLoss()
             logits = out['logits'][..., :-1, :].contiguous()
             flat_logits = logits.view(-1, logits.size(-1))
@@ -142,6 +175,9 @@ class RecurrentWrapper(torch.nn.Module):
         super().__init__()
         self.memory_cell = memory_cell
         self.rmt_config = rmt_kwargs
+        self.offloader = ActivationOffloader() if rmt_kwargs.get('offload_activations') else None
+        self.kv_cache = None
+        self.compiled_step = None
 
     def forward(self, 
                 input_ids, 
@@ -165,36 +201,56 @@ class RecurrentWrapper(torch.nn.Module):
                 labels=labels[:, i] if not (labels is None) else None, 
                 labels_mask=labels_mask[:, i] if not (labels_mask is None) else None, 
             ) for i in range(n_segs)]
-            labels = torch.cat([labels[:, i] for i in range(n_segs)], dim=1)
+            # (batch, n_segs, seg_len) -> (batch, n_segs * seg_len), a view for contiguous inputs
+            labels = labels.flatten(1, 2)
             if labels_mask is not None:
-                labels_mask = torch.cat([labels_mask[:, i] for i in range(n_segs)], dim=1)
+                labels_mask = labels_mask.flatten(1, 2)
         else:
             segmented = self.segment(input_ids=input_ids, inputs_embeds=inputs_embeds, attention_mask=attention_mask, labels=labels, labels_mask=labels_mask)
+        if self.offloader is not None:
+            self.offloader.reset(self.parameters())
+        ragged = self.rmt_config.get('ragged', False) and attention_mask is not None
+        cell_hidden_states = bool(output_hidden_states) and self.rmt_config.get('output_policy', 'full') != 'loss'
+        # masked_lm_head: cells skip LM head, it is applied in compute_loss only where loss needs logits
+        lm_head = not self.rmt_config.get('masked_lm_head', False)
+        if ragged and sliding_window:
+            raise ValueError('ragged segments are not supported with sliding window')
+        compiled = self.rmt_config.get('compile_segment_step', False)
+        if compiled and (ragged or sliding_window or input_segmented):
+            raise ValueError('compile_segment_step is not supported with ragged segments, sliding window '
+                             'and pre-segmented inputs')
         cell_outputs = []
-        past_key_values = None
+        kv_cache = self.get_kv_cache() if sliding_window else None
         num_mem_tokens = self.memory_cell.num_mem_tokens
-        prev_attn_mask = None
         for seg_num, segment in enumerate(segmented):
             seg_len = segment['input_ids'].size(-1)
-            cell_out, memory_state = self.memory_cell(**segment, 
-                                                      memory_state=memory_state, 
-                                                      output_hidden_states=True, 
-                                                      use_cache=sliding_window, 
-                                                      past_key_values=past_key_values,
-                                                      prev_attn_mask=prev_attn_mask
-                                                    )
+            if ragged:
+                cell_out, memory_state = self.run_segment(self.ragged_step, segment, memory_state, cell_hidden_states,
+                                                          lm_head)
+            elif compiled:
+                cell_out, memory_state = self.run_segment(self.static_step, segment, memory_state, lm_head,
+                                                          cell_hidden_states, bool(output_attentions))
+            else:
+                cell_out, memory_state = self.run_segment(self.memory_cell,
+                                                          **segment, 
+                                                          memory_state=memory_state, 
+                                                          output_hidden_states=cell_hidden_states, 
+                                                          lm_head=lm_head,
+                                                          use_cache=sliding_window, 
+                                                          past_key_values=(kv_cache.past_key_values
+                                                                           if sliding_window else None),
+                                                          prev_attn_mask=(kv_cache.prev_attn_mask
+                                                                          if sliding_window else None)
+                                                        )
             
             if sliding_window:
-                prev_attn_mask = segment['attention_mask']
-                past_key_values = [
-                    [
-                        k_or_v[..., -(num_mem_tokens+seg_len):k_or_v.size(-2)-num_mem_tokens, :].detach() 
-                        for k_or_v in seg_kv
-                    ] 
-                    for seg_kv in cell_out['past_key_values']
-                ]
+                kv_len = cell_out['past_key_values'][0][0].size(-2)
+                kv_cache.update(cell_out['past_key_values'], segment.get('attention_mask'),
+                                kv_len - num_mem_tokens - seg_len, kv_len - num_mem_tokens)
+                # full K/V of the segment are not kept in outputs
+                cell_out['past_key_values'] = None
             cell_outputs.append(cell_out)
-            self.manage_gradients(memory_state, seg_num)
+            memory_state = self.manage_gradients(memory_state, seg_num, len(segmented))
 
         out = self.process_outputs(cell_outputs, labels=labels, 
                                    labels_mask=labels_mask,
@@ -202,7 +258,68 @@ class RecurrentWrapper(torch.nn.Module):
                                    output_hidden_states=output_hidden_states)
         return out
 
-        
+    def get_kv_cache(self):
+        # buffers of sliding window are kept between calls, segment checkpointing needs a copy for every segment
+        inplace = not self.rmt_config.get('segment_checkpointing', False)
+        if self.kv_cache is None or self.kv_cache.inplace != inplace:
+            self.kv_cache = SlidingWindowCache(self.rmt_config.get('segment_size'), inplace=inplace)
+        self.kv_cache.reset()
+        return self.kv_cache
+
+    def run_segment(self, fn, *args, **kwargs):
+        # with segment_checkpointing only inputs of each segment (incl. memory state) are kept for backward,
+        # segment activations are recomputed during backward
+        if self.rmt_config.get('segment_checkpointing') and torch.is_grad_enabled():
+            fn = partial(checkpoint, fn, use_reentrant=False)
+        # with offload_activations tensors saved for backward by older segments are moved to host memory
+        with self.offloader.segment() if self.offloader is not None else nullcontext():
+            return fn(*args, **kwargs)
+
+    def static_step(self, segment, memory_state, lm_head=True, output_hidden_states=False, output_attentions=False):
+        # compiled cell step: memory state is always a tensor input, other inputs are fixed, so there is
+        # one graph per (batch size, segment length) and output flags
+        if memory_state is None:
+            memory_state = self.memory_cell.set_memory(segment['input_ids'].shape)
+        if self.compiled_step is None:
+            self.compiled_step = torch.compile(self.memory_cell.segment_step, dynamic=False)
+        return self.compiled_step(memory_state, segment['input_ids'], segment.get('attention_mask'), lm_head,
+                                  output_hidden_states, output_attentions)
+
+    def ragged_step(self, segment, memory_state, output_hidden_states=True, lm_head=True):
+        # runs memory cell only on samples with real tokens in the segment, other samples keep their memory
+        # and get zero outputs, so padding segments of short samples are not computed
+        batch_size = segment['attention_mask'].shape[0]
+        if memory_state is None:
+            memory_state = self.memory_cell.set_memory((batch_size,))
+        active = segment['attention_mask'].any(dim=1)
+        if active.all() or not active.any():
+            return self.memory_cell(**segment, memory_state=memory_state, output_hidden_states=output_hidden_states,
+                                    lm_head=lm_head)
+
+        active_idx = active.nonzero(as_tuple=True)[0]
+        active_segment = {k: v[active_idx] for k, v in segment.items() if v is not None}
+        cell_out, active_memory_state = self.memory_cell(**active_segment,
+                                                         memory_state=memory_state[active_idx],
+                                                         output_hidden_states=output_hidden_states,
+                                                         lm_head=lm_head)
+        memory_state = memory_state.to(active_memory_state.dtype).index_copy(0, active_idx, active_memory_state)
+        return self.scatter_output(cell_out, active_idx, batch_size), memory_state
+
+    def scatter_output(self, cell_out, active_idx, batch_size):
+        # puts outputs of active samples back to their places in the batch
+        def scatter(tensor):
+            return tensor.new_zeros(batch_size, *tensor.shape[1:]).index_copy(0, active_idx, tensor)
+
+        out = CausalLMOutputWithCrossAttentions()
+        for key, value in cell_out.items():
+            if key in {'logits', 'last_hidden_state'}:
+                out[key] = scatter(value)
+            elif key == 'hidden_states':
+                out[key] = [scatter(lh) for lh in value]
+            else:
+                out[key] = value
+        return out
+
     def generate(self, input_ids, attention_mask, **generate_kwargs):
         memory_state = None
         segmented = self.segment(input_ids=input_ids, attention_mask=attention_mask)
@@ -216,94 +333,215 @@ class RecurrentWrapper(torch.nn.Module):
         return out
 
     def segment(self, **kwargs):
-        segments = []
-        for k, tensor in kwargs.items():
-            if tensor is not None:
-                k_segments = self.split_tensor(tensor)
-                for s, k_seg in enumerate(k_segments):
-                    if s < len(segments):
-                        segments[s][k] = k_seg
-                    else:
-                        segments.append({k: k_seg})
-
-        return segments
-    
+        return segment(self.rmt_config.get('segment_size'), self.rmt_config.get('segment_alignment'), **kwargs)
+
     def split_tensor(self, tensor):
-        align = self.rmt_config.get('segment_alignment')
-        segment_size = self.rmt_config.get('segment_size')
-        if align in {'left', None}:
-            split_inds = list(range(0, tensor.shape[1], segment_size)) + [tensor.shape[1]]
-            segments = [tensor[:, start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-        elif align in {'right', None}:
-            split_inds = (list(range(tensor.shape[1], 0, -segment_size)) + [0])[::-1]
-            segments = [tensor[:, start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-        elif align == 'center':
-            n_seg = math.ceil(tensor.shape[1] / segment_size)
-            segments = torch.chunk(tensor, n_seg, dim=1)
-        else:
-            raise NotImplementedError
-        return segments
+        return split_tensor(tensor, self.rmt_config.get('segment_size'), self.rmt_config.get('segment_alignment'))
 
     def process_outputs(self, cell_outputs, **kwargs):
+        # output_policy: 'full' - logits (and hidden states) of the whole input and of every segment,
+        # 'last_segment' - of the last segment only, 'loss' - only loss
+        output_policy = self.rmt_config.get('output_policy', 'full')
+        if output_policy not in {'full', 'last_segment', 'loss'}:
+            raise ValueError(f'Unknown output_policy {output_policy}')
         out = CausalLMOutputWithCrossAttentions()
-        full_logits = torch.cat([o.logits for o in cell_outputs], dim=1)
-        full_hidden_states = tuple([torch.cat(layer_hs, dim=1) for layer_hs in zip(*[o.hidden_states for o in cell_outputs])])
 
         labels = kwargs.get('labels')
         if labels is not None:
-            shift_labels = labels[..., 1:].contiguous()
-            shift_logits = full_logits[..., :-1, :].contiguous()
-            flat_labels = shift_labels.view(-1)
-            flat_logits = shift_logits.view(-1, shift_logits.size(-1))
-            
-            loss_fct = CrossEntropyLoss()
-            labels_mask = kwargs.get('labels_mask')
-            if labels_mask is not None:
-                shift_mask = labels_mask[..., :-1].contiguous()
-
-                flat_labels = flat_labels[shift_mask.view(-1)]
-                flat_logits = flat_logits[shift_mask.view(-1)]
-                
-            out['loss'] = loss_fct(flat_logits, flat_labels)
+            out['loss'] = self.compute_loss(cell_outputs, labels, kwargs.get('labels_mask'))
         else:
             out['loss'] = 0
 
         out['ce_loss'] = out['loss']
-        
-        out['logits'] = full_logits
+        # with masked_lm_head full logits are never computed
+        if output_policy == 'loss' or self.rmt_config.get('masked_lm_head', False):
+            return out
+        if output_policy == 'last_segment':
+            out['logits'] = cell_outputs[-1].logits
+            if kwargs.get('output_hidden_states'):
+                out['hidden_states'] = cell_outputs[-1].hidden_states
+            return out
+
+        out['logits'] = torch.cat([o.logits for o in cell_outputs], dim=1)
         segment_keys = ['loss', 'logits']
         if kwargs.get('output_attentions'):
             segment_keys.append('attentions')
         if kwargs.get('output_hidden_states'):
             segment_keys.append('hidden_states')
-            out['hidden_states'] = full_hidden_states
+            out['hidden_states'] = tuple([torch.cat(layer_hs, dim=1)
+                                          for layer_hs in zip(*[o.hidden_states for o in cell_outputs])])
 
         for seg_num, o in enumerate(cell_outputs):
             for key, value in o.items():
                 if any([sk in key for sk in segment_keys]):
                     out[f'{key}_{seg_num}'] = value
 
-        return out 
-        
-    def manage_gradients(self, memory_state, seg_num):
-        k2, max_n_segments = self.rmt_config.get('k2'), self.rmt_config.get('max_n_segments')
-        if seg_num == 0 \
-            or k2 in {-1, None} \
-            or seg_num + k2 > max_n_segments:
-                return True
+        return out
+
+    def compute_loss(self, cell_outputs, labels, labels_mask=None):
+        # mean CE over the whole input computed segment by segment, without concatenation of logits:
+        # logits at position t predict labels[t + 1], labels_mask[t] selects this pair
+        # with masked_lm_head cells return last_hidden_state: LM head is applied only to positions selected
+        # by labels_mask, or, if all positions are labeled, by vocabulary chunks
+        loss_fct = CrossEntropyLoss(reduction='sum')
+        lm_head = self.memory_cell.model.get_output_embeddings()
+        loss, n_tokens = 0, 0
+        start = 0
+        for o in cell_outputs:
+            has_logits = o.get('logits') is not None
+            outputs = o.logits if has_logits else o.last_hidden_state
+            end = min(start + outputs.size(1), labels.size(1) - 1)
+            if end <= start:
+                break
+            outputs = outputs[:, :end - start]
+            flat_outputs = outputs.reshape(-1, outputs.size(-1))
+            flat_labels = labels[:, start + 1:end + 1].reshape(-1)
+            if labels_mask is not None:
+                flat_mask = labels_mask[:, start:end].reshape(-1)
+                flat_outputs = flat_outputs[flat_mask]
+                flat_labels = flat_labels[flat_mask]
+            if has_logits:
+                loss = loss + loss_fct(flat_outputs, flat_labels)
+            elif labels_mask is not None:
+                loss = loss + loss_fct(lm_head(flat_outputs), flat_labels)
+            else:
+                seg_loss, _ = chunked_cross_entropy(flat_outputs, lm_head.weight, flat_labels, lm_head.bias,
+                                                    ignore_index=loss_fct.ignore_index)
+                loss = loss + seg_loss
+            n_tokens += (flat_labels != loss_fct.ignore_index).sum()
+            start = end
+        return loss / n_tokens 
         
-        memory_state = memory_state.detach()
-        return False
+    def manage_gradients(self, memory_state, seg_num, n_segments):
+        # truncated BPTT: backward goes through memory of the last k2 segments only
+        k2 = self.rmt_config.get('k2')
+        if k2 in {-1, None} or seg_num + k2 >= n_segments:
+            return memory_state
+        return memory_state.detach()
+
+    def session(self, sliding_window=False):
+        return MemorySession(self, sliding_window=sliding_window)
+
+    def generate_forked(self, input_ids, attention_mask, questions_input_ids, questions_attention_mask=None,
+                        **generate_kwargs):
+        # context is processed once, its memory is copied to len(questions_input_ids) // len(input_ids)
+        # questions per context, questions of the same context go one after another
+        session = self.session()
+        session.feed(input_ids, attention_mask)
+        return session.generate(questions_input_ids, questions_attention_mask, **generate_kwargs)
+
+
+class MemorySession:
+    """Inference over a stream of tokens that keeps memory between calls.
+
+    feed() runs only new complete segments through the memory cell and buffers an incomplete tail,
+    generate() answers from the current memory, the tail is prepended to the generation prompt.
+    Segments of feed() and generate() are always left-aligned, segment_alignment of the wrapper is not used.
+    With sliding_window feed() also keeps K/V of the previous segment. generate() does not attend to them
+    (as generate of the wrapper), so it is not supported for such sessions.
+    """
+    def __init__(self, recurrent_wrapper, sliding_window=False):
+        self.wrapper = recurrent_wrapper
+        self.memory_cell = recurrent_wrapper.memory_cell
+        self.segment_size = recurrent_wrapper.rmt_config['segment_size']
+        self.sliding_window = sliding_window
+        self.reset()
+
+    def reset(self):
+        self.memory_state = None
+        self.kv_cache = SlidingWindowCache(self.segment_size)
+        self.tail_input_ids = None
+        self.tail_attention_mask = None
+        self.batch_size = None
+        self.n_segments = 0
+
+    def get_n_forks(self, batch_size):
+        if self.batch_size is None or self.batch_size == batch_size:
+            return 1
+        if batch_size % self.batch_size != 0:
+            raise ValueError(f'Batch size {batch_size} is not a multiple of session batch size {self.batch_size}')
+        return batch_size // self.batch_size
+
+    def with_tail(self, input_ids, attention_mask=None, n_forks=1):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if self.tail_input_ids is not None:
+            tail_input_ids = self.tail_input_ids.repeat_interleave(n_forks, dim=0)
+            tail_attention_mask = self.tail_attention_mask.repeat_interleave(n_forks, dim=0)
+            input_ids = torch.cat([tail_input_ids, input_ids], dim=1)
+            attention_mask = torch.cat([tail_attention_mask.to(attention_mask.dtype), attention_mask], dim=1)
+        return input_ids, attention_mask
+
+    def split(self, input_ids, attention_mask):
+        # left-aligned segments of segment_size for both feed() and generate(), the last one can be shorter
+        return [dict(input_ids=input_ids[:, i:i + self.segment_size],
+                     attention_mask=attention_mask[:, i:i + self.segment_size])
+                for i in range(0, input_ids.size(1), self.segment_size)]
+
+    @torch.no_grad()
+    def feed(self, input_ids, attention_mask=None):
+        if self.batch_size is not None and self.batch_size != input_ids.size(0):
+            raise ValueError(f'Session batch size is {self.batch_size}, got input of size {input_ids.size(0)}')
+        self.batch_size = input_ids.size(0)
+        input_ids, attention_mask = self.with_tail(input_ids, attention_mask)
+        num_mem_tokens = self.memory_cell.num_mem_tokens
+
+        n_full_segments = input_ids.size(1) // self.segment_size
+        tail_start = n_full_segments * self.segment_size
+        for segment in self.split(input_ids[:, :tail_start], attention_mask[:, :tail_start]):
+            cell_out, self.memory_state = self.memory_cell(**segment,
+                                                           memory_state=self.memory_state,
+                                                           output_hidden_states=True,
+                                                           use_cache=self.sliding_window,
+                                                           past_key_values=self.kv_cache.past_key_values,
+                                                           prev_attn_mask=self.kv_cache.prev_attn_mask)
+            if self.sliding_window:
+                kv_len = cell_out['past_key_values'][0][0].size(-2)
+                self.kv_cache.update(cell_out['past_key_values'], segment['attention_mask'],
+                                     kv_len - num_mem_tokens - self.segment_size, kv_len - num_mem_tokens)
+            self.n_segments += 1
+
+        if tail_start < input_ids.size(1):
+            self.tail_input_ids = input_ids[:, tail_start:]
+            self.tail_attention_mask = attention_mask[:, tail_start:]
+        else:
+            self.tail_input_ids = self.tail_attention_mask = None
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask=None, **generate_kwargs):
+        if self.sliding_window:
+            raise ValueError('generate is not supported for sessions with sliding_window: queries would be answered '
+                             'without K/V of the previous segment')
+        # session memory is not updated by the prompt, so several queries can be asked over the same stream
+        # batch of queries larger than the session batch gets a copy of memory for each query
+        n_forks = self.get_n_forks(input_ids.size(0))
+        input_ids, attention_mask = self.with_tail(input_ids, attention_mask, n_forks)
+        segmented = self.split(input_ids, attention_mask)
+
+        memory_state = self.memory_state
+        if memory_state is not None and n_forks > 1:
+            memory_state = memory_state.repeat_interleave(n_forks, dim=0)
+        for segment in segmented[:-1]:
+            _, memory_state = self.memory_cell(**segment, memory_state=memory_state, output_hidden_states=True)
+
+        return self.memory_cell.generate(**segmented[-1], memory_state=memory_state, **generate_kwargs)
 
 
 class Distillator(torch.nn.Module):
-    def __init__(self, teacher_model, student_model, alpha_distil):
+    """teacher_model can be None if training batches have teacher_topk_ids and teacher_topk_log_probs from
+    TeacherLogitsStore (modeling_rmt/teacher_cache.py), then KL is computed against top-k teacher distribution.
+    With memory_budget_mb CE and KL with full teacher logits are computed together by tiles of positions
+    (chunked_distillation_loss), log-softmax of a tile takes about memory_budget_mb.
+    """
+    def __init__(self, teacher_model, student_model, alpha_distil, memory_budget_mb=None):
         super().__init__()
         self.teacher = teacher_model
         self.student = student_model
         self.alpha = alpha_distil
-        for p in self.teacher.parameters():
-            p.requires_grad = False
+        self.memory_budget_mb = memory_budget_mb
+        if self.teacher is not None:
+            for p in self.teacher.parameters():
+                p.requires_grad = False
     
     def forward(self, 
                 input_ids, 
@@ -315,14 +553,20 @@ class Distillator(torch.nn.Module):
                 output_hidden_states=None,
                 input_segmented=False,
                 sliding_window=False,
+                teacher_topk_ids=None,
+                teacher_topk_log_probs=None,
                 ):
+        # with fused loss CE is computed together with KL, neither the teacher nor the student computes it
+        fused_loss = self.training and teacher_topk_ids is None and self.memory_budget_mb is not None
+        teacher_labels = labels if not fused_loss else None
         with torch.no_grad():
-            if self.training:
+            if self.training and teacher_topk_ids is None:
                 if input_segmented:
                     n_segs = input_ids.shape[1] if not (input_ids is None) else inputs_embeds.shape[1]
                     teacher_output = self.teacher(
                         input_ids=torch.cat([input_ids[:, i] for i in range(n_segs)], dim=1) if input_ids is not None else None,
-                        labels=torch.cat([labels[:, i] for i in range(n_segs)], dim=1)  if labels is not None else None, 
+                        labels=(torch.cat([teacher_labels[:, i] for i in range(n_segs)], dim=1)
+                                if teacher_labels is not None else None),
                         inputs_embeds=torch.cat([inputs_embeds[:, i] for i in range(n_segs)], dim=1) if inputs_embeds is not None else None, 
                         attention_mask=torch.cat([attention_mask[:, i] for i in range(n_segs)], dim=1) if attention_mask is not None else None, 
                         output_attentions=output_attentions, 
@@ -331,7 +575,7 @@ class Distillator(torch.nn.Module):
                 else:
                     teacher_output = self.teacher(
                         input_ids=input_ids,
-                        labels=labels, 
+                        labels=teacher_labels, 
                         inputs_embeds=inputs_embeds, 
                         attention_mask=attention_mask, 
                         output_attentions=output_attentions, 
@@ -341,7 +585,7 @@ class Distillator(torch.nn.Module):
                 teacher_output = dict()
         student_output = self.student(
             input_ids=input_ids,
-            labels=labels,
+            labels=labels if not fused_loss else None,
             labels_mask=labels_mask, 
             inputs_embeds=inputs_embeds, 
             attention_mask=attention_mask, 
@@ -356,10 +600,15 @@ class Distillator(torch.nn.Module):
             labels = torch.cat([labels[:, i] for i in range(n_segs)], dim=1)
             if labels_mask is not None:
                 labels_mask = torch.cat([labels_mask[:, i] for i in range(n_segs)], dim=1)
+            if teacher_topk_ids is not None:
+                teacher_topk_ids = torch.cat([teacher_topk_ids[:, i] for i in range(n_segs)], dim=1)
+                teacher_topk_log_probs = torch.cat([teacher_topk_log_probs[:, i] for i in range(n_segs)], dim=1)
     
         out = self.process_outputs(teacher_output, student_output,
             labels=labels,
             labels_mask=labels_mask, 
+            teacher_topk_ids=teacher_topk_ids,
+            teacher_topk_log_probs=teacher_topk_log_probs,
             output_attentions=output_attentions, 
             output_hidden_states=output_hidden_states)
 
@@ -367,7 +616,8 @@ class Distillator(torch.nn.Module):
                   
     def process_outputs(self, teacher_output, student_output, **kwargs):
         out = CausalLMOutputWithCrossAttentions()
-        teacher_logits = teacher_output.logits if self.training else None
+        teacher_logits = teacher_output.get('logits')
+        teacher_topk_ids, teacher_topk_log_probs = kwargs.get('teacher_topk_ids'), kwargs.get('teacher_topk_log_probs')
         student_logits = student_output.logits
 
         for (k, v) in student_output.items():
@@ -378,14 +628,20 @@ class Distillator(torch.nn.Module):
                 out[f'teacher_{k}'] = teachers
 
         labels = kwargs.get('labels')
+        if labels is not None and teacher_logits is not None and self.memory_budget_mb is not None:
+            return self.fused_loss(out, student_logits, teacher_logits, labels, kwargs.get('labels_mask'))
         if labels is not None:
             shift_labels = labels[..., 1:].contiguous()
             shift_logits = student_logits[..., :-1, :].contiguous()
-            shift_t_logits = teacher_logits[..., :-1, :].contiguous() if self.training else None
+            shift_t_logits = teacher_logits[..., :-1, :].contiguous() if teacher_logits is not None else None
 
             flat_labels = shift_labels.view(-1)
             flat_logits = shift_logits.view(-1, shift_logits.size(-1))
-            flat_t_logits = shift_t_logits.view(-1, shift_t_logits.size(-1)) if self.training else None
+            flat_t_logits = shift_t_logits.view(-1, shift_t_logits.size(-1)) if teacher_logits is not None else None
+            if teacher_topk_ids is not None:
+                k = teacher_topk_ids.size(-1)
+                flat_t_ids = teacher_topk_ids[..., :-1, :].reshape(-1, k)
+                flat_t_log_probs = teacher_topk_log_probs[..., :-1, :].reshape(-1, k)
             
             labels_mask = kwargs.get('labels_mask')
             if labels_mask is not None:
@@ -393,13 +649,21 @@ class Distillator(torch.nn.Module):
 
                 flat_labels = flat_labels[shift_mask.view(-1)]
                 flat_logits = flat_logits[shift_mask.view(-1)]
-                flat_t_logits = flat_t_logits[shift_mask.view(-1)] if self.training else None
-
-            dist_fct = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
-
-            log_sftmx_student = torch.log_softmax(flat_logits, dim=-1)  
-            log_sftmx_teacher = torch.log_softmax(flat_t_logits, dim=-1) if self.training else None
-            dist = dist_fct(log_sftmx_student, log_sftmx_teacher) if self.training else None
+                flat_t_logits = flat_t_logits[shift_mask.view(-1)] if teacher_logits is not None else None
+                if teacher_topk_ids is not None:
+                    flat_t_ids = flat_t_ids[shift_mask.view(-1)]
+                    flat_t_log_probs = flat_t_log_probs[shift_mask.view(-1)]
+
+            dist = None
+            if self.training and teacher_topk_ids is not None:
+                # same as KLDivLoss with reduction='batchmean'
+                dist = topk_kl_div(flat_logits, flat_t_ids, flat_t_log_probs) / flat_logits.size(0)
+            elif self.training:
+                dist_fct = torch.nn.KLDivLoss(reduction='batchmean', log_target=True)
+
+                log_sftmx_student = torch.log_softmax(flat_logits, dim=-1)  
+                log_sftmx_teacher = torch.log_softmax(flat_t_logits, dim=-1)
+                dist = dist_fct(log_sftmx_student, log_sftmx_teacher)
             out['ce_loss'] = out['loss']
             if self.training:
                 out['dist'] = dist
@@ -410,3 +674,22 @@ class Distillator(torch.nn.Module):
 
         return out 
 
+    def fused_loss(self, out, student_logits, teacher_logits, labels, labels_mask=None):
+        # the same CE and KL as in process_outputs, computed over views of logits: logits at position t
+        # predict labels[t + 1], labels_mask[t] selects this pair, the last position is not used
+        mask = torch.ones_like(labels, dtype=torch.bool)
+        mask[..., -1] = False
+        if labels_mask is not None:
+            mask = mask & labels_mask.bool()
+        shift_labels = torch.nn.functional.pad(labels[..., 1:], (0, 1), value=-100).masked_fill(~mask, -100)
+
+        vocab_size = student_logits.size(-1)
+        chunk_size = distillation_chunk_size(vocab_size, self.memory_budget_mb)
+        ce, kl, n_labels = chunked_distillation_loss(student_logits.reshape(-1, vocab_size),
+                                                     teacher_logits.reshape(-1, vocab_size),
+                                                     shift_labels.reshape(-1), mask.reshape(-1), chunk_size)
+        out['ce_loss'] = ce / n_labels
+        out['dist'] = kl / mask.sum()
+        out['loss'] = (1 - self.alpha) * out['ce_loss'] + self.alpha * out['dist']
+        return out
+
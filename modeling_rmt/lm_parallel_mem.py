@@ -3,6 +3,8 @@ import torch
 from torch.nn import CrossEntropyLoss
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 
+from .backbones import get_backbone_adapter
+
 class ParallelLayerWrapper(torch.nn.Module):
     def __init__(self, layer, d_model, num_mem_tokens) -> None:
         super().__init__()
@@ -40,18 +42,17 @@ class ParallelLayerWrapper(torch.nn.Module):
 
 
 class MemoryCell(torch.nn.Module):
-    def __init__(self, base_model, num_mem_tokens, layers_attr: str = 'transformer.h', wrap_pos=True):
+    def __init__(self, base_model, num_mem_tokens, layers_attr: str = None, wrap_pos=True):
         super().__init__()
         self.model = base_model
         self.num_mem_tokens = num_mem_tokens
         self.d_model = base_model.get_input_embeddings().embedding_dim
         self.W_mq = torch.nn.ModuleList()
         self.W_mem = []
-        self.layers = self.model
 
-        self.layers_attrs = layers_attr.split('.')
-        for i, attr in enumerate(self.layers_attrs):
-            self.layers = getattr(self.layers, attr)
+        self.backbone = get_backbone_adapter(base_model)
+        self.layers = self.backbone.get_layers(layers_attr)
+        self.layers_attrs = (layers_attr or self.backbone.layers_attr).split('.')
         for i in range(len(self.layers)):
             self.layers[i] = ParallelLayerWrapper(self.layers[i], self.d_model, self.num_mem_tokens)
         self.create_memory(num_mem_tokens)
@@ -71,19 +72,13 @@ class MemoryCell(torch.nn.Module):
         self.register_parameter('memory', torch.nn.Parameter(memory_weights, requires_grad=True))
 
     def wrap_positional_embeddings(self, num_mem_tokens):
-
-        num_pos_embs, emb_dim = self.model.transformer.wpe.weight.shape
-
-        new_num_pos = num_pos_embs + 2 * num_mem_tokens
-
-        prev_embs = self.model.transformer.wpe.weight.detach()
-        self.model.transformer.wpe = torch.nn.Embedding(new_num_pos, emb_dim)
-        with torch.no_grad():
-            self.model.transformer.wpe.weight[num_mem_tokens:-num_mem_tokens] = prev_embs
-        for layer in self.model.transformer.h:
-            layer.layer.attn.bias = torch.tril(torch.ones((new_num_pos, new_num_pos), dtype=torch.uint8)).view(
-                1, 1, new_num_pos, new_num_pos
-            )
+        # positions of memory tokens and causal masks depend on the backbone, see backbones.py
+        mask_size = self.backbone.wrap_positional_embeddings(num_mem_tokens, num_mem_tokens)
+        if mask_size is None:
+            return
+        mask = torch.tril(torch.ones((mask_size, mask_size), dtype=torch.uint8)).view(1, 1, mask_size, mask_size)
+        for attn in self.backbone.attention_modules():
+            attn.bias = mask
 
     def set_memory(self, input_shape):
         memory = self.memory.repeat(input_shape[0], 1, 1)
@@ -120,15 +115,14 @@ class MemoryCell(torch.nn.Module):
             if 'prev_attn_mask' in seg_kwargs:
                 seg_kwargs.pop('prev_attn_mask')
         if self.wrap_pos:
-
-            num_pos_embs = self.model.transformer.wpe.weight.shape[0]
             seg_kwargs['output_hidden_states'] = True
-            read_ordinary_pos = torch.arange(0, input_ids.size(1) + self.num_mem_tokens, dtype=torch.long, device=input_ids.device)
-            write_pos = torch.arange(num_pos_embs - self.num_mem_tokens, num_pos_embs, dtype=torch.long, device=input_ids.device)
-            seg_kwargs['position_ids'] = torch.cat([
-                read_ordinary_pos, 
-                write_pos
-            ]).long().unsqueeze(0)
+            seg_len = inputs_embeds.size(1) - 2 * self.num_mem_tokens
+            past_key_values = kwargs.get('past_key_values')
+            past_length = past_key_values[0][0].size(-2) if past_key_values is not None else 0
+            position_ids = self.backbone.position_ids(seg_len, self.num_mem_tokens, self.num_mem_tokens,
+                                                      inputs_embeds.device, past_length)
+            if position_ids is not None:
+                seg_kwargs['position_ids'] = position_ids
         return seg_kwargs
     
     def pad_attention_mask(self, attention_mask, shape):
@@ -0,0 +1,88 @@
+import torch
+from torch.utils.checkpoint import checkpoint
+
+
+def chunk_logsumexp(hidden_states, weight, bias=None):
+    logits = hidden_states @ weight.T
+    if bias is not None:
+        logits = logits + bias
+    return torch.logsumexp(logits.float(), dim=-1)
+
+
+def chunked_cross_entropy(hidden_states, weight, labels, bias=None, chunk_size=8192, ignore_index=-100):
+    """Sum of cross-entropy of LM head logits over positions and number of non-ignored labels.
+
+    Logits are computed by vocabulary chunks of `chunk_size` and are never stored: only per-position logsumexp
+    of every chunk is kept, each chunk is recomputed in backward.
+
+    Args:
+        hidden_states: (n, d_model) inputs of LM head
+        weight: (vocab_size, d_model) LM head weight
+        labels: (n,) target tokens
+        bias: optional (vocab_size,) LM head bias
+    """
+    lse = []
+    for start in range(0, weight.size(0), chunk_size):
+        chunk_bias = bias[start:start + chunk_size] if bias is not None else None
+        lse.append(checkpoint(chunk_logsumexp, hidden_states, weight[start:start + chunk_size], chunk_bias,
+                              use_reentrant=False))
+    lse = torch.logsumexp(torch.stack(lse, dim=-1), dim=-1)
+
+    mask = labels != ignore_index
+    targets = labels.masked_fill(~mask, 0)
+    target_logits = (hidden_states * weight[targets]).sum(dim=-1).float()
+    if bias is not None:
+        target_logits = target_logits + bias[targets]
+    return ((lse - target_logits) * mask).sum(), mask.sum()
+
+
+def topk_kl_div(logits, target_ids, target_log_probs):
+    """Sum over positions of KL(teacher || student), teacher distribution is given only by its top-k tokens.
+
+    Teacher log-probs are renormalized over k tokens, student log-probs of these tokens are computed from logits
+    without storing log_softmax over the whole vocabulary.
+
+    Args:
+        logits: (n, vocab_size) student logits
+        target_ids: (n, k) top-k teacher tokens
+        target_log_probs: (n, k) teacher log-probs of target_ids
+    """
+    target_log_probs = target_log_probs.float()
+    target_log_probs = target_log_probs - torch.logsumexp(target_log_probs, dim=-1, keepdim=True)
+    log_probs = logits.gather(-1, target_ids).float() - torch.logsumexp(logits.float(), dim=-1, keepdim=True)
+    return (target_log_probs.exp() * (target_log_probs - log_probs)).sum()
+
+
+def distillation_tile(logits, teacher_logits, labels, mask, ignore_index=-100):
+    log_probs = torch.log_softmax(logits.float(), dim=-1)
+    teacher_log_probs = torch.log_softmax(teacher_logits.float(), dim=-1)
+    kl = (teacher_log_probs.exp() * (teacher_log_probs - log_probs)).sum(dim=-1)
+    labeled = labels != ignore_index
+    target_log_probs = log_probs.gather(-1, labels.masked_fill(~labeled, 0)[:, None])[:, 0]
+    return -(target_log_probs * labeled).sum(), (kl * mask).sum()
+
+
+def distillation_chunk_size(vocab_size, memory_budget_mb):
+    # number of positions in a tile: about four (chunk_size, vocab_size) float32 tensors exist at once
+    return max(1, int(memory_budget_mb * 2 ** 20) // (4 * 4 * vocab_size))
+
+
+def chunked_distillation_loss(logits, teacher_logits, labels, mask, chunk_size=1024, ignore_index=-100):
+    """Sums of cross-entropy and of KL(teacher || student) over positions and number of non-ignored labels.
+
+    Both losses are computed together by tiles of `chunk_size` positions. Log-softmax of student and teacher is
+    stored only for one tile, tiles are recomputed in backward from logits.
+
+    Args:
+        logits: (n, vocab_size) student logits
+        teacher_logits: (n, vocab_size) teacher logits
+        labels: (n,) target tokens, positions with ignore_index are not used in cross-entropy
+        mask: (n,) positions used in KL
+    """
+    ce, kl = 0, 0
+    for start in range(0, logits.size(0), chunk_size):
+        end = start + chunk_size
+        tile_ce, tile_kl = checkpoint(distillation_tile, logits[start:end], teacher_logits[start:end],
+                                      labels[start:end], mask[start:end], ignore_index, use_reentrant=False)
+        ce, kl = ce + tile_ce, kl + tile_kl
+    return ce, kl, (labels != ignore_index).sum()
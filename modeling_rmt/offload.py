@@ -0,0 +1,124 @@
+import weakref
+from contextlib import contextmanager
+
+import torch
+
+
+class OffloadedTensor:
+    __slots__ = ('gpu', 'cpu', 'device', 'seg_num', 'nbytes', '__weakref__')
+
+    def __init__(self, tensor, seg_num):
+        self.gpu = tensor
+        self.cpu = None
+        self.device = tensor.device
+        self.seg_num = seg_num
+        self.nbytes = tensor.numel() * tensor.element_size()
+
+
+class ActivationOffloader:
+    """Moves tensors saved for backward by older segments to pinned host memory.
+
+    with offloader.segment():
+        # forward of one segment
+
+    Tensors saved during the last `keep_last` segments stay on device. In backward, the first unpacked tensor
+    of segment i starts prefetching segment i - 1 on a side stream, so copies overlap with backward of segment i.
+    Parameters and tensors smaller than `min_bytes` are never offloaded. Without CUDA nothing is offloaded and
+    offloaded_bytes stays zero.
+    """
+    def __init__(self, keep_last=1, min_bytes=2 ** 16):
+        self.keep_last = keep_last
+        self.min_bytes = min_bytes
+        self.enabled = torch.cuda.is_available()
+        self.stream = None
+        self.reset()
+
+    def reset(self, params=()):
+        self.seg_num = 0
+        # weak references: saved tensors are owned by the autograd graph and are freed with it
+        self.saved = []
+        self.offloaded_bytes = []
+        self.prefetch_events = {}
+        self.param_ptrs = {p.data_ptr() for p in params}
+
+    @contextmanager
+    def segment(self):
+        self.saved.append({})
+        self.offloaded_bytes.append(0)
+        if self.enabled and self.seg_num >= self.keep_last:
+            self.offload(self.seg_num - self.keep_last)
+        try:
+            if self.enabled:
+                with torch.autograd.graph.saved_tensors_hooks(self.pack, self.unpack):
+                    yield
+            else:
+                yield
+        finally:
+            self.seg_num += 1
+
+    def pack(self, tensor):
+        if not tensor.is_cuda or tensor.numel() * tensor.element_size() < self.min_bytes \
+                or tensor.untyped_storage().data_ptr() in self.param_ptrs:
+            return tensor
+        # the same tensor is often saved by several ops
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        saved = self.saved[self.seg_num].get(key)
+        saved = saved() if saved is not None else None
+        if saved is None:
+            saved = OffloadedTensor(tensor, self.seg_num)
+            self.saved[self.seg_num][key] = weakref.ref(saved)
+        return saved
+
+    def unpack(self, saved):
+        if isinstance(saved, torch.Tensor):
+            return saved
+        self.prefetch(saved.seg_num)
+        if saved.seg_num > 0:
+            self.prefetch(saved.seg_num - 1)
+        if self.prefetch_events[saved.seg_num] is not None:
+            torch.cuda.current_stream(saved.device).wait_event(self.prefetch_events[saved.seg_num])
+            saved.gpu.record_stream(torch.cuda.current_stream(saved.device))
+        return saved.gpu
+
+    def get_stream(self, device):
+        if self.stream is None:
+            self.stream = torch.cuda.Stream(device)
+        return self.stream
+
+    @torch.no_grad()
+    def offload(self, seg_num):
+        for ref in self.saved[seg_num].values():
+            saved = ref()
+            if saved is None or saved.gpu is None:
+                continue
+            stream = self.get_stream(saved.device)
+            stream.wait_stream(torch.cuda.current_stream(saved.device))
+            with torch.cuda.stream(stream):
+                saved.cpu = torch.empty_like(saved.gpu, device='cpu', pin_memory=True)
+                saved.cpu.copy_(saved.gpu, non_blocking=True)
+            # device memory is reused only after the copy is done
+            saved.gpu.record_stream(stream)
+            saved.gpu = None
+            self.offloaded_bytes[seg_num] += saved.nbytes
+
+    @torch.no_grad()
+    def prefetch(self, seg_num):
+        if seg_num in self.prefetch_events:
+            return
+        event = None
+        for ref in self.saved[seg_num].values():
+            saved = ref()
+            if saved is None or saved.cpu is None:
+                continue
+            stream = self.get_stream(saved.device)
+            with torch.cuda.stream(stream):
+                saved.gpu = saved.cpu.to(saved.device, non_blocking=True)
+            saved.cpu = None
+            event = event or torch.cuda.Event()
+        if event is not None:
+            event.record(self.stream)
+        # None: nothing of the segment was offloaded
+        self.prefetch_events[seg_num] = event
+
+    def report(self):
+        return {'offloaded_bytes': list(self.offloaded_bytes), 'total_offloaded_bytes': sum(self.offloaded_bytes)}
@@ -0,0 +1,53 @@
+import math
+from functools import lru_cache
+
+
+@lru_cache(maxsize=256)
+def segment_plan(seq_len, segment_size, alignment=None):
+    """(start, end) of every segment of a sequence of seq_len tokens, cached per shape and alignment.
+
+    center alignment splits the sequence as torch.chunk(tensor, ceil(seq_len / segment_size)).
+    """
+    if seq_len == 0:
+        return ()
+    if alignment in {'left', None}:
+        return tuple((start, min(start + segment_size, seq_len)) for start in range(0, seq_len, segment_size))
+    if alignment == 'right':
+        return tuple((max(end - segment_size, 0), end) for end in range(seq_len, 0, -segment_size))[::-1]
+    if alignment == 'center':
+        chunk_size = math.ceil(seq_len / math.ceil(seq_len / segment_size))
+        return tuple((start, min(start + chunk_size, seq_len)) for start in range(0, seq_len, chunk_size))
+    raise NotImplementedError
+
+
+def uniform_segment_len(plan):
+    # length of segments if all of them have the same length, None otherwise
+    lengths = {end - start for start, end in plan}
+    return lengths.pop() if len(lengths) == 1 else None
+
+
+def split_tensor(tensor, segment_size, alignment=None):
+    """Splits tensor (batch, seq_len, ...) into segments along dim 1.
+
+    If all segments have the same length, tensor is viewed as (batch, n_segs, seg_len, ...) without copying
+    and segments are views of it.
+    """
+    plan = segment_plan(tensor.shape[1], segment_size, alignment)
+    seg_len = uniform_segment_len(plan)
+    if seg_len is not None:
+        return tensor.unflatten(1, (len(plan), seg_len)).unbind(1)
+    return [tensor[:, start:end] for start, end in plan]
+
+
+def segment(segment_size, alignment=None, **kwargs):
+    # list of per-segment dicts of views of tensors in kwargs, all tensors share the same plan
+    segments = []
+    for k, tensor in kwargs.items():
+        if tensor is None:
+            continue
+        for s, k_seg in enumerate(split_tensor(tensor, segment_size, alignment)):
+            if s < len(segments):
+                segments[s][k] = k_seg
+            else:
+                segments.append({k: k_seg})
+    return segments
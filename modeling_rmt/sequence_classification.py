@@ -15,24 +15,29 @@ class RMTEncoderForSequenceClassification(RMTBaseModel):
         segmented = self.pad_and_segment(input_ids)
         if self.num_mem_tokens == 0:
             segmented = segmented[-1:]
+        # all memory rows are the same at start, only segments and labels are reordered
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
+        if labels is not None:
+            kwargs['labels'] = labels[order]
 
         base_model_outputs = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
             
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
             out = self.model(**seg_kwargs)
             base_model_outputs.append(out)
             
-            memory[non_empty_mask] = out.hidden_states[-1][:, self.memory_position]
+            memory[:n] = out.hidden_states[-1][:, self.memory_position]
 
         out = self.process_outputs(base_model_outputs, output_attentions, output_hidden_states)
-        return out
+        return self.restore_outputs_order(out, order)
 
     def pad_add_special_tokens(self, tensor, segment_size):
         input_elements = []
@@ -43,6 +48,10 @@ class RMTEncoderForSequenceClassification(RMTBaseModel):
         if pad_size > 0:
             tensor = F.pad(tensor, (0, pad_size), value=self.pad_token_id)
         return tensor
+
+    def segment_layout(self, add_to='inputs'):
+        prefix = torch.cat([self.cls_token, self.mem_token_ids, self.sep_token])
+        return prefix, self.sep_token, self.pad_token_id
         
 
 import copy
@@ -137,28 +146,32 @@ class RMTEncoderMLMMemLoss(RMTEncoderMemoryLayers):
         segmented = self.pad_and_segment(input_ids)
         if self.num_mem_tokens == 0:
             segmented = segmented[-1:]
+        # all memory rows are the same at start, only segments and labels are reordered
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
+        if labels is not None:
+            kwargs['labels'] = labels[order]
 
         base_model_outputs = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
             
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
             out = self.model(**seg_kwargs)
             
-            memory[non_empty_mask] = out.hidden_states[-1][:, self.memory_position]
+            memory[:n] = out.hidden_states[-1][:, self.memory_position]
 
-            input_ids = torch.stack([s for s in segment_input_ids if s is not None])
-            segment_reconstruction_loss = self.segment_reconstruction_forward(memory[non_empty_mask], input_ids)
+            segment_reconstruction_loss = self.segment_reconstruction_forward(memory[:n], segment_input_ids[:n])
             out['reconstruction_loss'] = segment_reconstruction_loss
             base_model_outputs.append(out)
 
         out = self.process_outputs(base_model_outputs, output_attentions, output_hidden_states)
-        return out
+        return self.restore_outputs_order(out, order)
 
     def process_outputs(self, model_outputs, output_attentions, output_hidden_states):
         rmt_out = model_outputs[-1]
@@ -212,7 +225,7 @@ class RMTEncoderHorizontalMemory(RMTEncoderMemoryLayers):
         self.override_encoder_forward(memory_forward_func)
 
     def set_memory(self, input_shape):
-        self.memory_storage = {}
+        self.memory_storage = {'batch_size': input_shape[0], 'non_empty_mask': slice(None)}
         memory = self.model.embeddings(self.mem_token_ids)
         memory = memory.repeat(input_shape[0], 1, 1)
         
@@ -234,22 +247,27 @@ class RMTEncoderHorizontalMemory(RMTEncoderMemoryLayers):
         segmented = self.pad_and_segment(input_ids)
         if self.num_mem_tokens == 0:
             segmented = segmented[-1:]
+        # all memory rows are the same at start, only segments and labels are reordered
+        order, segmented, segmented_attention_mask, n_non_empty = self.segment_plan(segmented)
+        if labels is not None:
+            kwargs['labels'] = labels[order]
 
         base_model_outputs = []
-        for seg_num, segment_input_ids in enumerate(segmented):                
+        for seg_num, (segment_input_ids, n) in enumerate(zip(segmented, n_non_empty)):
             if self.rmt_config['bptt_depth'] != -1:
                 raise NotImplementedError
 
-            seg_kwargs, non_empty_mask = self.prepare_kwargs(segment_input_ids, kwargs)
-            if sum(non_empty_mask) == 0:
+            if n == 0:
                 continue
-            self.memory_storage['non_empty_mask'] = non_empty_mask
+            seg_kwargs = self.prepare_active_kwargs(segment_input_ids[:n], segmented_attention_mask[seg_num, :n],
+                                                    kwargs)
+            self.memory_storage['non_empty_mask'] = slice(0, n)
             
-            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[non_empty_mask]
+            seg_kwargs['inputs_embeds'][:, self.memory_position] = memory[:n]
             out = self.model(**seg_kwargs)
             base_model_outputs.append(out)
             
-            memory[non_empty_mask] = out.hidden_states[-1][:, self.memory_position]
+            memory[:n] = out.hidden_states[-1][:, self.memory_position]
 
         out = self.process_outputs(base_model_outputs, output_attentions, output_hidden_states)
-        return out
\ No newline at end of file
+        return self.restore_outputs_order(out, order)
\ No newline at end of file
@@ -0,0 +1,58 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+
+class TeacherLogitsStore:
+    """Top-k teacher logits of a static dataset for distillation without teacher forward in the training loop.
+
+    For every position of every sample ids and log-probs of k most probable teacher tokens are kept in memory-mapped
+    .npy files (int32 ids, float16 log-probs), indexed by sample id. Sequences are right-aligned to seq_len: the last
+    stored position is the last token of a sample, as in left-padded batches.
+
+    mode: 'r' - read, 'w' - create new store of (n_samples, seq_len, k), 'r+' - write into existing store
+    """
+    def __init__(self, path, mode='r', n_samples=None, seq_len=None, k=None):
+        self.path = path
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, 'meta.json'), 'w') as fout:
+                json.dump({'n_samples': n_samples, 'seq_len': seq_len, 'k': k}, fout)
+            self.token_ids = np.lib.format.open_memmap(os.path.join(path, 'token_ids.npy'), mode='w+',
+                                                       dtype=np.int32, shape=(n_samples, seq_len, k))
+            self.log_probs = np.lib.format.open_memmap(os.path.join(path, 'log_probs.npy'), mode='w+',
+                                                       dtype=np.float16, shape=(n_samples, seq_len, k))
+        else:
+            with open(os.path.join(path, 'meta.json')) as fin:
+                meta = json.load(fin)
+            n_samples, seq_len, k = meta['n_samples'], meta['seq_len'], meta['k']
+            self.token_ids = np.load(os.path.join(path, 'token_ids.npy'), mmap_mode=mode)
+            self.log_probs = np.load(os.path.join(path, 'log_probs.npy'), mmap_mode=mode)
+        self.n_samples, self.seq_len, self.k = n_samples, seq_len, k
+
+    def __len__(self):
+        return self.n_samples
+
+    @torch.no_grad()
+    def write(self, sample_ids, logits):
+        # logits: (batch, seq_len, vocab_size) of left-padded batch
+        if logits.shape[1] > self.seq_len:
+            raise ValueError(f'Sequences of {logits.shape[1]} tokens do not fit store of {self.seq_len} tokens')
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        log_probs, token_ids = log_probs.topk(self.k, dim=-1)
+        ids = np.asarray(sample_ids)
+        self.token_ids[ids, -logits.shape[1]:] = token_ids.cpu().numpy().astype(np.int32)
+        self.log_probs[ids, -logits.shape[1]:] = log_probs.cpu().numpy().astype(np.float16)
+
+    def flush(self):
+        self.token_ids.flush()
+        self.log_probs.flush()
+
+    def get(self, sample_ids, seq_len):
+        # top-k ids (batch, seq_len, k) and log-probs of seq_len last positions of samples
+        ids = np.asarray(sample_ids)
+        token_ids = torch.from_numpy(self.token_ids[ids, -seq_len:].astype(np.int64))
+        log_probs = torch.from_numpy(self.log_probs[ids, -seq_len:].astype(np.float32))
+        return token_ids, log_probs
@@ -52,11 +52,11 @@ class RMTEncoderForTokenClassification(RMTBaseModel):
     def prepare_kwargs(self, segment, kwargs):
         segment_input_ids, segment_labels, segment_labels_mask = segment
         seg_kwargs = dict(**kwargs)
-        non_empty_mask = [s is not None for s in segment_input_ids]
+        non_empty_mask = self.get_non_empty_mask(segment_input_ids)
         if sum(non_empty_mask) == 0:
             return None, non_empty_mask
 
-        input_ids = torch.stack([s for s in segment_input_ids if s is not None])
+        input_ids = self.select_non_empty(segment_input_ids, non_empty_mask)
         inputs_embeds = self.model.embeddings(input_ids)
 
         seg_kwargs['input_ids'] = None
@@ -66,9 +66,9 @@ class RMTEncoderForTokenClassification(RMTBaseModel):
             seg_kwargs['token_type_ids'] = self.get_token_type_ids(input_ids)
         seg_kwargs['output_hidden_states'] = True
         if seg_kwargs['labels'] is not None:
-            seg_kwargs['labels'] = torch.stack([el for el, m in zip(segment_labels, non_empty_mask) if m])
+            seg_kwargs['labels'] = self.select_non_empty(segment_labels, non_empty_mask)
         if seg_kwargs['labels_mask'] is not None:
-            seg_kwargs['labels_mask'] = torch.stack([el for el, m in zip(segment_labels_mask, non_empty_mask) if m])
+            seg_kwargs['labels_mask'] = self.select_non_empty(segment_labels_mask, non_empty_mask)
         if kwargs['pos_weight'] is not None:
             pos_weight = kwargs['pos_weight']
             # all values in the second dimension of pos_weight should be the same
@@ -129,69 +129,12 @@ class RMTEncoderForTokenClassification(RMTBaseModel):
         return rmt_out
 
     def pad_and_segment(self, input_ids, labels=None, labels_mask=None):
-        segmented_batch = []
-        segmented_batch_labels = []
-        segmented_batch_labels_mask = []
-
-        if labels is None:
-            labels = [None] * input_ids.shape[0]
-        batch_labels = labels
-
-        if labels_mask is None:
-            labels_mask = [None] * input_ids.shape[0]
-        batch_labels_mask = labels_mask
-
-        for seq, labels, labels_mask in zip(input_ids, batch_labels, batch_labels_mask):
-            content_tokens_mask = (seq != self.pad_token_id) & (seq != self.cls_token.item()) & (seq != self.sep_token.item())
-            seq = seq[content_tokens_mask]
-            seq = seq[:self.segment_size * self.rmt_config['max_n_segments']]
-            if labels is not None:
-                labels = labels[content_tokens_mask]
-                labels = labels[:self.segment_size * self.rmt_config['max_n_segments']]
-            if labels_mask is not None:
-                labels_mask = labels_mask[content_tokens_mask]
-                labels_mask = labels_mask[:self.segment_size * self.rmt_config['max_n_segments']]
-
-            # n_seg = math.ceil(len(seq) / self.segment_size)
-            # input_segments = torch.chunk(seq, n_seg)
-            align = self.rmt_config.get('segment_alignment')
-            if align in {'right', None}:
-                split_inds = (list(range(len(seq), 0, -self.segment_size)) + [0])[::-1]
-            elif align == 'left':
-                split_inds = list(range(0, len(seq), self.segment_size)) + [len(seq)]
-            elif align == 'center':
-                n_seg = math.ceil(len(seq) / self.segment_size)
-                split_inds = list(range(0, len(seq), math.ceil(len(seq) / n_seg))) + [len(seq)]
-            else:
-                raise NotImplementedError
-
-            input_segments = [seq[start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-            input_segments = [self.pad_add_special_tokens(t, self.rmt_config['input_size']) for t in input_segments]
-            # add empty segment markers if needed
-            n_empty_segments = self.rmt_config['max_n_segments'] - len(input_segments)
-            input_segments = [None] * n_empty_segments + input_segments
-            segmented_batch.append(input_segments)
-
-            if labels is not None:
-                labels_segments = [labels[start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-                labels_segments = [self.pad_add_special_tokens(t, self.rmt_config['input_size'], add_to='labels') for t in labels_segments]
-                labels_segments = [None] * n_empty_segments + labels_segments
-                segmented_batch_labels.append(labels_segments)
-
-            if labels_mask is not None:
-                labels_mask_segments = [labels_mask[start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-                labels_mask_segments = [self.pad_add_special_tokens(t, self.rmt_config['input_size'], add_to='labels_mask') for t in labels_mask_segments]
-                labels_mask_segments = [None] * n_empty_segments + labels_mask_segments
-                segmented_batch_labels_mask.append(labels_mask_segments)
-
-        segmented_batch = [[sample[seg_num] for sample in segmented_batch]
-                           for seg_num in range(self.rmt_config['max_n_segments'])]
-        segmented_batch_labels = [[sample[seg_num] for sample in segmented_batch_labels]
-                                  for seg_num in range(self.rmt_config['max_n_segments'])]
-        segmented_batch_labels_mask = [[sample[seg_num] for sample in segmented_batch_labels_mask]
-                                       for seg_num in range(self.rmt_config['max_n_segments'])]
-
-        return segmented_batch, segmented_batch_labels, segmented_batch_labels_mask
+        drop_token_ids = [self.pad_token_id, self.cls_token.item(), self.sep_token.item()]
+        segmented, non_empty_mask = self.segment_batch(input_ids, drop_token_ids, labels=labels,
+                                                       labels_mask=labels_mask)
+        n_segments = non_empty_mask.shape[0]
+        return [segmented[k] if segmented[k] is not None else [None] * n_segments
+                for k in ['inputs', 'labels', 'labels_mask']]
 
     def pad_add_special_tokens(self, tensor, segment_size, add_to='inputs'):
         input_elements = []
@@ -217,6 +160,14 @@ class RMTEncoderForTokenClassification(RMTBaseModel):
                 tensor = F.pad(tensor, (0, pad_size), value=0)
         return tensor
 
+    def segment_layout(self, add_to='inputs'):
+        if add_to == 'inputs':
+            prefix = torch.cat([self.cls_token, self.mem_token_ids, self.sep_token])
+            return prefix, self.sep_token, self.pad_token_id
+        # labels and labels_mask are zero for special tokens, labels zeros are broadcasted over label dimension
+        prefix = torch.zeros(self.num_mem_tokens + 2, device=self.mem_token_ids.device)
+        return prefix, prefix[:1], 0
+
 
 class RMTEncoderForMaskedLM(RMTBaseModel):
     def __init__(self, base_model, **rmt_kwargs):
@@ -264,11 +215,11 @@ class RMTEncoderForMaskedLM(RMTBaseModel):
     def prepare_kwargs(self, segment, kwargs):
         segment_input_ids, segment_labels = segment
         seg_kwargs = dict(**kwargs)
-        non_empty_mask = [s is not None for s in segment_input_ids]
+        non_empty_mask = self.get_non_empty_mask(segment_input_ids)
         if sum(non_empty_mask) == 0:
             return None, non_empty_mask
 
-        input_ids = torch.stack([s for s in segment_input_ids if s is not None])
+        input_ids = self.select_non_empty(segment_input_ids, non_empty_mask)
         inputs_embeds = self.model.embeddings(input_ids)
 
         seg_kwargs['input_ids'] = None
@@ -278,7 +229,7 @@ class RMTEncoderForMaskedLM(RMTBaseModel):
             seg_kwargs['token_type_ids'] = self.get_token_type_ids(input_ids)
         seg_kwargs['output_hidden_states'] = True
         if seg_kwargs['labels'] is not None:
-            seg_kwargs['labels'] = torch.stack([el for el, m in zip(segment_labels, non_empty_mask) if m])
+            seg_kwargs['labels'] = self.select_non_empty(segment_labels, non_empty_mask)
 
         return seg_kwargs, non_empty_mask
 
@@ -324,53 +275,10 @@ class RMTEncoderForMaskedLM(RMTBaseModel):
         return rmt_out
 
     def pad_and_segment(self, input_ids, labels=None):
-        segmented_batch = []
-        segmented_batch_labels = []
-
-        if labels is None:
-            labels = [None] * input_ids.shape[0]
-        batch_labels = labels
-
-        for seq, labels in zip(input_ids, batch_labels):
-            content_tokens_mask = (seq != self.pad_token_id) & (seq != self.cls_token.item()) & (seq != self.sep_token.item())
-            seq = seq[content_tokens_mask]
-            seq = seq[:self.segment_size * self.rmt_config['max_n_segments']]
-            if labels is not None:
-                labels = labels[content_tokens_mask]
-                labels = labels[:self.segment_size * self.rmt_config['max_n_segments']]
-
-            # n_seg = math.ceil(len(seq) / self.segment_size)
-            # input_segments = torch.chunk(seq, n_seg)
-            align = self.rmt_config.get('segment_alignment')
-            if align in {'right', None}:
-                split_inds = (list(range(len(seq), 0, -self.segment_size)) + [0])[::-1]
-            elif align == 'left':
-                split_inds = list(range(0, len(seq), self.segment_size)) + [len(seq)]
-            elif align == 'center':
-                n_seg = math.ceil(len(seq) / self.segment_size)
-                split_inds = list(range(0, len(seq), math.ceil(len(seq) / n_seg))) + [len(seq)]
-            else:
-                raise NotImplementedError
-
-            input_segments = [seq[start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-            input_segments = [self.pad_add_special_tokens(t, self.rmt_config['input_size']) for t in input_segments]
-            # add empty segment markers if needed
-            n_empty_segments = self.rmt_config['max_n_segments'] - len(input_segments)
-            input_segments = [None] * n_empty_segments + input_segments
-            segmented_batch.append(input_segments)
-
-            if labels is not None:
-                labels_segments = [labels[start:end] for (start, end) in zip(split_inds, split_inds[1:])]
-                labels_segments = [self.pad_add_special_tokens(t, self.rmt_config['input_size'], add_to='labels') for t in labels_segments]
-                labels_segments = [None] * n_empty_segments + labels_segments
-                segmented_batch_labels.append(labels_segments)
-
-        segmented_batch = [[sample[seg_num] for sample in segmented_batch]
-                           for seg_num in range(self.rmt_config['max_n_segments'])]
-        segmented_batch_labels = [[sample[seg_num] for sample in segmented_batch_labels]
-                                  for seg_num in range(self.rmt_config['max_n_segments'])]
-
-        return segmented_batch, segmented_batch_labels
+        drop_token_ids = [self.pad_token_id, self.cls_token.item(), self.sep_token.item()]
+        segmented, non_empty_mask = self.segment_batch(input_ids, drop_token_ids, labels=labels)
+        n_segments = non_empty_mask.shape[0]
+        return [segmented[k] if segmented[k] is not None else [None] * n_segments for k in ['inputs', 'labels']]
 
     def pad_add_special_tokens(self, tensor, segment_size, add_to='inputs'):
         input_elements = []
@@ -389,3 +297,10 @@ class RMTEncoderForMaskedLM(RMTBaseModel):
         if pad_size > 0:
             tensor = F.pad(tensor, (0, pad_size), value=pad_value)
         return tensor
+
+    def segment_layout(self, add_to='inputs'):
+        if add_to == 'inputs':
+            prefix = torch.cat([self.cls_token, self.mem_token_ids, self.sep_token])
+            return prefix, self.sep_token, self.pad_token_id
+        prefix = torch.full((self.num_mem_tokens + 2,), -100, device=self.mem_token_ids.device)
+        return prefix, prefix[:1], -100
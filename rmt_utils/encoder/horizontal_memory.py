@@ -1,6 +1,30 @@
 import torch
 from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
 
+
+def get_layers_memory(rmt_parent, n_layers, hidden_states):
+    """Memory of all layers, stacked in one (n_layers, batch_size, num_mem_tokens, hidden_size) tensor.
+
+    It is allocated by the first pass of a batch (from set_memory, without memory), which writes the same initial
+    memory for all samples. The following passes prepend it to hidden states and update it in place.
+    """
+    layers_memory = rmt_parent.memory_storage.get('layers')
+    if layers_memory is not None:
+        return layers_memory, True
+    layers_memory = hidden_states.new_empty(n_layers, rmt_parent.memory_storage['batch_size'],
+                                            rmt_parent.num_mem_tokens, hidden_states.shape[-1])
+    rmt_parent.memory_storage['layers'] = layers_memory
+    return layers_memory, False
+
+
+def prepend_layer_memory(rmt_parent, layer_memory, hidden_states):
+    # [memory, hidden_states] are written into one workspace instead of cat of memory rows gathered by mask
+    batch_size, seq_len, hidden_size = hidden_states.shape
+    workspace = hidden_states.new_empty(batch_size, rmt_parent.num_mem_tokens + seq_len, hidden_size)
+    workspace[:, :rmt_parent.num_mem_tokens] = layer_memory[rmt_parent.memory_storage['non_empty_mask']]
+    workspace[:, rmt_parent.num_mem_tokens:] = hidden_states
+    return workspace
+
 def horizontal_memory_forward(
         self,
         hidden_states,
@@ -20,6 +44,10 @@ def horizontal_memory_forward(
     all_cross_attentions = () if output_attentions and self.config.add_cross_attention else None
 
     next_decoder_cache = () if use_cache else None
+    layers_memory, with_memory = get_layers_memory(rmt_parent, len(self.layer), hidden_states)
+    if with_memory and attention_mask is not None:
+        # attention mask of memory tokens is the same for all layers
+        memory_attention_mask = torch.cat((attention_mask[:, :, :, :rmt_parent.num_mem_tokens], attention_mask), dim=-1)
     for i, layer_module in enumerate(self.layer):
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
@@ -48,19 +76,10 @@ def horizontal_memory_forward(
                 encoder_attention_mask,
             )
         else:
-            if i in rmt_parent.memory_storage:
-                layer_memory = rmt_parent.memory_storage[i]
-                non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
-                if layer_memory.shape[0] == 1:
-                    layer_memory = layer_memory.repeat(len(non_empty_mask), 1, 1)
-                    
-                hidden_states = torch.cat([layer_memory[non_empty_mask], hidden_states], dim=1)
-                if attention_mask is not None:
-                    layer_attention_mask = torch.cat((attention_mask[:, :, :, :rmt_parent.num_mem_tokens], attention_mask), dim=-1)
-                else:
-                    layer_attention_mask = attention_mask
+            if with_memory:
+                hidden_states = prepend_layer_memory(rmt_parent, layers_memory[i], hidden_states)
+                layer_attention_mask = memory_attention_mask if attention_mask is not None else attention_mask
             else:
-                layer_memory = None
                 layer_attention_mask = attention_mask
 
             layer_outputs = layer_module(
@@ -89,24 +108,21 @@ def horizontal_memory_forward(
         hidden_states = layer_outputs[0]
         
         ### shorten hidden states
-        if i in rmt_parent.memory_storage:
+        if with_memory:
             hidden_states = hidden_states[:, rmt_parent.num_mem_tokens:]
 
         ### update memory 
         if rmt_parent.memory_layers is not None:
             memory_layer_hidden_states = memory_layer_out[0]
-            if i in rmt_parent.memory_storage:
+            if with_memory:
                 memory_layer_hidden_states = memory_layer_hidden_states[:, rmt_parent.num_mem_tokens:]
 
             updated_memory = memory_layer_hidden_states[:, rmt_parent.memory_position]
             hidden_states[:, rmt_parent.memory_position] = updated_memory
         
         ### set layer memory
-        if layer_memory is not None:
-            layer_memory[non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
-        else:
-            layer_memory = hidden_states[:, rmt_parent.memory_position].detach()
-        rmt_parent.memory_storage[i] = layer_memory
+        non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
+        layers_memory[i, non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
 
         if use_cache:
             next_decoder_cache += (layer_outputs[-1],)
@@ -164,24 +180,18 @@ def deberta_horizontal_memory_forward(
     else:
         next_kv = hidden_states
     rel_embeddings = self.get_rel_embedding()
+    layers_memory, with_memory = get_layers_memory(rmt_parent, len(self.layer), next_kv)
+    if with_memory and attention_mask is not None:
+        memory_attention_mask = torch.cat((attention_mask, attention_mask[:, :, :, :rmt_parent.num_mem_tokens]), dim=-1)
     for i, layer_module in enumerate(self.layer):
 
         if output_hidden_states:
             all_hidden_states = all_hidden_states + (hidden_states,)
 
-        if i in rmt_parent.memory_storage:
-            layer_memory = rmt_parent.memory_storage[i]
-            non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
-            if layer_memory.shape[0] == 1:
-                layer_memory = layer_memory.repeat(len(non_empty_mask), 1, 1)
-                
-            hidden_states = torch.cat([layer_memory[non_empty_mask], hidden_states], dim=1)
-            if attention_mask is not None:
-                layer_attention_mask = torch.cat((attention_mask, attention_mask[:, :, :, :rmt_parent.num_mem_tokens]), dim=-1)
-            else:
-                layer_attention_mask = attention_mask
+        if with_memory:
+            hidden_states = prepend_layer_memory(rmt_parent, layers_memory[i], hidden_states)
+            layer_attention_mask = memory_attention_mask if attention_mask is not None else attention_mask
         else:
-            layer_memory = None
             layer_attention_mask = attention_mask
 
         hidden_states = layer_module(
@@ -210,24 +220,21 @@ def deberta_horizontal_memory_forward(
             memory_layer_out, memory_attentions = memory_layer_out
         
         ### shorten hidden states
-        if i in rmt_parent.memory_storage:
+        if with_memory:
             hidden_states = hidden_states[:, rmt_parent.num_mem_tokens:]
 
         ### update memory 
         if rmt_parent.memory_layers is not None:
             memory_layer_hidden_states = memory_layer_out[0]
-            if i in rmt_parent.memory_storage:
+            if with_memory:
                 memory_layer_hidden_states = memory_layer_hidden_states[:, rmt_parent.num_mem_tokens:]
 
             updated_memory = memory_layer_hidden_states[:, rmt_parent.memory_position]
             hidden_states[:, rmt_parent.memory_position] = updated_memory
         
         ### set layer memory
-        if layer_memory is not None:
-            layer_memory[non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
-        else:
-            layer_memory = hidden_states[:, rmt_parent.memory_position].detach()
-        rmt_parent.memory_storage[i] = layer_memory
+        non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
+        layers_memory[i, non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
 
         if query_states is not None:
             query_states = hidden_states
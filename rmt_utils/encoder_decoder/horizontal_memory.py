@@ -1,5 +1,6 @@
 import torch
 from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
+from rmt_utils.encoder.horizontal_memory import get_layers_memory, prepend_layer_memory
 
 def horizontal_memory_forward(
         self,
@@ -102,6 +103,7 @@ def horizontal_memory_forward(
     encoder_decoder_position_bias = None
 
     hidden_states = self.dropout(inputs_embeds)
+    layers_memory, with_memory = get_layers_memory(rmt_parent, len(self.block), hidden_states)
 
     for i, (layer_module, past_key_value) in enumerate(zip(self.block, past_key_values)):
         layer_head_mask = head_mask[i]
@@ -131,16 +133,10 @@ def horizontal_memory_forward(
             if use_cache:
                 raise NotImplementedError
         else:
-            if i in rmt_parent.memory_storage:
-                layer_memory = rmt_parent.memory_storage[i]
-                non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
-                if layer_memory.shape[0] == 1:
-                    layer_memory = layer_memory.repeat(len(non_empty_mask), 1, 1)
-                
-                hidden_states = torch.cat([layer_memory[non_empty_mask], hidden_states], dim=1)
+            if with_memory:
+                hidden_states = prepend_layer_memory(rmt_parent, layers_memory[i], hidden_states)
                 layer_attention_mask = extended_attention_mask
             else:
-                layer_memory = None
                 layer_attention_mask = extended_attention_mask[:, :, :, rmt_parent.num_mem_tokens:]
                 
             layer_outputs = layer_module(
@@ -179,22 +175,19 @@ def horizontal_memory_forward(
         hidden_states, present_key_value_state = layer_outputs[:2]
         
         #!! shorten hidden states
-        if i in rmt_parent.memory_storage:
+        if with_memory:
             hidden_states = hidden_states[:, memory_len:]
         
         if rmt_parent.memory_layers is not None:
             memory_layer_hidden_states = memory_layer_out[0]
-            if i in rmt_parent.memory_storage:
+            if with_memory:
                 memory_layer_hidden_states = memory_layer_hidden_states[:, memory_len:]
             updated_memory = memory_layer_hidden_states[:, rmt_parent.memory_position]
             
             hidden_states[:, rmt_parent.memory_position] = updated_memory
         
-        if layer_memory is not None:
-            layer_memory[non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
-        else:
-            layer_memory = hidden_states[:, rmt_parent.memory_position].detach()
-        rmt_parent.memory_storage[i] = layer_memory
+        non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
+        layers_memory[i, non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
 
         # We share the position biases between the layers - the first layer store them
         # layer_outputs = hidden-states, key-value-states (self-attention position bias), (self-attention weights),
@@ -347,6 +340,7 @@ def horizontal_memory_forward_1by1(
     encoder_decoder_position_bias = None
 
     hidden_states = self.dropout(inputs_embeds)
+    layers_memory, with_memory = get_layers_memory(rmt_parent, len(self.block), hidden_states)
 
     for i, (layer_module, past_key_value) in enumerate(zip(self.block, past_key_values)):
         layer_head_mask = head_mask[i]
@@ -376,16 +370,10 @@ def horizontal_memory_forward_1by1(
             if use_cache:
                 raise NotImplementedError
         else:
-            if i in rmt_parent.memory_storage:
-                layer_memory = rmt_parent.memory_storage[i]
-                non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
-                if layer_memory.shape[0] == 1:
-                    layer_memory = layer_memory.repeat(len(non_empty_mask), 1, 1)
-                
-                hidden_states = torch.cat([layer_memory[non_empty_mask], hidden_states], dim=1)
+            if with_memory:
+                hidden_states = prepend_layer_memory(rmt_parent, layers_memory[i], hidden_states)
                 layer_attention_mask = extended_attention_mask
             else:
-                layer_memory = None
                 layer_attention_mask = extended_attention_mask[:, :, :, rmt_parent.num_mem_tokens:]
                 
             layer_outputs = layer_module(
@@ -424,22 +412,19 @@ def horizontal_memory_forward_1by1(
         hidden_states, present_key_value_state = layer_outputs[:2]
         
         #!! shorten hidden states
-        if i in rmt_parent.memory_storage:
+        if with_memory:
             hidden_states = hidden_states[:, memory_len:]
         
         if rmt_parent.memory_layers is not None:
             memory_layer_hidden_states = memory_layer_out[0]
-            if i in rmt_parent.memory_storage:
+            if with_memory:
                 memory_layer_hidden_states = memory_layer_hidden_states[:, memory_len:]
             updated_memory = memory_layer_hidden_states[:, rmt_parent.memory_position]
             
             hidden_states[:, rmt_parent.memory_position] = updated_memory
         
-        if layer_memory is not None:
-            layer_memory[non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
-        else:
-            layer_memory = hidden_states[:, rmt_parent.memory_position].detach()
-        rmt_parent.memory_storage[i] = layer_memory
+        non_empty_mask = rmt_parent.memory_storage['non_empty_mask']
+        layers_memory[i, non_empty_mask] = hidden_states[:, rmt_parent.memory_position].detach()
 
         # We share the position biases between the layers - the first layer store them
         # layer_outputs = hidden-states, key-value-states (self-attention position bias), (self-attention weights),
@@ -3,6 +3,7 @@ import logging
 import os
 import math
 import shutil
+import time
 from pathlib import Path
 from itertools import chain
 
@@ -95,6 +96,16 @@ parser.add_argument('--test_size', type=int, default=2000, help='number of sampl
 parser.add_argument('--segment_size', type=int, default=128, help='number of useful tokens in a segment')
 parser.add_argument('--d_mem', type=int, default=None, help='number of rows in associative matrix')
 parser.add_argument('--layers_attr', type=str, default=None, help='attribute of model, which contains layers')
+parser.add_argument('--stacked_memory', action='store_true', default=False,
+                    help='ARMT: keep associative memory of all layers in a single tensor (default: False)')
+parser.add_argument('--feature_map', type=str, default=None,
+                    help='ARMT: feature map for memory keys and queries: dpfp, identity, elu, favor (default: dpfp)')
+parser.add_argument('--memory_storage', type=str, default=None,
+                    help='ARMT: storage of associative memory: dense, mixed, low_rank, int8 (default: dense)')
+parser.add_argument('--memory_rank', type=int, default=None, help='ARMT: rank of memory for low_rank storage')
+parser.add_argument('--assoc_layers', type=str, default=None,
+                    help='ARMT: layers with associative memory: all, every:k, top:n or comma-separated indices '
+                         '(default: all)')
 parser.add_argument('--rewrite_setting', action='store_true', default=False,
                     help='keys can occur several times')
 parser.add_argument('--no_correction', action='store_true', default=False,
@@ -123,6 +134,18 @@ parser.add_argument('--segment_alignment', type=str, default=None, help="How to
 #                     help='whether to use RMT truncated bptt method in backward')
 # parser.add_argument('--k1', type=int, default=-1, help='(not implemented) If not -1, gradient update is done each k1 segments')
 parser.add_argument('--k2', type=int, default=-1, help='number of last segments used by backward')
+parser.add_argument('--segment_checkpointing', action='store_true', default=False,
+                    help='keep only memory states between segments and recompute segments in backward '
+                         '(default: False)')
+parser.add_argument('--offload_activations', action='store_true', default=False,
+                    help='move activations of older segments to pinned host memory until backward (default: False)')
+parser.add_argument('--output_policy', type=str, default='full',
+                    help='outputs of recurrent wrapper: full, last_segment (logits of the last segment) or loss '
+                         '(default: full)')
+parser.add_argument('--masked_lm_head', action='store_true', default=False,
+                    help='apply LM head only to positions used in loss, wrapper returns only loss (default: False)')
+parser.add_argument('--compile_segment_step', action='store_true', default=False,
+                    help='run memory cell on every segment with torch.compile (default: False)')
 parser.add_argument('--freeze_model_weights', action='store_true', default=False,
                     help='Stop training all model weights except memory layers')
 parser.add_argument('--backbone_cpt', type=str, default=None, help='backbone model checkpoint path')
@@ -416,6 +439,16 @@ if __name__ == '__main__':
 
         if args.no_correction:
             mem_cell_args['correction'] = False
+        if args.stacked_memory:
+            mem_cell_args['stacked_memory'] = True
+        if args.feature_map is not None:
+            mem_cell_args['feature_map'] = args.feature_map
+        if args.memory_storage is not None:
+            mem_cell_args['memory_storage'] = args.memory_storage
+        if args.memory_rank is not None:
+            mem_cell_args['memory_storage_kwargs'] = {'rank': args.memory_rank}
+        if args.assoc_layers is not None:
+            mem_cell_args['assoc_layers'] = args.assoc_layers
 
         cell = memory_cell_cls(**mem_cell_args)
         model = recurrent_wrapper_cls(cell, 
@@ -423,7 +456,12 @@ if __name__ == '__main__':
                                       max_n_segments=args.max_n_segments, 
                                     #   vary_n_segments=args.vary_n_segments,
                                       k2=args.k2,
-                                      segment_alignment=args.segment_alignment
+                                      segment_alignment=args.segment_alignment,
+                                      segment_checkpointing=args.segment_checkpointing,
+                                      offload_activations=args.offload_activations,
+                                      output_policy=args.output_policy,
+                                      masked_lm_head=args.masked_lm_head,
+                                      compile_segment_step=args.compile_segment_step
         )
                                     
 
@@ -594,7 +632,12 @@ if __name__ == '__main__':
         # trainer.validate(train_dataloader, split='train', write_tb=True)
         if valid_dataloader is not None:
             logger.info('Running validation on valid data:')
+            n_tokens = sum(batch['attention_mask'].sum().item() for batch in valid_dataloader)
+            start_time = time.time()
             trainer.validate(valid_dataloader, write_tb=True, split='valid')
+            trainer.metrics['valid']['tokens_per_sec'] = n_tokens / (time.time() - start_time)
+            logger.info(f"Validation on valid tokens/sec: {trainer.metrics['valid']['tokens_per_sec']:.1f}")
+            trainer.save_metrics(save_path=args.model_path)
         else:
             raise "No valid dataset"
         # if test_dataloader is not None:
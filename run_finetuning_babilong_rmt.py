@@ -4,6 +4,7 @@ import os
 import math
 import random
 import shutil
+import time
 from pathlib import Path
 from itertools import chain
 
@@ -102,16 +103,40 @@ parser.add_argument('--max_n_segments', type=int, default=1, help='maximal segme
 parser.add_argument('--vary_n_segments', action='store_true', default=False, help='randomly sample input size for each batch')
 
 parser.add_argument('--first_seg_len', type=int, default=None, help='parameter for mamba')
+parser.add_argument('--ragged_segments', action='store_true', default=False,
+                    help='RMT/ARMT: skip padding segments of short samples in a batch (default: False)')
 parser.add_argument('--mixed_length_ratio', type=float, default=0.0, help='used for mixed length curriculum. '
                     'r > 0.0 means that we will start to sample batches with lengths <= max_n_segments')
 parser.add_argument('--bptt_depth', type=int, default=-1, help='max number of previous segments in gradient computation.')
 parser.add_argument('--segment_alignment', type=str, help='way of aligning segments, one of right, left, center', default=None)
 parser.add_argument('--k2', type=int, default=-1, help='number of last segments used by backward')
+parser.add_argument('--segment_checkpointing', action='store_true', default=False,
+                    help='keep only memory states between segments and recompute segments in backward '
+                         '(default: False)')
+parser.add_argument('--offload_activations', action='store_true', default=False,
+                    help='move activations of older segments to pinned host memory until backward (default: False)')
+parser.add_argument('--output_policy', type=str, default='full',
+                    help='outputs of recurrent wrapper: full, last_segment (logits of the last segment) or loss '
+                         '(default: full)')
+parser.add_argument('--masked_lm_head', action='store_true', default=False,
+                    help='apply LM head only to positions used in loss, wrapper returns only loss (default: False)')
+parser.add_argument('--compile_segment_step', action='store_true', default=False,
+                    help='run memory cell on every segment with torch.compile (default: False)')
 parser.add_argument('--freeze_model_weights', action='store_true', default=False,
                     help='Stop training all model weights except memory layers')
 parser.add_argument('--backbone_cpt', type=str, default=None, help='backbone model checkpoint path')
 parser.add_argument('--d_mem', type=int, default=None, help='number of rows in associative matrix')
 parser.add_argument('--layers_attr', type=str, default=None, help='attribute of model, which contains layers')
+parser.add_argument('--stacked_memory', action='store_true', default=False,
+                    help='ARMT: keep associative memory of all layers in a single tensor (default: False)')
+parser.add_argument('--feature_map', type=str, default=None,
+                    help='ARMT: feature map for memory keys and queries: dpfp, identity, elu, favor (default: dpfp)')
+parser.add_argument('--memory_storage', type=str, default=None,
+                    help='ARMT: storage of associative memory: dense, mixed, low_rank, int8 (default: dense)')
+parser.add_argument('--memory_rank', type=int, default=None, help='ARMT: rank of memory for low_rank storage')
+parser.add_argument('--assoc_layers', type=str, default=None,
+                    help='ARMT: layers with associative memory: all, every:k, top:n or comma-separated indices '
+                         '(default: all)')
 parser.add_argument('--wrap_pos', action='store_true', default=False,
                     help='Wrap positional encoding for memory tokens (default: False)')
 parser.add_argument('--desired_metric', type=float, default=1.0, help='metric to stop training')
@@ -365,6 +390,16 @@ if __name__ == '__main__':
         
         if args.layers_attr is not None:
             mem_cell_args['layers_attr'] = args.layers_attr
+        if args.stacked_memory:
+            mem_cell_args['stacked_memory'] = True
+        if args.feature_map is not None:
+            mem_cell_args['feature_map'] = args.feature_map
+        if args.memory_storage is not None:
+            mem_cell_args['memory_storage'] = args.memory_storage
+        if args.memory_rank is not None:
+            mem_cell_args['memory_storage_kwargs'] = {'rank': args.memory_rank}
+        if args.assoc_layers is not None:
+            mem_cell_args['assoc_layers'] = args.assoc_layers
         cell = memory_cell_cls(**mem_cell_args)
         if args.segment_alignment not in {None, 'left'}:
             logger.info(f"Using custom segment alignment: {args.segment_alignment}")
@@ -378,8 +413,15 @@ if __name__ == '__main__':
             max_n_segments=max_n_segments, 
             segment_alignment=args.segment_alignment,
             k2=args.k2,
-            first_seg_len=args.first_seg_len
+            first_seg_len=args.first_seg_len,
+            segment_checkpointing=args.segment_checkpointing,
+            offload_activations=args.offload_activations,
+            output_policy=args.output_policy,
+            masked_lm_head=args.masked_lm_head,
+            compile_segment_step=args.compile_segment_step
         )
+        if args.ragged_segments:
+            rec_wrap_args['ragged'] = True
         model = recurrent_wrapper_cls(cell, **rec_wrap_args)
                                     
 
@@ -561,4 +603,9 @@ if __name__ == '__main__':
         #     trainer.validate(valid_dataloader, write_tb=True, split='valid')
         if test_dataloader is not None:
             logger.info('Runnning validation on test data:')
+            n_tokens = sum(batch['attention_mask'].sum().item() for batch in test_dataloader)
+            start_time = time.time()
             trainer.validate(test_dataloader, split='test')
+            trainer.metrics['test']['tokens_per_sec'] = n_tokens / (time.time() - start_time)
+            logger.info(f"Validation on test tokens/sec: {trainer.metrics['test']['tokens_per_sec']:.1f}")
+            trainer.save_metrics(save_path=args.model_path)
@@ -18,6 +18,7 @@ from lm_experiments_tools import Trainer, TrainerArgs
 from torch.nn.utils.rnn import pad_sequence
 
 import accelerate
+import sys
 
 from baselines.rwkv.RWKV_v5.src.dataflow.trie_tokenizer import MT_TRIE_TOKENIZER
 # load_dotenv()
@@ -40,6 +41,7 @@ from transformers import AutoConfig, AutoTokenizer, HfArgumentParser  # noqa: E4
 from peft import LoraConfig, TaskType, get_peft_model
 
 from lm_experiments_tools.utils import get_cls_by_name, get_optimizer, prepare_run  # noqa: E402
+from modeling_rmt.teacher_cache import TeacherLogitsStore  # noqa: E402
 
 # limit # of CPU threads to be used per pytorch worker, otherwise it might use all cpus and throttle gpus
 # > 2 fails cause of https://github.com/pytorch/pytorch/issues/56615
@@ -85,6 +87,15 @@ parser.add_argument('--model_type', type=str, default='encoder-decoder',
                          '(default: encoder-decoder)')
 
 parser.add_argument('--alpha_distil', type=float, default=None, help='')
+parser.add_argument('--teacher_cache', type=str, default=None,
+                    help='path to top-k teacher logits of train samples, if set teacher is not run during training. '
+                         'Logits are computed on the whole train sample, so inputs can not be cropped '
+                         '(no --vary_n_segments)')
+parser.add_argument('--teacher_cache_build', action='store_true', default=False,
+                    help='run teacher over train samples, write top-k logits to --teacher_cache and exit')
+parser.add_argument('--teacher_cache_topk', type=int, default=32, help='number of teacher logits kept per position')
+parser.add_argument('--distil_memory_budget_mb', type=float, default=None,
+                    help='compute CE and KL by tiles of positions, log-softmax of a tile takes about this memory')
 
 # Aydar # RMT args
 parser.add_argument('--input_size', type=int, default=None, help='maximal input size of the backbone model')
@@ -162,6 +173,11 @@ if __name__ == '__main__':
     if args.model_path is None:
         logger.warning('model_path is not set: config, logs and checkpoints will not be saved.')
 
+    if args.teacher_cache is not None and not args.teacher_cache_build and args.vary_n_segments:
+        # student would see a cropped suffix of a sample, while its KL target is conditioned on the whole sample
+        raise ValueError('--teacher_cache can not be used with --vary_n_segments: cached teacher logits are '
+                         'computed on the whole input_seq_len context')
+
     # # create model path and save configuration
     # # todo: use prepare run
     # if accelerator.is_main_process and args.model_path is not None:
@@ -249,6 +265,23 @@ if __name__ == '__main__':
         return result
 
     id_pad_value = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+
+    teacher_store = None
+    if args.teacher_cache is not None and not args.teacher_cache_build:
+        teacher_store = TeacherLogitsStore(args.teacher_cache)
+
+    def add_teacher_topk(collated, batch):
+        # top-k teacher logits from teacher_store, they are segmented with the other collated tensors
+        # (random_segment_size splits the same tokens into segments, the student still sees the whole sample)
+        if teacher_store is None or 'sample_id' not in batch[0]:
+            return
+        sample_ids = [b['sample_id'] for b in batch]
+        seq_len = collated['input_ids'].shape[1]
+        if seq_len != teacher_store.seq_len:
+            raise ValueError(f'teacher logits are cached for {teacher_store.seq_len} tokens of context, but batch '
+                             f'has {seq_len} tokens: KL targets would be conditioned on a different context')
+        collated['teacher_topk_ids'], collated['teacher_topk_log_probs'] = teacher_store.get(sample_ids, seq_len)
+
     if args.sliding_window:
         def collate_fn(batch):
             input_ids = [torch.tensor(b['input_ids']) for b in batch]
@@ -267,6 +300,8 @@ if __name__ == '__main__':
             collated = {'input_ids': input_ids,
                         'labels': labels, 
                         'attention_mask': attention_mask}
+            # train samples have the same length, so teacher logits are aligned with right-padded inputs too
+            add_teacher_topk(collated, batch)
 
             if input_ids.shape[1] != block_size:
                 # take only labels for last block (maybe use all labels during training?)
@@ -294,6 +329,8 @@ if __name__ == '__main__':
             collated = {'input_ids': input_ids,
                         'labels': labels, 
                         'attention_mask': attention_mask}
+            if not valid:
+                add_teacher_topk(collated, batch)
 
             if input_ids.shape[1] != block_size:
                 labels_mask = torch.ones_like(input_ids, dtype=bool)
@@ -332,7 +369,40 @@ if __name__ == '__main__':
         train_dataset = tokenized_datasets["train"].map(lambda x: group_texts(x, block_size, history_size),
                                                         batched=True, desc=f"Grouping train in chunks of {block_size} and history {history_size}")
         valid_dataset = Dataset.from_dict(group_texts(tokenized_datasets['validation'].to_dict(), block_size, val_history_size))
+        if args.teacher_cache is not None:
+            train_dataset = train_dataset.map(lambda x, ids: {'sample_id': ids}, with_indices=True, batched=True)
     kwargs = {'pin_memory': True, 'num_workers': args.data_n_workers}
+
+    if args.teacher_cache_build:
+        # offline teacher pass, train samples are split between processes and written to one store
+        if accelerator.is_main_process:
+            TeacherLogitsStore(args.teacher_cache, mode='w', n_samples=len(train_dataset),
+                               seq_len=args.input_seq_len, k=args.teacher_cache_topk)
+        accelerator.wait_for_everyone()
+        teacher_store = TeacherLogitsStore(args.teacher_cache, mode='r+')
+        teacher = get_cls_by_name(args.teacher_cls).from_pretrained(args.pretrained_teacher)
+        teacher = teacher.to(accelerator.device).eval()
+
+        def cache_collate_fn(batch):
+            input_ids = [torch.tensor(b['input_ids'][::-1]) for b in batch]
+            attention_mask = [torch.tensor(b['attention_mask'][::-1]) for b in batch]
+            return {'sample_id': [b['sample_id'] for b in batch],
+                    'input_ids': pad_sequence(input_ids, padding_value=id_pad_value).T.flip(1),
+                    'attention_mask': pad_sequence(attention_mask, padding_value=0).T.flip(1)}
+
+        shard = train_dataset.shard(accelerator.num_processes, accelerator.process_index, contiguous=True)
+        cache_dataloader = DataLoader(shard, batch_size=args.batch_size, collate_fn=cache_collate_fn, **kwargs)
+        logger.info(f'writing top-{args.teacher_cache_topk} teacher logits of {len(shard)} samples '
+                    f'to {args.teacher_cache}')
+        with torch.no_grad():
+            for batch in cache_dataloader:
+                teacher_out = teacher(input_ids=batch['input_ids'].to(accelerator.device),
+                                      attention_mask=batch['attention_mask'].to(accelerator.device))
+                teacher_store.write(batch['sample_id'], teacher_out.logits)
+        teacher_store.flush()
+        accelerator.wait_for_everyone()
+        logger.info('teacher cache is done')
+        sys.exit(0)
     # shuffle train data each epoch (one loop over train_dataset)
     per_worker_batch_size = args.batch_size * args.gradient_accumulation_steps
     train_rnd_generator = torch.Generator()
@@ -449,9 +519,12 @@ if __name__ == '__main__':
         )
 
         if args.distillator_cls is not None:
-            teacher_cls = get_cls_by_name(args.teacher_cls)
-            teacher = teacher_cls.from_pretrained(args.pretrained_teacher)
-            model = distillator(teacher, model, alpha_distil=args.alpha_distil)             
+            teacher = None
+            if teacher_store is None:
+                teacher_cls = get_cls_by_name(args.teacher_cls)
+                teacher = teacher_cls.from_pretrained(args.pretrained_teacher)
+            model = distillator(teacher, model, alpha_distil=args.alpha_distil,
+                                memory_budget_mb=args.distil_memory_budget_mb)             
 
         ## load cpt of rmt
         if args.model_cpt and args.model_cpt != 'None':
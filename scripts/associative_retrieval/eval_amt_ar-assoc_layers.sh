@@ -0,0 +1,66 @@
+#!/usr/bin/env bash
+# evaluates trained ARMT on associative retrieval with associative memory only in a subset of layers
+# exact_match and tokens_per_sec for every schedule are saved to MODEL_CPT/assoc_layers/<schedule>/metrics.json
+# weights of associative memory in unused layers are dropped when checkpoint is loaded
+
+export WANDB_PROJECT=associative_retrieval
+export CUDA_VISIBLE_DEVICES=0
+NP=1
+# set -e
+cd ../..
+
+MODEL_TYPE=decoder
+MEMORY_CELL=modeling_amt.language_modeling:AssociativeMemoryCell
+RECURRENT_WRAPPER=modeling_amt.language_modeling:AssociativeRecurrentWrapper
+BACKBONE_CLS=base_models.modeling_gpt_neox:GPTNeoXForCausalLM
+TASK_NAME=associative_retrieval_v3
+METRIC=exact_match
+
+MEMORY_SIZE=4
+KEY_SIZE=2
+VALUE_SIZE=1
+NUM_PAIRS=50
+D_MEM=32
+MAX_N_SEGMENTS=$((NUM_PAIRS + 1))
+BLOCK_SIZE=$((KEY_SIZE + VALUE_SIZE + 2))
+BS=64
+DIM=128
+NUM_LAYERS=4
+
+MODEL_CFG=/home/rodkin/rmt/wip/base_models/gptconfigs/neox_tiny_${NUM_LAYERS}l${NUM_LAYERS}hd${DIM}.json
+MODEL_CPT=../runs/${TASK_NAME}/amt/lr3e-04_linear_adamw_wd1e-03_k${KEY_SIZE}-v${VALUE_SIZE}-p${NUM_PAIRS}-${MAX_N_SEGMENTS}x2048_mem${MEMORY_SIZE}_bs256_regular_bptt-${MAX_N_SEGMENTS}_${NUM_LAYERS}l${NUM_LAYERS}hd${DIM}/run_1
+ACCEL_CONFIG=./accel_configs/accelerate.yaml
+
+# all, every k-th layer from the top, top n layers or list of layers
+for ASSOC_LAYERS in all every:2 top:2 top:1 0,3
+do
+
+echo RUNNING: TASK_NAME ASSOC_LAYERS
+echo RUNNING: $TASK_NAME $ASSOC_LAYERS
+accelerate launch --config_file $ACCEL_CONFIG --num_processes $NP --main_process_port 29573 run_finetuning_associative_retrieval.py \
+        --task_name $TASK_NAME \
+        --model_path ${MODEL_CPT}/assoc_layers/${ASSOC_LAYERS/:/} \
+        --model_cpt $MODEL_CPT \
+        --validate_only \
+        --model_cfg $MODEL_CFG \
+        --model_cls $BACKBONE_CLS \
+        --model_type $MODEL_TYPE \
+        --memory_cell_cls $MEMORY_CELL \
+        --recurrent_wrapper_cls $RECURRENT_WRAPPER \
+        --segment_size $BLOCK_SIZE \
+        --key_size $KEY_SIZE \
+        --value_size $VALUE_SIZE \
+        --num_pairs $NUM_PAIRS \
+        --num_mem_tokens $MEMORY_SIZE \
+        --max_n_segments $MAX_N_SEGMENTS\
+        --use_generate_on_valid \
+        --batch_size $BS \
+        --data_n_workers 2 \
+        --optimize_metric $METRIC --optimize_mode max \
+        --dataset_path /home/rodkin/rmt/datasets/associative_retrieval \
+        --d_mem $D_MEM \
+        --layers_attr gpt_neox.layers \
+        --assoc_layers $ASSOC_LAYERS \
+        --valid_size 1000
+done
+echo "done"
@@ -0,0 +1,65 @@
+#!/usr/bin/env bash
+# evaluates trained ARMT on babilong with associative memory only in a subset of layers
+# exact_match and tokens_per_sec for every schedule are saved to MODEL_CPT/assoc_layers/<schedule>/metrics.json
+
+export WANDB_PROJECT=babilong
+export CUDA_VISIBLE_DEVICES=0
+NP=1
+# set -e
+cd ../..
+
+CUBLAS_WORKSPACE_CONFIG=:4096:2
+
+MODEL_TYPE=decoder
+MEMORY_CELL=modeling_amt.language_modeling:AssociativeMemoryCell
+RECURRENT_WRAPPER=modeling_amt.language_modeling:AssociativeRecurrentWrapper
+BACKBONE_CLS=transformers:AutoModelForCausalLM
+TASK_DATASET=qa1_single-supporting-fact
+NOISE_DATASET=pg19
+METRIC=exact_match
+
+MODEL_NAME=gpt2  # backbone model
+SEGMENT_SIZE=512 # size of one segment in tokens
+MEMORY_SIZE=10
+MAX_N_SEGMENTS=32
+D_MEM=64
+BS=1
+K2=-1
+
+SAMPLE_SIZE=$(($SEGMENT_SIZE*$MAX_N_SEGMENTS)) # length of task sample in tokens
+ACCEL_CONFIG=./accel_configs/accelerate.yaml
+MODEL_CPT=/home/jovyan/armt/runs/babilong/${TASK_DATASET}/amt/$MODEL_NAME/lr1e-04_linear_adamw_wd1e-03_${MAX_N_SEGMENTS}x${SEGMENT_SIZE}_mem${MEMORY_SIZE}_bs64_bptt-${K2}/run_1
+
+# all, every k-th layer from the top, top n layers or list of layers
+for ASSOC_LAYERS in all every:2 every:3 top:6 top:3 top:1
+do
+
+echo RUNNING: TASK_DATASET $TASK_DATASET ASSOC_LAYERS $ASSOC_LAYERS
+echo SAMPLE_SIZE $SAMPLE_SIZE MODEL_NAME $MODEL_NAME
+
+accelerate launch --config_file $ACCEL_CONFIG --num_processes $NP --main_process_port 29711 run_finetuning_babilong_rmt.py \
+        --task_dataset $TASK_DATASET \
+        --noise_dataset $NOISE_DATASET \
+        --babi_path /home/jovyan/rmt/babilong/data/tasks_1-20_v1-2/en-10k \
+        --model_path ${MODEL_CPT}/assoc_layers/${ASSOC_LAYERS/:/} \
+        --from_pretrained $MODEL_NAME \
+        --model_type $MODEL_TYPE \
+        --memory_cell_cls $MEMORY_CELL \
+        --recurrent_wrapper_cls $RECURRENT_WRAPPER \
+        --model_cls $BACKBONE_CLS \
+        --segment_size $SEGMENT_SIZE \
+        --sample_size $SAMPLE_SIZE \
+        --num_mem_tokens $MEMORY_SIZE \
+        --max_n_segments $MAX_N_SEGMENTS\
+        --batch_size $BS \
+        --k2 $K2 \
+        --data_n_workers 2 \
+        --optimize_metric $METRIC --optimize_mode max \
+        --seed 42 \
+        --d_mem $D_MEM \
+        --assoc_layers $ASSOC_LAYERS \
+        --model_cpt $MODEL_CPT \
+        --use_generate_on_valid \
+        --validate_only
+done
+echo "done"
@@ -0,0 +1,40 @@
+import pytest
+import torch
+from transformers import GPT2Config, GPT2LMHeadModel
+
+from modeling_amt.language_modeling import AssociativeMemoryCell, AssociativeRecurrentWrapper
+from modeling_rmt.language_modeling import MemoryCell, RecurrentWrapper
+
+SEGMENT_SIZE, N_SEGMENTS = 8, 3
+
+
+def build_wrapper(kind, output_policy):
+    torch.manual_seed(0)
+    config = GPT2Config(n_layer=2, n_embd=32, n_head=2, vocab_size=100, n_positions=256)
+    model = GPT2LMHeadModel(config)
+    if kind == 'rmt':
+        cell, wrapper_cls = MemoryCell(model, num_mem_tokens=4), RecurrentWrapper
+    else:
+        cell, wrapper_cls = AssociativeMemoryCell(model, num_mem_tokens=4, d_mem=8), AssociativeRecurrentWrapper
+    return wrapper_cls(cell, segment_size=SEGMENT_SIZE, max_n_segments=N_SEGMENTS, output_policy=output_policy).eval()
+
+
+@pytest.mark.parametrize('kind', ['rmt', 'armt'])
+@pytest.mark.parametrize('output_policy', ['full', 'last_segment'])
+def test_compiled_segment_step_returns_hidden_states(kind, output_policy, monkeypatch):
+    # segment_step is run as is: the test checks which inputs reach the (compiled) step, not the compiler
+    monkeypatch.setattr(torch, 'compile', lambda fn, **kwargs: fn)
+    wrapper = build_wrapper(kind, output_policy)
+    input_ids = torch.randint(0, 100, (2, SEGMENT_SIZE * N_SEGMENTS))
+    attention_mask = torch.ones_like(input_ids)
+
+    with torch.no_grad():
+        out = wrapper(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+        wrapper.rmt_config['compile_segment_step'] = True
+        compiled_out = wrapper(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+
+    assert compiled_out['hidden_states'] is not None
+    assert len(compiled_out['hidden_states']) == len(out['hidden_states'])
+    for hs, compiled_hs in zip(out['hidden_states'], compiled_out['hidden_states']):
+        torch.testing.assert_close(compiled_hs, hs)
+    torch.testing.assert_close(compiled_out['logits'], out['logits'])
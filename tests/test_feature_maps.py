@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+from modeling_amt.feature_maps import get_feature_map
+from modeling_amt.language_modeling import dpfp
+
+
+@pytest.mark.parametrize('d_mem', [1, 4, 16, 64])
+@pytest.mark.parametrize('nu', [1, 2, 3, 5])
+def test_dpfp_matches_cat_formula(d_mem, nu):
+    # gather-index DPFP vs cat([x2 * x2.roll(j) for j in 1..nu]) of the previous implementation
+    torch.manual_seed(0)
+    x = torch.randn(2, 7, d_mem, requires_grad=True)
+    x_ref = x.detach().clone().requires_grad_(True)
+    phi = get_feature_map('dpfp', d_mem, nu=nu)
+
+    out, out_ref = phi(x), dpfp(x_ref, nu=nu)
+    assert out.shape == (2, 7, phi.d_key)
+    torch.testing.assert_close(out, out_ref)
+
+    grad = torch.randn_like(out)
+    out.backward(grad)
+    out_ref.backward(grad)
+    torch.testing.assert_close(x.grad, x_ref.grad)
+
+
+@pytest.mark.parametrize('dtype', [torch.float16, torch.bfloat16])
+def test_dpfp_matches_cat_formula_low_precision(dtype):
+    torch.manual_seed(0)
+    x = torch.randn(3, 5, 32).to(dtype)
+    phi = get_feature_map('dpfp', 32, nu=3)
+    out = phi(x)
+    assert out.dtype == dtype
+    torch.testing.assert_close(out, dpfp(x, nu=3))
@@ -0,0 +1,61 @@
+import pytest
+import torch
+from torch.nn import CrossEntropyLoss
+from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
+
+from modeling_rmt.language_modeling import Distillator
+
+BATCH_SIZE, SEQ_LEN, VOCAB_SIZE = 2, 7, 64
+
+
+def student_ce(logits, labels, labels_mask):
+    # CE as computed by memory cells (MemoryCell.process_output)
+    flat_logits = logits[..., :-1, :].reshape(-1, logits.size(-1))
+    flat_labels = labels[..., 1:].reshape(-1)
+    if labels_mask is not None:
+        flat_mask = labels_mask[..., :-1].reshape(-1)
+        flat_logits, flat_labels = flat_logits[flat_mask], flat_labels[flat_mask]
+    return CrossEntropyLoss()(flat_logits, flat_labels)
+
+
+def distillation_loss(logits, teacher_logits, labels, labels_mask, memory_budget_mb):
+    distillator = Distillator(None, None, alpha_distil=0.3, memory_budget_mb=memory_budget_mb).train()
+    student_output = CausalLMOutputWithCrossAttentions(logits=logits)
+    if memory_budget_mb is None:
+        student_output['loss'] = student_ce(logits, labels, labels_mask)
+    out = distillator.process_outputs({'logits': teacher_logits}, student_output, labels=labels,
+                                      labels_mask=labels_mask)
+    grad, = torch.autograd.grad(out['loss'], logits)
+    return out, grad
+
+
+def make_labels_mask(kind):
+    if kind is None:
+        return None
+    labels_mask = torch.zeros(BATCH_SIZE, SEQ_LEN, dtype=torch.bool)
+    labels_mask[0, 2:] = True
+    labels_mask[1, -3:] = True
+    return labels_mask
+
+
+@pytest.mark.parametrize('labels_mask_kind', [None, 'partial'])
+@pytest.mark.parametrize('ignore_labels', [False, True])
+@pytest.mark.parametrize('chunk_size', [1, 3, 5, BATCH_SIZE * SEQ_LEN, 100])
+def test_fused_distillation_loss_matches_unfused(labels_mask_kind, ignore_labels, chunk_size):
+    torch.manual_seed(0)
+    logits = torch.randn(BATCH_SIZE, SEQ_LEN, VOCAB_SIZE, requires_grad=True)
+    teacher_logits = torch.randn(BATCH_SIZE, SEQ_LEN, VOCAB_SIZE)
+    labels = torch.randint(0, VOCAB_SIZE, (BATCH_SIZE, SEQ_LEN))
+    if ignore_labels:
+        labels[0, 4] = -100
+        labels[1, -2] = -100
+    labels_mask = make_labels_mask(labels_mask_kind)
+    # budget of exactly chunk_size positions, see distillation_chunk_size
+    memory_budget_mb = chunk_size * 4 * 4 * VOCAB_SIZE / 2 ** 20
+
+    out, grad = distillation_loss(logits, teacher_logits, labels, labels_mask, None)
+    fused_out, fused_grad = distillation_loss(logits, teacher_logits, labels, labels_mask, memory_budget_mb)
+
+    for key in ['ce_loss', 'dist', 'loss']:
+        torch.testing.assert_close(fused_out[key], out[key])
+    torch.testing.assert_close(fused_grad, grad)
@@ -0,0 +1,124 @@
+import pytest
+import torch
+
+from memory_store import ALIGNMENT, MemorySnapshotStore, load_memory_snapshot, read_header, save_memory_snapshot
+from modeling_amt.memory_storage import MEMORY_STORAGES, get_memory_storage
+
+SHAPE = (2, 6, 5)  # (batch, d_key, d_model)
+STORAGE_KWARGS = {'mixed': {'read_dtype': 'bfloat16'}, 'low_rank': {'rank': 3}}
+
+
+def assert_state_equal(loaded, state):
+    if isinstance(state, torch.Tensor):
+        assert loaded.dtype == state.dtype
+        assert torch.equal(loaded, state)
+    elif isinstance(state, dict):
+        assert loaded.keys() == state.keys()
+        for k in state:
+            assert_state_equal(loaded[k], state[k])
+    elif isinstance(state, (list, tuple)):
+        assert len(loaded) == len(state)
+        for loaded_v, v in zip(loaded, state):
+            assert_state_equal(loaded_v, v)
+    else:
+        assert loaded == state
+
+
+def armt_layer_state(storage_name, z_dtype=torch.float32):
+    # memory state of one AssociativeLayerWrapper after a segment: storage state, z and first_seg
+    storage = get_memory_storage(storage_name, SHAPE, **STORAGE_KWARGS.get(storage_name, {}))
+    keys, values = torch.randn(SHAPE[0], 4, SHAPE[1]), torch.randn(SHAPE[0], 4, SHAPE[2])
+    storage.add(keys, values)
+    return dict(**storage.get_state(), z=torch.randn(SHAPE[0], SHAPE[1]).to(z_dtype), first_seg=False)
+
+
+def check_snapshot_layout(path):
+    header = read_header(path)
+    assert header['data_start'] % ALIGNMENT == 0
+    assert all(info['offset'] % ALIGNMENT == 0 for info in header['tensors'])
+
+
+@pytest.mark.parametrize('storage_name', sorted(MEMORY_STORAGES))
+@pytest.mark.parametrize('z_dtype', [torch.float32, torch.bfloat16])
+def test_armt_state_round_trip(tmp_path, storage_name, z_dtype):
+    torch.manual_seed(0)
+    state = [armt_layer_state(storage_name, z_dtype) for _ in range(3)]
+    path = tmp_path / 'armt.mem'
+    save_memory_snapshot(path, state, meta={'n_segments': 7})
+    check_snapshot_layout(path)
+
+    loaded, meta = load_memory_snapshot(path, return_meta=True)
+    assert meta == {'n_segments': 7}
+    assert_state_equal(loaded, state)
+
+    # loaded state is accepted by a storage of the same mode and reads the same values
+    storage = get_memory_storage(storage_name, SHAPE, **STORAGE_KWARGS.get(storage_name, {}))
+    reference = get_memory_storage(storage_name, SHAPE, **STORAGE_KWARGS.get(storage_name, {}))
+    storage.set_state({k: v for k, v in loaded[0].items() if k not in {'z', 'first_seg'}})
+    reference.set_state({k: v for k, v in state[0].items() if k not in {'z', 'first_seg'}})
+    x = torch.randn(SHAPE[0], 3, SHAPE[1])
+    torch.testing.assert_close(storage.read(x), reference.read(x))
+
+
+@pytest.mark.parametrize('dtype', [torch.float32, torch.bfloat16, torch.float16, torch.int8])
+def test_rmt_state_round_trip(tmp_path, dtype):
+    torch.manual_seed(0)
+    memory_state = (torch.randn(2, 4, 16) * 10).to(dtype)
+    path = tmp_path / 'rmt.mem'
+    save_memory_snapshot(path, memory_state)
+    check_snapshot_layout(path)
+    assert_state_equal(load_memory_snapshot(path), memory_state)
+
+
+def test_loaded_state_is_copy_on_write(tmp_path):
+    memory_state = torch.randn(2, 4, 16)
+    path = tmp_path / 'rmt.mem'
+    save_memory_snapshot(path, memory_state)
+
+    loaded = load_memory_snapshot(path)
+    loaded.zero_()
+    assert torch.equal(load_memory_snapshot(path), memory_state)
+
+
+def test_not_a_snapshot(tmp_path):
+    path = tmp_path / 'other.mem'
+    path.write_bytes(b'not a snapshot')
+    with pytest.raises(ValueError):
+        load_memory_snapshot(path)
+
+
+def test_snapshot_store_lru_eviction(tmp_path):
+    store = MemorySnapshotStore(tmp_path, cache_size=2)
+    states = {key: torch.full((1, 2, 3), float(i)) for i, key in enumerate(['a', 'b', 'c'])}
+    for key, state in states.items():
+        store.put(key, state)
+    assert len(store.cache) == 0
+    assert store.get('missing') is None
+
+    store.get('a')
+    store.get('b')
+    assert list(store.cache) == ['a', 'b']
+    # 'a' becomes the most recently used, so 'b' is evicted by 'c'
+    assert store.get('a') is store.cache['a']
+    store.get('c')
+    assert list(store.cache) == ['a', 'c']
+    # evicted states are loaded from disk again
+    assert_state_equal(store.get('b'), states['b'])
+    assert list(store.cache) == ['c', 'b']
+
+    # put replaces the file and drops the stale cached state
+    new_state = torch.full((1, 2, 3), 10.)
+    store.put('c', new_state)
+    assert 'c' not in store.cache
+    assert_state_equal(store.get('c'), new_state)
+
+    store.delete('b')
+    assert 'b' not in store
+    assert store.get('b', default='missing') == 'missing'
+
+
+def test_snapshot_store_without_cache(tmp_path):
+    store = MemorySnapshotStore(tmp_path, cache_size=0)
+    store.put('a', torch.ones(1, 2, 3))
+    assert_state_equal(store.get('a'), torch.ones(1, 2, 3))
+    assert len(store.cache) == 0